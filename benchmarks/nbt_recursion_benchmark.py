@@ -0,0 +1,142 @@
+'''Compare the explicit-stack NBT tree walks with recursive equivalents.
+
+Run from the repository root with `python benchmarks/nbt_recursion_benchmark.py`.
+'''
+import array
+import sys
+import timeit
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from pyanvil.components import ByteArrayTag, ByteTag, CompoundTag, IntArrayTag, IntTag, ListTag, LongArrayTag, StringTag  # noqa: E402
+from pyanvil.stream import InputStream, OutputStream  # noqa: E402
+from pyanvil.utility.nbt import NBT, TagType  # noqa: E402
+
+
+# Recursive reference versions of the tree walks, as the tag classes used to implement them
+
+def parse_recursive(stream, tag_type, name):
+    if tag_type == TagType.COMPOUND:
+        tag = CompoundTag(tag_name=name)
+        while stream.peek() != 0:
+            child_type = stream.read_u8()
+            child_name = stream.read_string()
+            tag.add_child(parse_recursive(stream, child_type, child_name))
+        stream.skip(1)
+        return tag
+    if tag_type == TagType.LIST:
+        sub_type = stream.read_u8()
+        tag = ListTag(sub_type, tag_name=name)
+        for i in range(stream.read_i32()):
+            tag.add_child(parse_recursive(stream, sub_type, 'None'))
+        return tag
+    return NBT._parsers[tag_type].parse(stream, name)
+
+
+def serialize_recursive(tag, stream, include_name=True):
+    if tag.clazz_id not in (TagType.COMPOUND, TagType.LIST):
+        tag.serialize(stream, include_name=include_name)
+        return
+    if include_name:
+        stream.write_u8(tag.clazz_id)
+        stream.write_string(tag.tag_name)
+    if tag.clazz_id == TagType.COMPOUND:
+        for child in tag.children.values():
+            serialize_recursive(child, stream, include_name=True)
+        stream.write_u8(TagType.END)
+    else:
+        stream.write_u8(tag.sub_type_id)
+        stream.write_i32(len(tag.children))
+        for child in tag.children:
+            serialize_recursive(child, stream, include_name=False)
+
+
+def clone_recursive(tag):
+    if tag.clazz_id == TagType.COMPOUND:
+        return CompoundTag(tag_name=tag.tag_name, children=[clone_recursive(c) for c in tag.children.values()])
+    if tag.clazz_id == TagType.LIST:
+        return ListTag(tag.sub_type_id, tag_name=tag.tag_name, children=[clone_recursive(c) for c in tag.children])
+    return tag.clone()
+
+
+def equal_recursive(tag, other):
+    if tag.clazz_id == TagType.COMPOUND:
+        return tag.tag_name == other.tag_name and tag.children.keys() == other.children.keys() and \
+            all(equal_recursive(c, other.children[n]) for n, c in tag.children.items())
+    if tag.clazz_id == TagType.LIST:
+        return tag.tag_name == other.tag_name and len(tag.children) == len(other.children) and \
+            all(equal_recursive(a, b) for a, b in zip(tag.children, other.children))
+    return tag == other
+
+
+def chunk_shaped():
+    sections = []
+    for y in range(16):
+        sections.append(CompoundTag(children=[
+            ByteTag(y, tag_name='Y'),
+            ListTag(CompoundTag.clazz_id, tag_name='Palette', children=[
+                CompoundTag(children=[
+                    StringTag(f'minecraft:block_{i}', tag_name='Name'),
+                    CompoundTag(tag_name='Properties', children=[StringTag('north', tag_name='facing')]),
+                ]) for i in range(24)
+            ]),
+            LongArrayTag(tag_name='BlockStates', values=array.array('q', [0]) * 320),
+            ByteArrayTag(tag_name='SkyLight', values=array.array('b', [0]) * 2048),
+        ]))
+    entities = [
+        CompoundTag(children=[StringTag('minecraft:zombie', tag_name='id'), ListTag(TagType.DOUBLE, tag_name='Pos')])
+        for i in range(64)
+    ]
+    return CompoundTag(tag_name='', children=[CompoundTag(tag_name='Level', children=[
+        IntTag(0, tag_name='xPos'),
+        IntTag(0, tag_name='zPos'),
+        IntArrayTag(tag_name='Biomes', values=array.array('i', [1]) * 1024),
+        ListTag(CompoundTag.clazz_id, tag_name='Sections', children=sections),
+        ListTag(CompoundTag.clazz_id, tag_name='Entities', children=entities),
+    ])])
+
+
+def deeply_nested(depth):
+    tag = CompoundTag(tag_name='leaf', children=[ByteTag(1, tag_name='b')])
+    for i in range(depth):
+        tag = CompoundTag(tag_name=f'n{i}', children=[tag])
+    return CompoundTag(tag_name='', children=[tag])
+
+
+def to_bytes(tag):
+    stream = OutputStream()
+    tag.serialize(stream)
+    return stream.get_data()
+
+
+def bench(label, iterative, recursive, number):
+    it = min(timeit.repeat(iterative, number=number, repeat=5)) / number
+    try:
+        rec = min(timeit.repeat(recursive, number=number, repeat=5)) / number
+        rec_str = f'{rec * 1e3:9.3f} ms'
+    except RecursionError:
+        rec_str = 'RecursionError'
+    print(f'  {label:<10} iterative {it * 1e3:9.3f} ms   recursive {rec_str}')
+
+
+def run(name, tag, number):
+    data = to_bytes(tag)
+    print(f'{name} ({len(data)} bytes)')
+
+    def parse_rec():
+        stream = InputStream(data)
+        tag_type = stream.read_u8()
+        return parse_recursive(stream, tag_type, stream.read_string())
+
+    bench('parse', lambda: NBT.parse_nbt(InputStream(data)), parse_rec, number)
+    bench('serialize', lambda: tag.serialize(OutputStream()), lambda: serialize_recursive(tag, OutputStream()), number)
+    bench('clone', lambda: NBT.clone_tree(tag), lambda: clone_recursive(tag), number)
+    copy = NBT.clone_tree(tag)
+    bench('equal', lambda: tag == copy, lambda: equal_recursive(tag, copy), number)
+
+
+if __name__ == '__main__':
+    run('chunk-shaped', chunk_shaped(), 20)
+    run('nested 400', deeply_nested(400), 200)
+    run('nested 5000', deeply_nested(5000), 20)
@@ -0,0 +1,83 @@
+import array
+import math
+import zlib
+
+import pytest
+
+from pyanvil.components import ByteArrayTag, ByteTag, CompoundTag, IntArrayTag, IntTag, ListTag, LongArrayTag, StringTag
+from pyanvil.stream import OutputStream
+
+PALETTE = ['minecraft:air', 'minecraft:stone', 'minecraft:dirt']
+
+
+def build_section_nbt(y):
+    # Width 4 palette indices, 16 per long with the first block in the lowest bits
+    longs = array.array('q')
+    for long_index in range(256):
+        lng = 0
+        for i in reversed(range(16)):
+            lng = (lng << 4) + ((long_index * 16 + i) % len(PALETTE))
+        longs.append(int.from_bytes(lng.to_bytes(8, byteorder='big', signed=False), byteorder='big', signed=True))
+    return CompoundTag(children=[
+        ByteTag(y, tag_name='Y'),
+        ListTag(CompoundTag.clazz_id, tag_name='Palette', children=[
+            CompoundTag(children=[StringTag(name, tag_name='Name')]) for name in PALETTE
+        ]),
+        LongArrayTag(tag_name='BlockStates', values=longs),
+        ByteArrayTag(tag_name='SkyLight', values=array.array('b', [-1]) * 2048),
+        ByteArrayTag(tag_name='BlockLight', values=array.array('b', [0]) * 2048),
+    ])
+
+
+def build_chunk_nbt(x, z, section_ys=(0,)):
+    return CompoundTag(tag_name='', children=[
+        IntTag(2586, tag_name='DataVersion'),
+        CompoundTag(tag_name='Level', children=[
+            IntTag(x, tag_name='xPos'),
+            IntTag(z, tag_name='zPos'),
+            IntArrayTag(tag_name='Biomes', values=array.array('i', [1]) * 1024),
+            ListTag(CompoundTag.clazz_id, tag_name='Sections', children=[build_section_nbt(y) for y in section_ys]),
+            ListTag(CompoundTag.clazz_id, tag_name='TileEntities', children=[
+                CompoundTag(children=[StringTag('minecraft:chest', tag_name='id'), IntTag(x * 16, tag_name='x')])
+            ]),
+            CompoundTag(tag_name='Heightmaps', children=[
+                LongArrayTag(tag_name='MOTION_BLOCKING', values=array.array('q', [0]) * 37),
+            ]),
+        ]),
+    ])
+
+
+def write_region_file(path, chunks):
+    '''Write a region file holding the given {(x, z): chunk nbt} mapping, zlib compressed.'''
+    locations = bytearray(4096)
+    timestamps = bytearray(4096)
+    body = bytearray()
+    for (x, z), chunk_nbt in chunks.items():
+        stream = OutputStream()
+        chunk_nbt.serialize(stream)
+        payload = zlib.compress(stream.get_data())
+        data = (len(payload) + 1).to_bytes(4, byteorder='big') + bytes([2]) + payload
+        sectors = math.ceil(len(data) / 4096)
+        index = (x % 32) + (z % 32) * 32
+        offset = 2 + len(body) // 4096
+        locations[index * 4:index * 4 + 4] = offset.to_bytes(3, byteorder='big') + bytes([sectors])
+        timestamps[index * 4:index * 4 + 4] = (1000 + index).to_bytes(4, byteorder='big')
+        body += data + bytes(sectors * 4096 - len(data))
+    with open(path, 'wb') as f:
+        f.write(locations + timestamps + body)
+    return path
+
+
+@pytest.fixture
+def region_file(tmp_path):
+    chunks = {(x, z): build_chunk_nbt(x, z) for (x, z) in [(0, 0), (1, 0), (0, 1), (5, 7)]}
+    return write_region_file(tmp_path / 'r.0.0.mca', chunks)
+
+
+@pytest.fixture
+def world_folder(tmp_path):
+    region_folder = tmp_path / 'world' / 'region'
+    region_folder.mkdir(parents=True)
+    write_region_file(region_folder / 'r.0.0.mca', {(x, z): build_chunk_nbt(x, z, section_ys=(0, 1)) for x in range(2) for z in range(2)})
+    write_region_file(region_folder / 'r.-1.0.mca', {(-1, 0): build_chunk_nbt(-1, 0)})
+    return tmp_path / 'world'
@@ -3,6 +3,7 @@ from .materials import Material
 from .world import World
 from .canvas import Canvas
 from .schematic import Schematic
+from .volume import Volume
 from .utility.nbt import NBT
 
 from .components import ByteArrayTag, ByteTag, CompoundTag, DoubleTag, FloatTag, IntArrayTag, IntTag, ListTag, LongArrayTag, LongTag, ShortTag, StringTag
@@ -13,12 +13,13 @@ class Block(ComponentBase):
         return f'Block({str(self._state)}, {self.block_light}, {self.sky_light})'
 
     def set_state(self, state):
+        # Marked first, a block of a read-only world refuses the change before it is made
+        self.mark_as_dirty()
         self._dirty = True
         if type(state) is BlockState:
             self._state = state
         else:
             self._state = BlockState(state, {})
-        self.mark_as_dirty()
 
     def get_state(self):
         return self._state.clone()
@@ -1,17 +1,52 @@
+from ..utility.nbt import _Owners
+
+
 class BlockState:
     def __init__(self, name: str = 'minecraft:air', props: dict = {}):
         self.name = name
-        self.props = props
+        self._props = props
+        # Owners of the properties dict while it is shared with clones
+        self._shared_props: _Owners = None
         self.id: int = None
 
+    @property
+    def props(self) -> dict:
+        '''The block properties. They can be changed in place, so a copy still shared with a live clone is made private first.'''
+        if self._shared_props is not None:
+            if self.__release():
+                self._props = self._props.copy()
+        return self._props
+
+    @props.setter
+    def props(self, props: dict):
+        self.__release()
+        self._props = props
+
+    def __release(self) -> bool:
+        owners = self._shared_props
+        if owners is None:
+            return False
+        self._shared_props = None
+        owners.count -= 1
+        return owners.count > 0
+
+    def __del__(self):
+        self.__release()
+
     def __str__(self):
-        return f'BlockState({self.name}, {str(self.props)})'
+        return f'BlockState({self.name}, {str(self._props)})'
 
     def __hash__(self):
         return hash(self.name)
 
     def __eq__(self, other):
-        return self.name == other.name and self.props == other.props
+        return self.name == other.name and self._props == other._props
 
     def clone(self):
-        return BlockState(self.name, self.props.copy())
+        '''Copy-on-write clone, the properties are shared until a state hands them out while the other one is alive.'''
+        copy = BlockState(self.name, self._props)
+        if self._shared_props is None:
+            self._shared_props = _Owners()
+        self._shared_props.count += 1
+        copy._shared_props = self._shared_props
+        return copy
@@ -4,9 +4,9 @@ from ..coordinate import AbsoluteCoordinate, ChunkCoordinate
 from .component_base import ComponentBase
 from . import ChunkSection, Sizes, Block, Biome
 from . import CompoundTag, ListTag
+from ..utility import compression
 from ..utility.nbt import NBT
 from ..stream import InputStream, OutputStream
-import zlib
 
 
 class Chunk(ComponentBase):
@@ -28,21 +28,48 @@ class Chunk(ComponentBase):
     def from_file(file: BinaryIO, offset: int, sections: int, parent_region: 'Region' = None) -> 'Chunk':
         file.seek(offset)
         datalen = int.from_bytes(file.read(4), byteorder="big", signed=False)
-        file.read(1)  # Compression scheme
-        decompressed = zlib.decompress(file.read(datalen - 1))
-        data = NBT.parse_nbt(InputStream(decompressed))
+        return Chunk.from_data(datalen.to_bytes(4, byteorder='big') + file.read(datalen), parent_region=parent_region)
+
+    @staticmethod
+    def from_data(data, parent_region: 'Region' = None) -> 'Chunk':
+        '''Load a chunk from its stored form: length prefix, compression scheme and compressed payload.'''
+        datalen = int.from_bytes(data[0:4], byteorder="big", signed=False)
+        scheme = data[4]
+        if scheme & compression.EXTERNAL:
+            raise ValueError('Chunk data is stored in an external .mcc file, load it through its Region')
+        return Chunk.from_payload(scheme, data[5:4 + datalen], datalen, parent_region=parent_region)
+
+    @staticmethod
+    def from_payload(scheme: int, payload, orig_size: int = None, parent_region: 'Region' = None) -> 'Chunk':
+        '''Load a chunk from its compressed payload and the compression scheme it was stored with.'''
+        if orig_size is None:
+            orig_size = len(payload) + 1
+        return Chunk.from_nbt_data(compression.decompress(scheme, payload), orig_size, parent_region=parent_region)
+
+    @staticmethod
+    def from_nbt_data(decompressed, orig_size: int, parent_region: 'Region' = None) -> 'Chunk':
+        '''Load a chunk from its decompressed NBT data.'''
+        data = NBT.parse_nbt(InputStream(decompressed), lazy=True)
         root_tag = data.get("Level")
         x = root_tag.get("xPos").get()
         z = root_tag.get("zPos").get()
-        return Chunk(ChunkCoordinate(x, z), Chunk.__unpack_sections(data), data, datalen, parent_region=parent_region)
+        return Chunk(ChunkCoordinate(x, z), Chunk.__unpack_sections(data), data, orig_size, parent_region=parent_region)
 
-    def package_and_compress(self):
+    def package_and_compress(self, scheme: int = compression.ZLIB, level: int = compression.DEFAULT_LEVEL):
         """Serialize and compress chunk to raw data"""
+        return Chunk.compress(self.package(), scheme, level)
+
+    def package(self) -> bytes:
+        """Serialize chunk to uncompressed NBT data"""
         stream = OutputStream()
-        # Serialize and compress chunk
         chunkNBT = self.pack()
         chunkNBT.serialize(stream)
-        return zlib.compress(stream.get_data())
+        return stream.get_data()
+
+    @staticmethod
+    def compress(data, scheme: int = compression.ZLIB, level: int = compression.DEFAULT_LEVEL) -> bytes:
+        '''Compress serialized chunk data. Only takes and returns bytes so it can run in a worker process.'''
+        return compression.compress(scheme, data, level)
 
     @property
     def index(self):
@@ -63,12 +90,10 @@ class Chunk(ComponentBase):
     def get_section(self, y) -> ChunkSection:
         key = int(y / Sizes.SUBCHUNK_WIDTH)
         if key not in self.sections:
-            self.sections[key] = ChunkSection(
-                CompoundTag(),
-                key,
-                blocks=[Block(dirty=True) for i in range(4096)],
-                parent_chunk=self
-            )
+            section = ChunkSection(CompoundTag(), key, parent_chunk=self)
+            section.set_blocks(blocks={i: Block(parent_chunk_section=section) for i in range(4096)})
+            # Only stands in for the missing air, it is written once one of its blocks is changed
+            self.sections[key] = section
         return self.sections[key]
 
     def find_like(self, string) -> list[Block]:
@@ -104,7 +129,8 @@ class Chunk(ComponentBase):
         new_sections: ListTag = ListTag(
             CompoundTag.clazz_id,
             tag_name='Sections',
-            children=[sec.serialize() for sec in self.sections.values()]
+            # Sections that were never stored and never changed are only air, they are left out
+            children=[sec.serialize() for sec in self.sections.values() if sec.is_dirty or sec.raw_section.has('Y')]
         )
         new_nbt = self.raw_nbt.clone()
         new_nbt.get('Level').add_child(new_sections)
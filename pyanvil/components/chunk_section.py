@@ -1,17 +1,23 @@
+import array
 import math
 from .component_base import ComponentBase
 from . import Block, BlockState, Sizes
-from . import ByteArrayTag, ByteTag, CompoundTag, StringTag, LongArrayTag, LongTag, ListTag
+from . import ByteArrayTag, ByteTag, CompoundTag, StringTag, LongArrayTag, ListTag
 
 
 class ChunkSection(ComponentBase):
+    BLOCK_COUNT = Sizes.SUBCHUNK_WIDTH ** 3
+
     def __init__(self, raw_section, y_index, blocks: dict[int, Block] = None, parent_chunk: 'Chunk' = None):
         super().__init__(parent=parent_chunk)
 
-        if blocks is None:
-            blocks = dict()
+        # Without blocks they are built from the raw section the first time one is asked for
         self.__blocks: dict[int, Block] = blocks
 
+        # Palette indices set through set_palette_indices, in place of blocks
+        self.__indices: array.array = None
+        self.__palette: list[BlockState] = None
+
         self.raw_section = raw_section
         self.y_index = y_index
 
@@ -20,24 +26,69 @@ class ChunkSection(ComponentBase):
         y = block_pos[1]
         z = block_pos[2]
 
-        return self.__blocks[x + z * Sizes.SUBCHUNK_WIDTH + y * Sizes.SUBCHUNK_WIDTH ** 2]
+        return self.__get_blocks()[x + z * Sizes.SUBCHUNK_WIDTH + y * Sizes.SUBCHUNK_WIDTH ** 2]
 
     def set_blocks(self, blocks: dict[int, Block]):
         if blocks is not None:
             self.__blocks = blocks
         else:
             self.__blocks = dict()
+        self.__indices = self.__palette = None
 
     @staticmethod
     def from_nbt(section_nbt, parent_chunk=None) -> 'ChunkSection':
-        states = []  # Sections which contain only air have no states.
-        if section_nbt.has('BlockStates'):
-            flatstates = [c.get() for c in section_nbt.get('BlockStates').children]
-            pack_size = (len(flatstates) * 64) // (Sizes.SUBCHUNK_WIDTH ** 3)
-            states = [
-                ChunkSection._read_width_from_loc(flatstates, pack_size, i) for i in range(Sizes.SUBCHUNK_WIDTH ** 3)
-            ]
-        palette: list[BlockState] = None
+        return ChunkSection(section_nbt, section_nbt.get('Y').get(), parent_chunk=parent_chunk)
+
+    def palette_indices(self) -> tuple[array.array, list[BlockState]]:
+        '''The blocks of the section as 4096 palette indices (x fastest, then z, then y) and their palette.
+
+        Reads the packed block states directly when no `Block` objects have been built.'''
+        # Read each attribute once, another thread may be building the blocks meanwhile
+        given, given_palette, blocks = self.__indices, self.__palette, self.__blocks
+        if given is not None:
+            return array.array('H', given), list(given_palette)
+        if blocks is not None:
+            palette = []
+            mapping = {}
+            indices = array.array('H')
+            for i in range(len(blocks)):
+                state = blocks[i]._state
+                if state not in mapping:
+                    mapping[state] = len(palette)
+                    palette.append(state)
+                indices.append(mapping[state])
+            return indices, palette
+        return self.__read_raw_indices()
+
+    def set_palette_indices(self, indices: array.array, palette: list[BlockState]):
+        '''Replace every block of the section, the counterpart of `palette_indices`.
+
+        Blocks that were already built are changed in place and keep their light values, so `Block` objects
+        handed out before stay part of the section.'''
+        self.mark_as_dirty()
+        if self.__blocks is not None:
+            palette = list(palette)
+            for i, block in self.__blocks.items():
+                block._state = palette[indices[i]]
+            return
+        self.__indices = array.array('H', indices)
+        self.__palette = list(palette)
+        self.__blocks = None
+
+    def light_values(self) -> tuple[array.array, array.array]:
+        '''Block light and sky light of the 4096 blocks, in the same order as `palette_indices`.'''
+        if self.__blocks is not None:
+            blocks = [self.__blocks[i] for i in range(len(self.__blocks))]
+            return array.array('B', (b.block_light for b in blocks)), array.array('B', (b.sky_light for b in blocks))
+        return tuple(
+            array.array('B', ChunkSection._divide_nibbles(self.raw_section.get(name).get()))
+            if self.raw_section.has(name) else array.array('B', bytes(ChunkSection.BLOCK_COUNT))
+            for name in ('BlockLight', 'SkyLight')
+        )
+
+    def __read_raw_indices(self) -> tuple[array.array, list[BlockState]]:
+        section_nbt = self.raw_section
+        palette: list[BlockState] = [BlockState('minecraft:air', {})]
         if section_nbt.has('Palette'):
             palette = [
                 BlockState(
@@ -45,35 +96,45 @@ class ChunkSection(ComponentBase):
                     state.get('Properties').to_dict() if state.has('Properties') else {}
                 ) for state in section_nbt.get('Palette').children
             ]
-        block_lights = ChunkSection._divide_nibbles(section_nbt.get('BlockLight').get()) if section_nbt.has('BlockLight') else None
-        sky_lights = ChunkSection._divide_nibbles(section_nbt.get('SkyLight').get()) if section_nbt.has('SkyLight') else None
-        section = ChunkSection(section_nbt, section_nbt.get('Y').get(), parent_chunk=parent_chunk)
-        blocks: dict[int, Block] = dict()
-        for i, state in enumerate(states):
-            state = palette[state]
-            block_light = block_lights[i] if block_lights else 0
-            sky_light = sky_lights[i] if sky_lights else 0
-            blocks[i] = Block(state=state, block_light=block_light, sky_light=sky_light, parent_chunk_section=section)
-        section.set_blocks(blocks=blocks)
-        return section
+        if not section_nbt.has('BlockStates'):
+            # Sections which contain only air have no states.
+            return array.array('H', bytes(2 * ChunkSection.BLOCK_COUNT)), palette
+        flatstates = section_nbt.get('BlockStates').get()
+        pack_size = (len(flatstates) * 64) // ChunkSection.BLOCK_COUNT
+        return ChunkSection._unpack_indices(flatstates, pack_size), palette
+
+    def __get_blocks(self) -> dict[int, Block]:
+        if self.__blocks is None:
+            indices, palette = self.palette_indices()
+            block_lights, sky_lights = self.light_values()
+            self.__blocks = {
+                i: Block(state=palette[state], block_light=block_lights[i], sky_light=sky_lights[i], parent_chunk_section=self)
+                for i, state in enumerate(indices)
+            }
+            self.__indices = self.__palette = None
+        return self.__blocks
 
     def serialize(self):
         serial_section = self.raw_section
-        dirty = any((b.is_dirty for b in self.__blocks.values()))
-        if dirty:
-            self.palette = list(set([b._state for b in self.__blocks.values()] + [BlockState('minecraft:air', {})]))
-            self.palette.sort(key=lambda s: s.name)
+        # Clean sections are written back as they were read
+        if self.is_dirty:
+            indices, palette = self.palette_indices()
+            # Only keep the states in use, sorted by name, with air always present
+            used = set(palette[i] for i in set(indices)) | {BlockState('minecraft:air', {})}
+            self.palette = sorted(used, key=lambda s: s.name)
             serial_section.add_child(ByteTag(tag_value=self.y_index, tag_name='Y'))
             mat_id_mapping = {self.palette[i]: i for i in range(len(self.palette))}
             new_palette = self._serialize_palette()
             serial_section.add_child(new_palette)
-            serial_section.add_child(self._serialize_blockstates(mat_id_mapping))
+            # Unused palette entries were dropped, no index refers to them
+            remap = [mat_id_mapping.get(state, 0) for state in palette]
+            serial_section.add_child(self._serialize_blockstates(array.array('H', (remap[i] for i in indices))))
 
         if not serial_section.has('SkyLight'):
-            serial_section.add_child(ByteArrayTag(tag_name='SkyLight', children=[ByteTag(-1, tag_name='None') for i in range(2048)]))
+            serial_section.add_child(ByteArrayTag(tag_name='SkyLight', values=array.array('b', [-1]) * 2048))
 
         if not serial_section.has('BlockLight'):
-            serial_section.add_child(ByteArrayTag(tag_name='BlockLight', children=[ByteTag(-1, tag_name='None') for i in range(2048)]))
+            serial_section.add_child(ByteArrayTag(tag_name='BlockLight', values=array.array('b', [-1]) * 2048))
 
         return serial_section
 
@@ -92,8 +153,8 @@ class ChunkSection(ComponentBase):
 
         return serial_palette
 
-    def _serialize_blockstates(self, state_mapping):
-        serial_states = LongArrayTag(tag_name='BlockStates')
+    def _serialize_blockstates(self, indices: array.array):
+        longs = array.array('q')
         width = math.ceil(math.log(len(self.palette), 2))
         if width < 4:
             width = 4
@@ -102,54 +163,36 @@ class ChunkSection(ComponentBase):
         states_per_long = 64 // width
 
         # amount of longs
-        arraylength = math.ceil(len(self.__blocks) / states_per_long)
+        arraylength = math.ceil(len(indices) / states_per_long)
 
         for long_index in range(arraylength):
             lng = 0
-            for state in range(states_per_long):
-                # insert blocks in reverse, so first one ends up most to the right
-                block_index = long_index * states_per_long + (states_per_long - state - 1)
-
-                if block_index < len(self.__blocks):
-                    block = self.__blocks[block_index]
-                    lng = (lng << width) + state_mapping[block._state]
+            # insert blocks in reverse, so first one ends up most to the right
+            for state in reversed(indices[long_index * states_per_long:(long_index + 1) * states_per_long]):
+                lng = (lng << width) + state
 
             lng = int.from_bytes(lng.to_bytes(8, byteorder='big', signed=False), byteorder='big', signed=True)
-            serial_states.add_child(LongTag(lng))
-        return serial_states
-
-    @staticmethod
-    def _read_width_from_loc(long_list, width, position):
-        # max amount of blockstates that fit in each long
-        states_per_long = 64 // width
-
-        # the long in which this blockstate is stored
-        long_index = position // states_per_long
-
-        # at which bit in the long this state is located
-        position_in_long = (position % states_per_long) * width
-        return ChunkSection._read_bits(long_list[long_index], width, position_in_long)
+            longs.append(lng)
+        return LongArrayTag(tag_name='BlockStates', values=longs)
 
     @staticmethod
-    def _read_bits(num, width: int, start: int):
-        # create a mask of size 'width' of 1 bits
-        mask = (2 ** width) - 1
-        # shift it out to where we need for the mask
-        mask = mask << start
-        # select the bits we need
-        comp = num & mask
-        # move them back to where they should be
-        comp = comp >> start
-
-        return comp
+    def _unpack_indices(long_list, width) -> array.array:
+        '''All palette indices packed in `long_list`, `64 // width` per long starting at the lowest bits.'''
+        mask = (1 << width) - 1
+        shifts = range(0, (64 // width) * width, width)
+        indices = array.array('H')
+        for lng in long_list:
+            lng &= 0xFFFFFFFFFFFFFFFF
+            indices.extend([(lng >> shift) & mask for shift in shifts])
+        del indices[ChunkSection.BLOCK_COUNT:]
+        return indices
 
     @staticmethod
     def _divide_nibbles(arry):
+        # Two values per byte, the first one in the low nibble
         rtn = []
-        f2_mask = (2 ** 4) - 1
-        f1_mask = f2_mask << 4
         for s in arry:
-            rtn.append(s & f1_mask)
-            rtn.append(s & f2_mask)
+            rtn.append(s & 0x0F)
+            rtn.append((s >> 4) & 0x0F)
 
         return rtn
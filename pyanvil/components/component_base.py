@@ -1,24 +1,54 @@
 from abc import ABC
+from io import UnsupportedOperation
 
 
 class ComponentBase(ABC):
+    # Set on the root of a read-only component chain, components below it cannot be marked as dirty
+    _read_only: bool = False
+
     def __init__(self, parent=None, dirty=False):
         '''Handles "dirty" propagation up the component chain.'''
         self._parent: ComponentBase = parent
         self._is_dirty: bool = dirty
-        self._dirty_children: set = set()
+        # Only allocated once a child is marked as dirty
+        self._dirty_children: set = None
 
     @property
     def is_dirty(self):
         return self._is_dirty
 
+    @property
+    def is_read_only(self) -> bool:
+        component = self
+        while component._parent is not None:
+            component = component._parent
+        return component._read_only
+
     def mark_as_dirty(self):
-        self._is_dirty = True
-        if self._parent is not None:
-            self._parent.mark_child_as_dirty(self)
-            self._parent.mark_as_dirty()
+        if self.is_read_only:
+            raise UnsupportedOperation(f'{self} belongs to a read-only component and cannot be changed')
+        # The chain is only checked once, the components above are marked without walking it again
+        component = self
+        while component is not None:
+            component._is_dirty = True
+            parent = component._parent
+            if parent is not None:
+                parent.mark_child_as_dirty(component)
+            component = parent
+
+    def mark_as_clean(self):
+        '''Clear the dirty state of this component and of every dirty component below it.'''
+        stack = [self]
+        while stack:
+            component = stack.pop()
+            component._is_dirty = False
+            if component._dirty_children:
+                stack.extend(component._dirty_children)
+            component._dirty_children = None
 
     def mark_child_as_dirty(self, child):
+        if self._dirty_children is None:
+            self._dirty_children = set()
         self._dirty_children.add(child)
 
     def set_parent(self, parent: 'ComponentBase'):
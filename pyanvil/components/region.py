@@ -1,35 +1,83 @@
+import array
 import math
+import mmap
+import os
 import sys
-from io import FileIO
+import threading
+import weakref
+from concurrent.futures import Executor, ThreadPoolExecutor
+from io import FileIO, UnsupportedOperation
 from pathlib import Path
 from time import time
-from typing import BinaryIO, Union
+from typing import Iterable, Union
 import logging
-
-from ..coordinate import ChunkCoordinate
+import re
+from contextlib import contextmanager
+
+from ..coordinate import ChunkCoordinate, RegionCoordinate
+from ..stream import DecompressingReader, InputStream
+from ..utility import compression
+from ..utility.file_pool import PooledFile, RegionFilePool, default_pool
+from ..utility.nbt import NBT, NBTEventReader, NBTPath
 from . import Chunk
 from .component_base import ComponentBase
 from .constants import Sizes
 
+_decompress_pool: ThreadPoolExecutor = None
+_decompress_pool_lock = threading.Lock()
+
+
+def _default_decompress_pool() -> ThreadPoolExecutor:
+    '''The thread pool prefetches decompress on when they are not given an executor, started on first use.'''
+    global _decompress_pool
+    with _decompress_pool_lock:
+        if _decompress_pool is None:
+            _decompress_pool = ThreadPoolExecutor(thread_name_prefix='pyanvil-decompress')
+        return _decompress_pool
+
 
 class Region(ComponentBase):
-    def __init__(self, region_file: Union[str, Path]):
+    # Chunks that need more sectors than the one byte sector count can hold go to an external file
+    MAX_CHUNK_SECTORS = 255
+
+    ORDER_Z_MAJOR = 'z-major'
+    ORDER_MORTON = 'morton'
+    ORDERS = (ORDER_Z_MAJOR, ORDER_MORTON)
+
+    # Reading a few unwanted sectors is cheaper than another seek
+    PREFETCH_MAX_GAP = 4 * Sizes.CHUNK_SECTOR_SIZE
+
+    def __init__(self, region_file: Union[str, Path], compression_scheme: Union[int, str] = compression.ZLIB,
+                 compression_level: int = compression.DEFAULT_LEVEL, append_only: bool = False, compact_threshold: float = None,
+                 file_pool: RegionFilePool = None, read_only: bool = False):
+        '''In `append_only` mode saves never overwrite chunk data, new chunk versions go to the end of the file and the
+        header is written once per save. With a `compact_threshold` the region is compacted after a save that leaves
+        more than that fraction of the file unused. The file is opened through `file_pool`, by default the pool
+        shared by all regions.
+
+        A `read_only` region only ever opens its file for reading, its chunks cannot be changed or saved.'''
         super().__init__(parent=None)
         self.file_path = region_file
-        self.file: FileIO = None
+        self._read_only = read_only
+        # Defaults for save(), chunks are read with whatever scheme they were stored with
+        self.compression_scheme = compression.get_codec(compression_scheme).scheme
+        self.compression_level = compression_level
+        self.append_only = append_only
+        self.compact_threshold = compact_threshold
+        self.file_pool = file_pool if file_pool is not None else default_pool
+        self.file_pool.acquire(self.file_path)
+        self.__closed = False
         self.chunks: dict[int, Chunk] = {}
+        # Unloaded chunks that are still referenced elsewhere, they are handed out again instead of a second copy
+        self.__unloaded: weakref.WeakValueDictionary[int, Chunk] = weakref.WeakValueDictionary()
 
         # locations and timestamps are parallel lists.
         # Indexes in one can be accessed in the other as well.
         self.__chunk_locations: list[list[int]] = None
         self.__timestamps: list[int] = None
 
-        # Uninterpreted raw data
-        # Header
-        self.__chunk_location_data: bytes = None
-        self.__timestamps_data: bytes = None
-        # Uninterpreted chunks mapped to their index
-        self.__raw_chunk_data: dict[int, bytes] = {}
+        # Header as it was when the region was opened
+        self.__header: RegionHeader = None
 
         self.__load_from_file()
 
@@ -39,133 +87,463 @@ class Region(ComponentBase):
     def __exit__(self, exc_type, exc_value, traceback):
         if self.is_dirty:
             self.save()
-        if self.file:
-            self.file.close()
+        self.close()
+
+    def close(self):
+        '''Release the region file, other regions may still be using it.'''
+        if not self.__closed:
+            self.__closed = True
+            self.file_pool.release(self.file_path)
 
     def __load_from_file(self):
-        self.__ensure_file_open()
-        # 8KiB header. 4KiB chunk location table, 4KiB timestamp table
-        self.__chunk_location_data = self.file.read(4 * 1024)
-        self.__timestamps_data = self.file.read(4 * 1024)
-        self.__read_chunks_to_memory()
+        # 8KiB header. 4KiB chunk location table, 4KiB timestamp table.
+        # Chunks are only sliced out of the map when they are requested.
+        self.__header = self.header
+
+    def __check_writable(self):
+        if self._read_only:
+            raise UnsupportedOperation(f'Region "{self.file_path}" is opened read-only')
+
+    def __open(self, write: bool = False) -> PooledFile:
+        return self.file_pool.get(self.file_path, write=write)
+
+    def save(self, executor: Executor = None, compression_scheme: Union[int, str] = None, compression_level: int = None,
+             chunks: Iterable[Chunk] = None):
+        '''Write the dirty chunks back to the region file, clean chunks keep their stored bytes and timestamps.
+
+        With an `executor` (thread or process pool) the chunks are compressed concurrently,
+        serialization and sector placement stay on the calling thread.
+        The compression scheme and level default to the ones the region was opened with.
+        Given `chunks`, only those of them that are dirty are written, the other dirty chunks stay dirty.'''
+        self.__check_writable()
+        scheme = self.compression_scheme if compression_scheme is None else compression.get_codec(compression_scheme).scheme
+        level = self.compression_level if compression_level is None else compression_level
+        file = self.__open(write=True)
+        sectors = self.__sector_map()
+        dirty_chunks = self._dirty_children or set()
+        if chunks is not None:
+            dirty_chunks = dirty_chunks.intersection(chunks)
+        dirty_chunks = sorted(dirty_chunks, key=lambda chunk: chunk.index)
+
+        for chunk, chunk_data in zip(dirty_chunks, self.__compress_chunks(dirty_chunks, executor, scheme, level)):
+            index = chunk.index
+            sector_count = math.ceil((len(chunk_data) + 5) / Sizes.CHUNK_SECTOR_SIZE)
+            external_path = self.__external_path(index)
+            stored_scheme = scheme
+            if sector_count > Region.MAX_CHUNK_SECTORS:
+                external_path.write_bytes(chunk_data)
+                stored_scheme, chunk_data, sector_count = scheme | compression.EXTERNAL, b'', 1
+            elif external_path.exists():
+                external_path.unlink()
+
+            # Constuct new data block, padded to whole sectors
+            data = bytearray((len(chunk_data) + 1).to_bytes(length=4, byteorder='big', signed=False))  # Total length of chunk data
+            data += stored_scheme.to_bytes(length=1, byteorder='big', signed=False)
+            data += chunk_data
+            data += bytes(sector_count * Sizes.CHUNK_SECTOR_SIZE - len(data))
 
-    def __ensure_file_open(self):
-        if not self.file:
-            self.file = open(self.file_path, mode='r+b')
+            loc = self.__chunk_locations[index]
+            old_start, old_count = loc[0] // Sizes.CHUNK_SECTOR_SIZE, loc[1] // Sizes.CHUNK_SECTOR_SIZE
+            sectors.free(old_start, old_count)
+            if self.append_only:
+                start = sectors.end
+            elif old_start != 0 and sector_count <= old_count:
+                start = old_start
+            else:
+                start = sectors.allocate(sector_count)
+            sectors.mark(start, sector_count)
+
+            file.file.seek(start * Sizes.CHUNK_SECTOR_SIZE)
+            file.file.write(data)
+            logging.debug(f'Saving {chunk} with', {'loc': loc, 'new_start': start, 'sectors': sector_count})
+
+            self.__chunk_locations[index] = [start * Sizes.CHUNK_SECTOR_SIZE, sector_count * Sizes.CHUNK_SECTOR_SIZE]
+            self.timestamps[index] = int(time())
+            if not self.append_only:
+                self.__write_header_entry(file.file, index)
+
+        if self.append_only:
+            # The old header keeps pointing at the old chunk versions until the new data is on disk
+            file.file.flush()
+            file.file.seek(0)
+            file.file.write(self.__header_data())
+        file.file.flush()
+        file.remap()
+
+        if chunks is None:
+            self.mark_as_clean()
+        else:
+            for chunk in dirty_chunks:
+                chunk.mark_as_clean()
+                self._dirty_children.discard(chunk)
+            if not self._dirty_children:
+                self.mark_as_clean()
+
+        if self.compact_threshold is not None and self.dead_space_ratio > self.compact_threshold:
+            self.compact()
+
+    def compact(self):
+        '''Rewrite the region with its chunks back to back in index order, dropping unused sectors and padding.'''
+        self.optimize(order=Region.ORDER_Z_MAJOR)
+
+    def optimize(self, order: str = ORDER_Z_MAJOR) -> int:
+        '''Rewrite the region with its chunks back to back in scan order, dropping unused sectors and padding.
+
+        `order` is `Region.ORDER_Z_MAJOR` (rows of x for each z, the index order) or `Region.ORDER_MORTON`
+        (Z-order curve, keeps square areas close together). Dirty chunks are saved first. The new file is written
+        next to the old one and then replaces it. Returns the number of bytes reclaimed.'''
+        self.__check_writable()
+        if order not in Region.ORDERS:
+            raise ValueError(f'Unknown chunk order "{order}", expected one of {", ".join(Region.ORDERS)}')
+        if self.is_dirty:
+            self.save()
+        size_before = Path(self.file_path).stat().st_size
+        indexes = [i for i, (offset, size) in enumerate(self.chunk_locations) if offset != 0 and size != 0]
+        self.__rewrite(sorted(indexes, key=Region.morton_key) if order == Region.ORDER_MORTON else indexes)
+        return size_before - Path(self.file_path).stat().st_size
+
+    def __rewrite(self, indexes: list[int]):
+        path = Path(self.file_path)
+        temp_path = path.with_name(path.name + '.tmp')
+        locations = [[0, 0] for i in range(RegionHeader.ENTRIES)]
+        with open(temp_path, mode='wb') as out:
+            out.write(bytes(RegionHeader.SIZE))
+            sector = RegionHeader.SIZE // Sizes.CHUNK_SECTOR_SIZE
+            for index in indexes:
+                with self.__chunk_data(index) as data:
+                    sector_count = math.ceil(len(data) / Sizes.CHUNK_SECTOR_SIZE)
+                    out.write(data)
+                    out.write(bytes(sector_count * Sizes.CHUNK_SECTOR_SIZE - len(data)))
+                locations[index] = [sector * Sizes.CHUNK_SECTOR_SIZE, sector_count * Sizes.CHUNK_SECTOR_SIZE]
+                sector += sector_count
+            out.seek(0)
+            out.write(self.__header_data(locations))
+            out.flush()
+            os.fsync(out.fileno())
+        # Every region reading the old file has to map the new one
+        self.file_pool.discard(path)
+        os.replace(temp_path, path)
+        self.__chunk_locations = locations
+
+    def __header_data(self, locations: list[list[int]] = None) -> bytes:
+        if locations is None:
+            locations = self.chunk_locations
+        table = array.array('I', (
+            (offset // Sizes.CHUNK_SECTOR_SIZE) << 8 | (size // Sizes.CHUNK_SECTOR_SIZE) for offset, size in locations
+        ))
+        table.extend(self.timestamps)
+        if sys.byteorder == 'little':
+            table.byteswap()
+        return table.tobytes()
 
-    def __read_chunks_to_memory(self):
-        for offset, size in self.chunk_locations:
-            self.file.seek(offset)
-            self.__raw_chunk_data[offset] = self.file.read(size)
+    @property
+    def dead_space_ratio(self) -> float:
+        '''Fraction of the file's sectors that hold neither the header nor live chunk data.'''
+        sectors = self.__sector_map()
+        return sectors.free_sectors / sectors.end if sectors.end else 0.0
 
-    def save(self):
-        self.__ensure_file_open()
-        self.file.seek((4 + 4) * 1024)  # Skip to the end of the region header
-        # Sort chunks by offset
-        #self.chunks.sort(key=lambda chunk: self.__chunk_locations[chunk.index][0])
+    @staticmethod
+    def __compress_chunks(chunks: list[Chunk], executor: Executor, scheme: int, level: int):
+        if executor is None:
+            return (chunk.package_and_compress(scheme, level) for chunk in chunks)
+        packaged = [chunk.package() for chunk in chunks]
+        return executor.map(Chunk.compress, packaged, [scheme] * len(packaged), [level] * len(packaged))
+
+    def __sector_map(self) -> 'SectorMap':
+        file_size = Path(self.file_path).stat().st_size
+        sectors = SectorMap(math.ceil(file_size / Sizes.CHUNK_SECTOR_SIZE))
+        sectors.mark(0, 2)  # The header
+        for offset, size in self.chunk_locations:
+            if offset != 0 and size != 0:
+                sectors.mark(offset // Sizes.CHUNK_SECTOR_SIZE, size // Sizes.CHUNK_SECTOR_SIZE)
+        return sectors
+
+    def __write_header_entry(self, file: FileIO, index: int):
+        offset, size = self.__chunk_locations[index]
+        file.seek(index * 4)
+        file.write((offset // Sizes.CHUNK_SECTOR_SIZE).to_bytes(3, byteorder='big', signed=False))
+        file.write((size // Sizes.CHUNK_SECTOR_SIZE).to_bytes(1, byteorder='big', signed=False))
+        file.seek(4 * 1024 + index * 4)
+        file.write(self.timestamps[index].to_bytes(4, byteorder='big', signed=False))
 
-        rest_of_the_data = self.__read_region_after_header()
+    def get_chunk(self, coord: ChunkCoordinate):
+        chunk_index = Chunk.to_region_chunk_index(coord)
+        logging.debug(f'Loading {coord.x}x {coord.z}z from {self.file_path}')
+        chunk = self.__loaded_chunk(chunk_index)
+        if chunk is None:
+            with self.__chunk_payload(chunk_index) as (scheme, payload):
+                chunk = Chunk.from_payload(scheme, payload, parent_region=self)
+            # Readers sharing the region may have loaded the chunk meanwhile, they all get the same one
+            chunk = self.chunks.setdefault(chunk_index, chunk)
+        return chunk
+
+    def unload_chunk(self, coord: ChunkCoordinate):
+        '''Forget a loaded chunk, a dirty chunk is saved first on its own.
+
+        As long as the chunk is still referenced elsewhere, loading it again returns the same instance.'''
+        chunk = self.chunks.get(Chunk.to_region_chunk_index(coord))
+        if chunk is None:
+            return
+        if chunk.is_dirty:
+            self.save(chunks=[chunk])
+        self.__unloaded[chunk.index] = chunk
+        self.chunks.pop(chunk.index, None)
+
+    def __loaded_chunk(self, index: int) -> Chunk:
+        chunk = self.chunks.get(index)
+        if chunk is None:
+            chunk = self.__unloaded.pop(index, None)
+            if chunk is not None:
+                chunk = self.chunks.setdefault(index, chunk)
+        return chunk
+
+    def prefetch(self, coords: Iterable[ChunkCoordinate], executor: Executor = None) -> list[Chunk]:
+        '''Load many chunks of the region at once and return them, in the order of `coords`.
+
+        The chunks that are not loaded yet are read in file order, neighbouring chunks in one read,
+        and are decompressed on `executor`, a thread or process pool. Without one they are decompressed on a
+        thread pool shared by all regions.'''
+        indexes = [Chunk.to_region_chunk_index(coord) for coord in coords]
+        # Kept here as well, another thread may unload chunks from the region before they are returned
+        found = {}
+        for i in indexes:
+            chunk = self.__loaded_chunk(i)
+            if chunk is not None:
+                found[i] = chunk
+        wanted = sorted(
+            {i for i in indexes if i not in found and self.chunk_locations[i][1] != 0},
+            key=lambda i: self.chunk_locations[i][0]
+        )
+        payloads = self.__read_payloads(wanted)
+        if payloads:
+            schemes, views = zip(*payloads.values())
+            if executor is None and len(payloads) == 1:
+                decompressed = [compression.decompress(schemes[0], views[0])]
+            elif executor is None:
+                decompressed = list(_default_decompress_pool().map(compression.decompress, schemes, views))
+            else:
+                if not isinstance(executor, ThreadPoolExecutor):
+                    # Views cannot be pickled, other processes get a copy
+                    views = [bytes(view) for view in views]
+                decompressed = list(executor.map(compression.decompress, schemes, views))
+            for (index, (scheme, payload)), data in zip(payloads.items(), decompressed):
+                found[index] = self.chunks.setdefault(index, Chunk.from_nbt_data(data, len(payload) + 1, parent_region=self))
+        return [found[i] for i in indexes if i in found]
+
+    def __read_payloads(self, indexes: list[int]) -> dict[int, tuple[int, memoryview]]:
+        '''Read the schemes and payloads of the chunks at `indexes`, which are sorted by offset.
+
+        Chunks that are at most `PREFETCH_MAX_GAP` bytes apart are read together.'''
+        runs = []
+        for index in indexes:
+            offset, size = self.chunk_locations[index]
+            if runs and offset - runs[-1][1] <= Region.PREFETCH_MAX_GAP:
+                runs[-1][1] = max(runs[-1][1], offset + size)
+                runs[-1][2].append(index)
+            else:
+                runs.append([offset, offset + size, [index]])
+
+        mapped = self.__open().map
+        payloads = {}
+        for start, end, run in runs:
+            if hasattr(mapped, 'madvise') and start % mmap.PAGESIZE == 0:
+                mapped.madvise(mmap.MADV_WILLNEED, start, end - start)
+            data = memoryview(mapped[start:end])
+            for index in run:
+                offset = self.chunk_locations[index][0] - start
+                datalen = int.from_bytes(data[offset:offset + 4], byteorder='big', signed=False)
+                scheme = data[offset + 4]
+                if scheme & compression.EXTERNAL:
+                    payloads[index] = (scheme & ~compression.EXTERNAL, self.__external_path(index).read_bytes())
+                else:
+                    payloads[index] = (scheme, data[offset + 5:offset + 4 + datalen])
+        return payloads
+
+    def iter_chunk_events(self, coord: ChunkCoordinate) -> NBTEventReader:
+        '''Stream the NBT events of a chunk, inflating it as it is read instead of building a `Chunk`.'''
+        with self.__chunk_payload(Chunk.to_region_chunk_index(coord)) as (scheme, payload):
+            if scheme == compression.ZLIB:
+                return NBT.iter_events(DecompressingReader(bytes(payload)))
+            if scheme == compression.GZIP:
+                return NBT.iter_events(DecompressingReader(bytes(payload), wbits=DecompressingReader.GZIP))
+            return NBT.iter_events(InputStream(compression.decompress(scheme, payload)))
+
+    def query(self, path: Union[str, NBTPath]) -> dict[int, list]:
+        '''Run an NBT path query against every chunk stored in the region file.
+
+        The chunks are scanned as raw NBT, no `Chunk` objects are built. Returns the matches by chunk index.'''
+        if not isinstance(path, NBTPath):
+            path = NBT.compile_path(path)
+        results = {}
+        for index, (offset, size) in enumerate(self.chunk_locations):
+            if offset != 0 and size != 0:
+                with self.__chunk_payload(index) as (scheme, payload):
+                    results[index] = path.search(compression.decompress(scheme, payload))
+        return results
+
+    @contextmanager
+    def __chunk_payload(self, index: int):
+        '''Yield a chunk's compression scheme and compressed payload, read from its external file if it has one.'''
+        with self.__chunk_data(index) as data:
+            scheme = data[4]
+            if scheme & compression.EXTERNAL:
+                yield scheme & ~compression.EXTERNAL, self.__external_path(index).read_bytes()
+            else:
+                with data[5:] as payload:
+                    yield scheme, payload
+
+    def __external_path(self, index: int) -> Path:
+        region = self.region_coordinate
+        x = region.x * Sizes.REGION_WIDTH + index % Sizes.REGION_WIDTH
+        z = region.z * Sizes.REGION_WIDTH + index // Sizes.REGION_WIDTH
+        return Path(self.file_path).parent / f'c.{x}.{z}.mcc'
 
-        for index, chunk in self.chunks.items():
-            self.timestamps[index] = int(time())
+    @property
+    def region_coordinate(self) -> RegionCoordinate:
+        return Region.coordinate_from_file_name(self.file_path)
 
-            chunk_data: bytes = chunk.package_and_compress()
+    @staticmethod
+    def coordinate_from_file_name(path: Union[str, Path]) -> RegionCoordinate:
+        '''Coordinate of a region, taken from its r.<x>.<z>.mca file name.'''
+        match = re.fullmatch(r'r\.(-?\d+)\.(-?\d+)\.mc[ar]', Path(path).name)
+        if match is None:
+            raise ValueError(f'Cannot tell the region coordinate from the file name "{path}"')
+        return RegionCoordinate(int(match.group(1)), int(match.group(2)))
+
+    def __chunk_data(self, index: int) -> memoryview:
+        '''View of a chunk's length prefix, compression scheme and payload in the mapped file.
+
+        Release the view when done with it, the map cannot be recreated while views exist.'''
+        offset, sections = self.chunk_locations[index]
+        with memoryview(self.__open().map) as whole_file:
+            datalen = int.from_bytes(whole_file[offset:offset + 4], byteorder='big', signed=False)
+            return whole_file[offset:offset + 4 + datalen]
 
-            datalen = len(chunk_data)
-            block_data_len = math.ceil((datalen + 5) / 4096.0) * 4096
+    @property
+    def header(self) -> 'RegionHeader':
+        '''The header as it currently is in the file.'''
+        mapped = self.__open().map
+        return RegionHeader(mapped[0:RegionHeader.SIZE] if mapped is not None else b'')
 
-            # Constuct new data block
-            data: bytes = (datalen + 1).to_bytes(length=4, byteorder='big', signed=False)  # Total length of chunk data
-            data += (2).to_bytes(length=1, byteorder='big', signed=False)
-            data += chunk_data
-            data += (0).to_bytes(block_data_len - (datalen + 5), byteorder='big', signed=False)
+    @property
+    def chunk_locations(self) -> list[list[int]]:
+        if self.__chunk_locations is None:
+            # Byte offset and byte length of every chunk
+            self.__chunk_locations = [
+                [offset * Sizes.CHUNK_SECTOR_SIZE, count * Sizes.CHUNK_SECTOR_SIZE]
+                for offset, count in zip(self.__header.offsets, self.__header.sector_counts)
+            ]
+        return self.__chunk_locations
 
-            loc = self.__chunk_locations[index]
-            original_sector_length = loc[1]
-            data_len_diff = block_data_len - original_sector_length
-            if data_len_diff != 0 and self.debug:
-                print(f'Danger: Diff is {data_len_diff}, shifting required!')
+    @property
+    def timestamps(self) -> list[int]:
+        if self.__timestamps is None:
+            self.__timestamps = self.__header.timestamps.tolist()
+        return self.__timestamps
 
-            self.__chunk_locations[index][1] = block_data_len
+    @staticmethod
+    def morton_key(index: int) -> int:
+        '''Position of a chunk index on the Z-order curve, the bits of x and z interleaved.'''
+        x, z = index % Sizes.REGION_WIDTH, index // Sizes.REGION_WIDTH
+        key = 0
+        for bit in range(Sizes.REGION_WIDTH.bit_length() - 1):
+            key |= ((x >> bit) & 1) << (2 * bit) | ((z >> bit) & 1) << (2 * bit + 1)
+        return key
 
-            if loc[0] == 0 or loc[1] == 0:
-                print('Chunk not generated', chunk)
-                sys.exit(0)
+    @staticmethod
+    def iterate_in_groups(container, group_size, start, end):
+        return (container[i: (i + group_size)] for i in range(start, end, group_size))
 
-            # Adjust sectors after this one that need their locations recalculated
-            for i, other_loc in enumerate(self.__chunk_locations):
-                if other_loc[0] > loc[0]:
-                    self.__chunk_locations[i][0] = other_loc[0] + data_len_diff
 
-            header_length = 2 * 4096
-            rest_of_the_data[(loc[0] - header_length):(loc[0] + original_sector_length - header_length)] = data
-            logging.debug(f'Saving {chunk} with', {'loc': loc, 'new_len': datalen, 'old_len': chunk.orig_size, 'sector_len': block_data_len})
+class RegionHeader:
+    '''The 8KiB region header: sector offsets, sector counts and timestamps of all 1024 chunks.
 
-        # rewrite entire file with new chunks and locations recorded
-        self.file.seek(0)
-        self.__write_header(self.file)
+    The tables are split with byte slicing and read as big endian `array`s, there is no per entry Python work.
+    Entries are indexed by `x + z * 32` with region relative chunk coordinates.'''
+    SIZE = 8 * 1024
+    ENTRIES = Sizes.REGION_WIDTH * Sizes.REGION_WIDTH
 
-        self.file.write(rest_of_the_data)
+    # Maps every non zero byte to 1
+    _PRESENT = bytes([0] + [1] * 255)
 
-        required_padding = (math.ceil(self.file.tell() / 4096.0) * 4096) - self.file.tell()
+    def __init__(self, data):
+        data = bytes(data)
+        data += bytes(RegionHeader.SIZE - len(data))  # An empty file has no chunks
+        locations = data[:RegionHeader.SIZE // 2]
 
-        self.file.write((0).to_bytes(required_padding, byteorder='big', signed=False))
+        # Each location is a 3 byte sector offset followed by a 1 byte sector count.
+        # Moving the offset bytes one to the right turns them into big endian 4 byte integers.
+        offsets = bytearray(len(locations))
+        for i in range(3):
+            offsets[i + 1::4] = locations[i::4]
+        self.offsets = RegionHeader.__uint32_array(offsets)
+        self.sector_counts = array.array('B', locations[3::4])
+        self.timestamps = RegionHeader.__uint32_array(data[RegionHeader.SIZE // 2:])
+        self.presence = self.sector_counts.tobytes().translate(RegionHeader._PRESENT)
 
-        self._is_dirty = False
+    @staticmethod
+    def from_file(path: Union[str, Path]) -> 'RegionHeader':
+        '''Read only the header of a region file.'''
+        with open(path, mode='rb') as f:
+            return RegionHeader(f.read(RegionHeader.SIZE))
 
-    def __write_header(self, file: BinaryIO):
-        for c_loc in self.__chunk_locations:
-            file.write(int(c_loc[0] / 4096).to_bytes(3, byteorder='big', signed=False))
-            file.write(int(c_loc[1] / 4096).to_bytes(1, byteorder='big', signed=False))
+    @staticmethod
+    def __uint32_array(data) -> array.array:
+        values = array.array('I', data)
+        if sys.byteorder == 'little':
+            values.byteswap()
+        return values
 
-        for ts in self.timestamps:
-            file.write(ts.to_bytes(4, byteorder='big', signed=False))
+    def has_chunk(self, x: int, z: int) -> bool:
+        return self.presence[(x % Sizes.REGION_WIDTH) + (z % Sizes.REGION_WIDTH) * Sizes.REGION_WIDTH] == 1
 
-    def get_chunk(self, coord: ChunkCoordinate):
-        chunk_index = Chunk.to_region_chunk_index(coord)
-        print(f'Loading {coord.x}x {coord.z}z from {self.file_path}')
-        if not chunk_index in self.chunks:
-            self.__ensure_file_open()
-            offset, sections = self.chunk_locations[chunk_index]
-            chunk = Chunk.from_file(file=self.file, offset=offset, sections=sections, parent_region=self)
-            self.chunks[chunk_index] = chunk
-            return chunk
-        else:
-            return self.chunks[chunk_index]
+    @property
+    def presence_rows(self) -> list[bytes]:
+        '''The presence bitmap as 32 rows of 32 bytes, one row per z.'''
+        return [self.presence[z * Sizes.REGION_WIDTH:(z + 1) * Sizes.REGION_WIDTH] for z in range(Sizes.REGION_WIDTH)]
 
-    def __read_region_after_header(self):
-        self.__ensure_file_open()
-        self.file.seek((4 + 4) * 1024)
-        return bytearray(self.file.read())
+    @property
+    def chunk_indexes(self) -> list[int]:
+        '''Indexes of the chunks stored in the region, in index order.'''
+        return [i for i, present in enumerate(self.presence) if present]
 
     @property
-    def chunk_locations(self) -> list[list[int]]:
-        if self.__chunk_locations is None:
-            # Interpret header chunk
-            self.__chunk_locations = [
-                # Nested list containing 2 elements, one taking 3 bytes, one with 1 byte
-                [
-                    int.from_bytes(offset, byteorder='big', signed=False) * Sizes.CHUNK_SECTOR_SIZE,
-                    size * Sizes.CHUNK_SECTOR_SIZE
-                ]
-                for (*offset, size) in Region.iterate_in_groups(
-                    self.__chunk_location_data, group_size=4, start=0, end=4 * 1024
-                )
-            ]
-        return self.__chunk_locations
+    def chunk_count(self) -> int:
+        return self.presence.count(1)
+
+
+class SectorMap:
+    '''Tracks which 4KiB sectors of a region file are in use, one byte per sector.'''
+    FREE = 0
+    USED = 1
+
+    def __init__(self, sector_total: int):
+        self.sectors = bytearray(sector_total)
+
+    def mark(self, start: int, count: int):
+        self.__set(start, count, SectorMap.USED)
+
+    def free(self, start: int, count: int):
+        self.__set(start, count, SectorMap.FREE)
+
+    def allocate(self, count: int) -> int:
+        '''First sector of the first free run of `count` sectors, past the end of the file if no gap is big enough.'''
+        start = self.sectors.find(bytes(count))
+        if start == -1:
+            # A free run at the end of the file can be extended
+            start = len(self.sectors.rstrip(bytes([SectorMap.FREE])))
+        return start
 
     @property
-    def timestamps(self) -> list[list[int]]:
-        if self.__timestamps is None:
-            # Interpret header chunk
-            self.__timestamps = [
-                int.from_bytes(t, byteorder='big', signed=False)
-                for t in Region.iterate_in_groups(
-                    self.__timestamps_data, group_size=4, start=4 * 1024, end=8 * 1024
-                )
-            ]
-        return self.__timestamps
+    def free_sectors(self) -> int:
+        return self.sectors.count(SectorMap.FREE)
 
-    @staticmethod
-    def iterate_in_groups(container, group_size, start, end):
-        return (container[i: (i + group_size)] for i in range(start, end, group_size))
+    @property
+    def end(self) -> int:
+        '''First sector past the end of the file.'''
+        return len(self.sectors)
+
+    def __set(self, start: int, count: int, value: int):
+        if start + count > len(self.sectors):
+            self.sectors += bytes(start + count - len(self.sectors))
+        self.sectors[start:start + count] = bytes([value]) * count
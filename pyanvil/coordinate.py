@@ -10,6 +10,9 @@ class Coordinate(ABC):
     def __hash__(self) -> int:
         return hash((self.x, self.z))
 
+    def __eq__(self, other) -> bool:
+        return type(self) is type(other) and (self.x, self.z) == (other.x, other.z)
+
     @abstractmethod
     def to_absolute_coordinate(self) -> 'AbsoluteCoordinate':
         pass
@@ -31,6 +34,9 @@ class AbsoluteCoordinate(Coordinate):
     def __hash__(self) -> int:
         return hash((self.x, self.y, self.z))
 
+    def __eq__(self, other) -> bool:
+        return type(self) is type(other) and (self.x, self.y, self.z) == (other.x, other.y, other.z)
+
     def to_absolute_coordinate(self) -> 'AbsoluteCoordinate':
         return self
 
@@ -1,24 +1,311 @@
+import array
+import io
+import struct
+import sys
+import zlib
+
+from .utility import mutf8
+
+_U8 = struct.Struct('>B')
+_I8 = struct.Struct('>b')
+_U16 = struct.Struct('>H')
+_I16 = struct.Struct('>h')
+_I32 = struct.Struct('>i')
+_I64 = struct.Struct('>q')
+_F32 = struct.Struct('>f')
+_F64 = struct.Struct('>d')
+
+# Arrays are stored big-endian, array.array uses the native order
+_SWAP_ARRAYS = sys.byteorder == 'little'
+
+
 class InputStream:
+    '''Reads big-endian NBT primitives from a memoryview without copying the underlying buffer.'''
+
     def __init__(self, data):
         self.pos = 0
-        self.buffer = data
+        self.buffer = memoryview(data).cast('B')
 
     def read(self, num):
         rtn = self.buffer[self.pos:self.pos + num]
         self.pos += num
         return rtn
 
+    def skip(self, num):
+        self.pos += num
+
     def peek(self):
         return self.buffer[self.pos]
 
+    def read_u8(self):
+        value, = _U8.unpack_from(self.buffer, self.pos)
+        self.pos += 1
+        return value
+
+    def read_i8(self):
+        value, = _I8.unpack_from(self.buffer, self.pos)
+        self.pos += 1
+        return value
+
+    def read_u16(self):
+        value, = _U16.unpack_from(self.buffer, self.pos)
+        self.pos += 2
+        return value
+
+    def read_i16(self):
+        value, = _I16.unpack_from(self.buffer, self.pos)
+        self.pos += 2
+        return value
+
+    def read_i32(self):
+        value, = _I32.unpack_from(self.buffer, self.pos)
+        self.pos += 4
+        return value
+
+    def read_i64(self):
+        value, = _I64.unpack_from(self.buffer, self.pos)
+        self.pos += 8
+        return value
+
+    def read_f32(self):
+        value, = _F32.unpack_from(self.buffer, self.pos)
+        self.pos += 4
+        return value
+
+    def read_f64(self):
+        value, = _F64.unpack_from(self.buffer, self.pos)
+        self.pos += 8
+        return value
+
+    def read_string(self):
+        '''Read a Modified UTF-8 string prefixed with its unsigned 16 bit byte length.'''
+        length = self.read_u16()
+        start = self.pos
+        self.pos += length
+        return mutf8.decode(self.buffer[start:self.pos])
+
+    def read_array(self, dtype, count):
+        '''Read `count` big-endian values of the `array` typecode `dtype` into a native `array.array`.'''
+        values = array.array(dtype)
+        end = self.pos + values.itemsize * count
+        values.frombytes(self.buffer[self.pos:end])
+        if _SWAP_ARRAYS and values.itemsize > 1:
+            values.byteswap()
+        self.pos = end
+        return values
+
+    # Typed readers keyed by the struct format used by the NBT tag classes
+    READERS = {
+        '>b': read_i8,
+        '>h': read_i16,
+        '>i': read_i32,
+        '>q': read_i64,
+        '>f': read_f32,
+        '>d': read_f64,
+    }
+
 
 class OutputStream:
+    '''Appends big-endian NBT primitives to a growable bytearray.'''
+
     def __init__(self):
-        self.buffer = bytes([])
+        self.buffer = bytearray()
 
     def write(self, data):
         self.buffer += data
         return self
 
+    def write_u8(self, value):
+        self.buffer += _U8.pack(value)
+        return self
+
+    def write_i8(self, value):
+        self.buffer += _I8.pack(value)
+        return self
+
+    def write_u16(self, value):
+        self.buffer += _U16.pack(value)
+        return self
+
+    def write_i16(self, value):
+        self.buffer += _I16.pack(value)
+        return self
+
+    def write_i32(self, value):
+        self.buffer += _I32.pack(value)
+        return self
+
+    def write_i64(self, value):
+        self.buffer += _I64.pack(value)
+        return self
+
+    def write_f32(self, value):
+        self.buffer += _F32.pack(value)
+        return self
+
+    def write_f64(self, value):
+        self.buffer += _F64.pack(value)
+        return self
+
+    def write_string(self, string):
+        '''Write a Modified UTF-8 string prefixed with its unsigned 16 bit byte length.'''
+        data = mutf8.encode(string)
+        self.buffer += _U16.pack(len(data))
+        self.buffer += data
+        return self
+
+    def write_array(self, values):
+        '''Write a native `array.array` as big-endian values.'''
+        if _SWAP_ARRAYS and values.itemsize > 1:
+            values = array.array(values.typecode, values)
+            values.byteswap()
+        self.buffer += values
+        return self
+
+    # Typed writers keyed by the struct format used by the NBT tag classes
+    WRITERS = {
+        '>b': write_i8,
+        '>h': write_i16,
+        '>i': write_i32,
+        '>q': write_i64,
+        '>f': write_f32,
+        '>d': write_f64,
+    }
+
     def get_data(self):
-        return self.buffer
+        return bytes(self.buffer)
+
+    def getbuffer(self):
+        '''Return a view of the written data without copying it.
+
+        The stream cannot grow while the view is alive, release it before writing again.'''
+        return memoryview(self.buffer)
+
+
+class FileInputStream:
+    '''Reads big-endian NBT primitives incrementally from a binary file-like object.
+
+    Only a small window of the file is held in memory at a time.'''
+
+    def __init__(self, fileobj, buffer_size=64 * 1024):
+        self.file = fileobj
+        self.buffer_size = buffer_size
+        self.buffer = b''
+        self.offset = 0  # position in the current window
+        self.pos = 0  # bytes consumed from the file
+
+    def __fill(self, num):
+        available = len(self.buffer) - self.offset
+        if available >= num:
+            return
+        parts = [self.buffer[self.offset:]]
+        while available < num:
+            data = self.file.read(max(self.buffer_size, num - available))
+            if not data:
+                raise EOFError('Unexpected end of NBT data')
+            parts.append(data)
+            available += len(data)
+        self.buffer = b''.join(parts)
+        self.offset = 0
+
+    def __unpack(self, fmt, width):
+        self.__fill(width)
+        value, = fmt.unpack_from(self.buffer, self.offset)
+        self.offset += width
+        self.pos += width
+        return value
+
+    def read(self, num):
+        self.__fill(num)
+        rtn = self.buffer[self.offset:self.offset + num]
+        self.offset += num
+        self.pos += num
+        return rtn
+
+    def skip(self, num):
+        self.pos += num
+        available = len(self.buffer) - self.offset
+        if num <= available:
+            self.offset += num
+            return
+        # Discard the window and read past the rest without keeping it
+        num -= available
+        self.buffer = b''
+        self.offset = 0
+        while num > 0:
+            data = self.file.read(min(num, self.buffer_size))
+            if not data:
+                raise EOFError('Unexpected end of NBT data')
+            num -= len(data)
+
+    def peek(self):
+        self.__fill(1)
+        return self.buffer[self.offset]
+
+    def read_u8(self):
+        return self.__unpack(_U8, 1)
+
+    def read_i8(self):
+        return self.__unpack(_I8, 1)
+
+    def read_u16(self):
+        return self.__unpack(_U16, 2)
+
+    def read_i16(self):
+        return self.__unpack(_I16, 2)
+
+    def read_i32(self):
+        return self.__unpack(_I32, 4)
+
+    def read_i64(self):
+        return self.__unpack(_I64, 8)
+
+    def read_f32(self):
+        return self.__unpack(_F32, 4)
+
+    def read_f64(self):
+        return self.__unpack(_F64, 8)
+
+    def read_string(self):
+        return mutf8.decode(self.read(self.read_u16()))
+
+    def read_array(self, dtype, count):
+        values = array.array(dtype)
+        values.frombytes(self.read(values.itemsize * count))
+        if _SWAP_ARRAYS and values.itemsize > 1:
+            values.byteswap()
+        return values
+
+    READERS = {
+        '>b': read_i8,
+        '>h': read_i16,
+        '>i': read_i32,
+        '>q': read_i64,
+        '>f': read_f32,
+        '>d': read_f64,
+    }
+
+
+class DecompressingReader:
+    '''File-like object that inflates zlib or gzip data from `source` as it is read.
+
+    `source` may be a binary file-like object or a bytes-like object.'''
+
+    ZLIB = zlib.MAX_WBITS
+    GZIP = zlib.MAX_WBITS | 16
+
+    def __init__(self, source, wbits=ZLIB, chunk_size=64 * 1024):
+        if not hasattr(source, 'read'):
+            source = io.BytesIO(source)
+        self.source = source
+        self.chunk_size = chunk_size
+        self.__decompressor = zlib.decompressobj(wbits)
+
+    def read(self, size=-1):
+        out = bytearray()
+        while (size < 0 or len(out) < size) and not self.__decompressor.eof:
+            data = self.__decompressor.unconsumed_tail or self.source.read(self.chunk_size)
+            if not data:
+                break
+            out += self.__decompressor.decompress(data, 0 if size < 0 else size - len(out))
+        return bytes(out)
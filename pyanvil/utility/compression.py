@@ -0,0 +1,190 @@
+'''Chunk compression schemes, keyed by the scheme byte stored in front of every chunk payload.
+
+1 gzip, 2 zlib, 3 uncompressed and 4 LZ4 (framed like Java's lz4 `LZ4BlockOutputStream`, needs the
+optional `lz4` package for compressed blocks, block checksums use the `xxhash` package when it is installed). A scheme byte with `EXTERNAL` set means the payload
+did not fit in the region file and is stored in a `c.<x>.<z>.mcc` file next to it.'''
+import array
+import sys
+import zlib
+from typing import Callable, NamedTuple, Union
+
+try:
+    import lz4.block as lz4_block
+except ImportError:
+    lz4_block = None
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+GZIP = 1
+ZLIB = 2
+NONE = 3
+LZ4 = 4
+
+EXTERNAL = 0x80
+
+DEFAULT_LEVEL = -1
+
+
+class Codec(NamedTuple):
+    scheme: int
+    name: str
+    compress: Callable  # (data, level) -> bytes
+    decompress: Callable  # (data) -> bytes
+
+
+_codecs: dict[int, Codec] = {}
+
+
+def register_codec(codec: Codec):
+    _codecs[codec.scheme] = codec
+
+
+def get_codec(key: Union[int, str]) -> Codec:
+    '''Look a codec up by scheme byte or name, the external flag is ignored.'''
+    if isinstance(key, str):
+        for codec in _codecs.values():
+            if codec.name == key:
+                return codec
+    elif key & ~EXTERNAL in _codecs:
+        return _codecs[key & ~EXTERNAL]
+    raise ValueError(f'Unknown chunk compression scheme {key!r}')
+
+
+def compress(key: Union[int, str], data, level: int = DEFAULT_LEVEL) -> bytes:
+    return get_codec(key).compress(data, level)
+
+
+def decompress(key: Union[int, str], data) -> bytes:
+    return get_codec(key).decompress(data)
+
+
+def _deflate(wbits):
+    def compress(data, level):
+        compressor = zlib.compressobj(level, zlib.DEFLATED, wbits)
+        return compressor.compress(data) + compressor.flush()
+
+    def decompress(data):
+        return zlib.decompress(data, wbits)
+    return compress, decompress
+
+
+# LZ4 block framing: magic, token (method | level), compressed length, decompressed length and
+# checksum (all little endian), then the block. The stream ends with an empty raw block.
+_LZ4_MAGIC = b'LZ4Block'
+_LZ4_HEADER_SIZE = len(_LZ4_MAGIC) + 13
+_LZ4_RAW = 0x10
+_LZ4_COMPRESSED = 0x20
+_LZ4_BLOCK_SIZE = 64 * 1024
+_LZ4_LEVEL = 6  # log2(block size) - 10
+_LZ4_SEED = 0x9747b28c
+
+_P1, _P2, _P3, _P4, _P5 = 2654435761, 2246822519, 3266489917, 668265263, 374761393
+_MASK = 0xFFFFFFFF
+
+
+def _rotl(x, r):
+    return ((x << r) | (x >> (32 - r))) & _MASK
+
+
+def xxh32(data, seed: int = 0) -> int:
+    '''32 bit xxHash, the checksum used by the LZ4 block framing.'''
+    if xxhash is not None:
+        return xxhash.xxh32_intdigest(data, seed)
+    return _xxh32(data, seed)
+
+
+def _xxh32(data, seed: int = 0) -> int:
+    # Pure Python fallback, far slower than the xxhash package
+    data = bytes(data)
+    length = len(data)
+    words = array.array('I', data[:length - length % 4])
+    if sys.byteorder == 'big':
+        words.byteswap()
+    i = 0
+    if length >= 16:
+        v1 = (seed + _P1 + _P2) & _MASK
+        v2 = (seed + _P2) & _MASK
+        v3 = seed
+        v4 = (seed - _P1) & _MASK
+        stripes = length // 16 * 4
+        while i < stripes:
+            v1 = _rotl((v1 + words[i] * _P2) & _MASK, 13) * _P1 & _MASK
+            v2 = _rotl((v2 + words[i + 1] * _P2) & _MASK, 13) * _P1 & _MASK
+            v3 = _rotl((v3 + words[i + 2] * _P2) & _MASK, 13) * _P1 & _MASK
+            v4 = _rotl((v4 + words[i + 3] * _P2) & _MASK, 13) * _P1 & _MASK
+            i += 4
+        h = (_rotl(v1, 1) + _rotl(v2, 7) + _rotl(v3, 12) + _rotl(v4, 18)) & _MASK
+    else:
+        h = (seed + _P5) & _MASK
+    h = (h + length) & _MASK
+    while i < len(words):
+        h = _rotl((h + words[i] * _P3) & _MASK, 17) * _P4 & _MASK
+        i += 1
+    for byte in data[len(words) * 4:]:
+        h = _rotl((h + byte * _P5) & _MASK, 11) * _P1 & _MASK
+    h ^= h >> 15
+    h = h * _P2 & _MASK
+    h ^= h >> 13
+    h = h * _P3 & _MASK
+    h ^= h >> 16
+    return h
+
+
+def _lz4_block_header(method, compressed, decompressed, checksum):
+    return _LZ4_MAGIC + bytes([method | _LZ4_LEVEL]) + b''.join(
+        n.to_bytes(4, byteorder='little', signed=False) for n in (compressed, decompressed, checksum)
+    )
+
+
+def _lz4_compress(data, level):
+    if lz4_block is None:
+        raise ImportError('Writing LZ4 chunks needs the lz4 package')
+    data = memoryview(data).cast('B')
+    out = bytearray()
+    for start in range(0, len(data), _LZ4_BLOCK_SIZE):
+        block = data[start:start + _LZ4_BLOCK_SIZE]
+        packed = lz4_block.compress(block, mode='high_compression' if level > 0 else 'default',
+                                    compression=max(level, 0), store_size=False)
+        checksum = xxh32(block, _LZ4_SEED) & 0xFFFFFFF
+        if len(packed) >= len(block):
+            out += _lz4_block_header(_LZ4_RAW, len(block), len(block), checksum) + block
+        else:
+            out += _lz4_block_header(_LZ4_COMPRESSED, len(packed), len(block), checksum) + packed
+    out += _lz4_block_header(_LZ4_RAW, 0, 0, 0)
+    return bytes(out)
+
+
+def _lz4_decompress(data):
+    data = memoryview(data).cast('B')
+    out = bytearray()
+    pos = 0
+    while pos < len(data):
+        if data[pos:pos + len(_LZ4_MAGIC)] != _LZ4_MAGIC:
+            raise ValueError(f'Bad LZ4 block magic at {pos}')
+        method = data[pos + len(_LZ4_MAGIC)] & 0xF0
+        compressed, decompressed = (
+            int.from_bytes(data[pos + i:pos + i + 4], byteorder='little', signed=False)
+            for i in (len(_LZ4_MAGIC) + 1, len(_LZ4_MAGIC) + 5)
+        )
+        pos += _LZ4_HEADER_SIZE
+        if decompressed == 0:
+            break
+        block = data[pos:pos + compressed]
+        if method == _LZ4_RAW:
+            out += block
+        elif lz4_block is None:
+            raise ImportError('Reading LZ4 chunks needs the lz4 package')
+        else:
+            out += lz4_block.decompress(block, uncompressed_size=decompressed)
+        pos += compressed
+    return bytes(out)
+
+
+register_codec(Codec(GZIP, 'gzip', *_deflate(zlib.MAX_WBITS | 16)))
+register_codec(Codec(ZLIB, 'zlib', *_deflate(zlib.MAX_WBITS)))
+# Copy the data, a view of a mapped region file must not outlive the read
+register_codec(Codec(NONE, 'none', lambda data, level: bytes(data), bytes))
+register_codec(Codec(LZ4, 'lz4', _lz4_compress, _lz4_decompress))
@@ -0,0 +1,165 @@
+'''A bounded pool of open, memory mapped region files shared by `Region` instances.'''
+import mmap
+import threading
+from collections import OrderedDict
+from io import FileIO
+from pathlib import Path
+from typing import Union
+
+
+class PooledFile:
+    '''An open region file and a read-only map of it.
+
+    Read-only entries only keep the map, the map holds its own descriptor. Writable entries also keep the file.'''
+
+    __slots__ = ('path', 'writable', 'file', 'map')
+
+    def __init__(self, path: Path, writable: bool):
+        self.path = path
+        self.writable = writable
+        self.file: FileIO = open(path, mode='r+b' if writable else 'rb')
+        self.map: mmap.mmap = None
+        self.remap()
+        if not writable:
+            self.file.close()
+            self.file = None
+
+    @property
+    def descriptors(self) -> int:
+        return (self.file is not None) + (self.map is not None)
+
+    def remap(self):
+        '''Map the whole file, the map has to be recreated when the file grows.'''
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        if self.file is None:
+            with open(self.path, mode='rb') as f:
+                self.__map(f)
+        else:
+            self.__map(self.file)
+
+    def __map(self, file):
+        # An empty file cannot be mapped, there is nothing to read from it yet
+        if Path(self.path).stat().st_size > 0:
+            self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def close(self):
+        '''Raises BufferError if views of the map are still in use.'''
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class RegionFilePool:
+    '''Keeps at most `max_descriptors` file descriptors open, closing the least recently used files first.
+
+    Files are opened read-only until a region asks for write access. Regions `acquire` their path when they are
+    created and `release` it when they are closed, a file stays open until its last user released it or it is
+    evicted. Evicted files are reopened by the next `get`.'''
+
+    def __init__(self, max_descriptors: int = 256):
+        self.max_descriptors = max_descriptors
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.__files: OrderedDict[Path, PooledFile] = OrderedDict()
+        self.__users: dict[Path, int] = {}
+        self.__lock = threading.RLock()
+
+    def get(self, path: Union[str, Path], write: bool = False) -> PooledFile:
+        path = Path(path)
+        with self.__lock:
+            pooled = self.__files.get(path)
+            if pooled is not None and (pooled.writable or not write):
+                self.hits += 1
+                self.__files.move_to_end(path)
+                return pooled
+            self.misses += 1
+            if pooled is not None:
+                # Reopen for writing
+                self.__close(path)
+            pooled = PooledFile(path, writable=write)
+            self.__files[path] = pooled
+            self.__evict()
+            return pooled
+
+    def acquire(self, path: Union[str, Path]):
+        '''Register a user of the file, it is kept open until every user released it.'''
+        path = Path(path)
+        with self.__lock:
+            self.__users[path] = self.__users.get(path, 0) + 1
+
+    def release(self, path: Union[str, Path]):
+        '''Give up one use of the file, the last user closes it if it is open.
+
+        A file whose map is still viewed stays open, it is closed when it is evicted.'''
+        path = Path(path)
+        with self.__lock:
+            users = self.__users.pop(path, 0) - 1
+            if users > 0:
+                self.__users[path] = users
+                return
+            try:
+                self.__close(path)
+            except BufferError:
+                pass
+
+    def discard(self, path: Union[str, Path]):
+        '''Close the file whoever uses it, for example because it is about to be replaced. Raises BufferError if
+        views of the map are still in use.'''
+        with self.__lock:
+            self.__close(Path(path))
+
+    def close_all(self):
+        with self.__lock:
+            for path in list(self.__files):
+                self.__close(path)
+
+    @property
+    def open_descriptors(self) -> int:
+        with self.__lock:
+            return sum(pooled.descriptors for pooled in self.__files.values())
+
+    @property
+    def stats(self) -> dict[str, int]:
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'open_files': len(self.__files),
+            'open_descriptors': self.open_descriptors,
+        }
+
+    def __contains__(self, path: Union[str, Path]) -> bool:
+        return Path(path) in self.__files
+
+    def __close(self, path: Path):
+        pooled = self.__files.get(path)
+        if pooled is not None:
+            # The entry is only dropped once it is closed, a BufferError leaves it usable
+            pooled.close()
+            del self.__files[path]
+
+    def __evict(self):
+        descriptors = self.open_descriptors
+        # The most recently used file is the one just opened, it always stays
+        for path in list(self.__files)[:-1]:
+            if descriptors <= self.max_descriptors:
+                break
+            pooled = self.__files[path]
+            freed = pooled.descriptors
+            try:
+                pooled.close()
+            except BufferError:
+                # A view of the map is still being read, try the next one
+                continue
+            del self.__files[path]
+            descriptors -= freed
+            self.evictions += 1
+
+
+default_pool = RegionFilePool()
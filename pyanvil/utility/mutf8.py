@@ -0,0 +1,36 @@
+'''Java's Modified UTF-8, the string encoding used by NBT.
+
+It differs from UTF-8 in two ways: NUL is written as the two bytes C0 80 and characters outside
+the Basic Multilingual Plane are written as a UTF-16 surrogate pair of three bytes each.'''
+import re
+from functools import lru_cache
+
+_SUPPLEMENTARY = re.compile('[\U00010000-\U0010ffff]')
+
+# Tag names and block ids repeat constantly, keep the most recent encodings around
+ENCODE_CACHE_SIZE = 4096
+
+
+def _to_surrogate_pair(match):
+    code = ord(match.group()) - 0x10000
+    return chr(0xD800 + (code >> 10)) + chr(0xDC00 + (code & 0x3FF))
+
+
+@lru_cache(maxsize=ENCODE_CACHE_SIZE)
+def encode(string: str) -> bytes:
+    if string.isascii() and '\x00' not in string:
+        return string.encode('ascii')
+    string = _SUPPLEMENTARY.sub(_to_surrogate_pair, string)
+    return string.encode('utf-8', 'surrogatepass').replace(b'\x00', b'\xc0\x80')
+
+
+def decode(data) -> str:
+    '''Decode a bytes-like object.'''
+    try:
+        # Modified UTF-8 without NUL and supplementary characters is plain UTF-8
+        return str(data, 'utf-8')
+    except UnicodeDecodeError:
+        pass
+    text = bytes(data).replace(b'\xc0\x80', b'\x00').decode('utf-8', 'surrogatepass')
+    # Join surrogate pairs back into single characters
+    return text.encode('utf-16-le', 'surrogatepass').decode('utf-16-le')
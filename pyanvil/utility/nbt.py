@@ -1,7 +1,11 @@
 from abc import ABC, abstractmethod
-import struct
+import array
+import re
+import sys
+from collections import namedtuple
 from enum import IntEnum
-from ..stream import InputStream, OutputStream
+from ..stream import FileInputStream, InputStream, OutputStream
+from . import mutf8
 
 
 class TagType(IntEnum):
@@ -20,11 +24,46 @@ class TagType(IntEnum):
     LONG_ARRAY = 12
 
 
+_END = int(TagType.END)
+_LIST = int(TagType.LIST)
+_COMPOUND = int(TagType.COMPOUND)
+
+# Tag names repeat across every chunk, parsed names are interned so each one is stored once.
+# List elements have no name and all share this one.
+_UNNAMED = sys.intern('None')
+
+
+class _Owners:
+    '''The number of tags sharing one container after `clone()`.'''
+    __slots__ = ('count',)
+
+    def __init__(self):
+        self.count = 1
+
+
 class BaseNBTTag(ABC):
+    __slots__ = ()
+
     @abstractmethod
     def serialize(self, stream: OutputStream, include_name=True):
         pass
 
+    def _share_with(self, copy):
+        # Copy-on-write tags keep the owners of their container in `_shared`, None while they are the only one
+        if self._shared is None:
+            self._shared = _Owners()
+        self._shared.count += 1
+        copy._shared = self._shared
+
+    def _release(self) -> bool:
+        '''Stop sharing the container, True if other tags still hold it and this one has to copy it.'''
+        owners = self._shared
+        if owners is None:
+            return False
+        self._shared = None
+        owners.count -= 1
+        return owners.count > 0
+
 
 class NBT:
 
@@ -32,9 +71,7 @@ class NBT:
 
     @staticmethod
     def write_string(stream, string):
-        stream.write(len(string).to_bytes(2, byteorder='big', signed=False))
-        for c in string:
-            stream.write(ord(c).to_bytes(1, byteorder='big', signed=False))
+        stream.write_string(string)
 
     @staticmethod
     def register_parser(id, clazz):
@@ -44,21 +81,22 @@ class NBT:
     def create_simple_nbt_class(tag_id, class_tag_name, tag_width, tag_parser):
 
         class DataNBTTag(BaseNBTTag):
+            __slots__ = ('tag_name', 'tag_value')
 
             clazz_width = tag_width
             clazz_name = class_tag_name
             clazz_parser = tag_parser
+            clazz_reader = InputStream.READERS[tag_parser]
+            clazz_writer = OutputStream.WRITERS[tag_parser]
             clazz_id = tag_id
 
             @classmethod
-            def parse(cls, stream, name):
-                return cls(
-                    tag_value=struct.unpack(
-                        cls.clazz_parser,
-                        stream.read(cls.clazz_width)
-                    )[0],
-                    tag_name=name
-                )
+            def parse(cls, stream, name, lazy=False):
+                return cls(tag_value=cls.clazz_reader(stream), tag_name=name)
+
+            @classmethod
+            def skip(cls, stream):
+                stream.skip(cls.clazz_width)
 
             def __init__(self, tag_value, tag_name='None'):
                 int(tag_value)
@@ -76,10 +114,10 @@ class NBT:
 
             def serialize(self, stream, include_name=True):
                 if include_name:
-                    stream.write(type(self).clazz_id.to_bytes(1, byteorder='big', signed=False))
+                    stream.write_u8(type(self).clazz_id)
                     NBT.write_string(stream, self.tag_name)
 
-                stream.write(struct.pack(type(self).clazz_parser, self.tag_value))
+                type(self).clazz_writer(stream, self.tag_value)
 
             def clone(self):
                 return type(self)(self.tag_value, tag_name=self.tag_name)
@@ -97,14 +135,17 @@ class NBT:
     @staticmethod
     def create_string_nbt_class(tag_id):
         class DataNBTTag(BaseNBTTag):
+            __slots__ = ('tag_name', 'tag_value')
 
             clazz_id = tag_id
 
             @classmethod
-            def parse(cls, stream, name):
-                payload_length = int.from_bytes(stream.read(2), byteorder='big', signed=False)
-                payload = stream.read(payload_length).decode('utf-8')
-                return cls(payload, tag_name=name)
+            def parse(cls, stream, name, lazy=False):
+                return cls(stream.read_string(), tag_name=name)
+
+            @classmethod
+            def skip(cls, stream):
+                stream.skip(stream.read_u16())
 
             def __init__(self, tag_value, tag_name='None'):
                 self.tag_name = tag_name
@@ -121,12 +162,10 @@ class NBT:
 
             def serialize(self, stream, include_name=True):
                 if include_name:
-                    stream.write(type(self).clazz_id.to_bytes(1, byteorder='big', signed=False))
+                    stream.write_u8(type(self).clazz_id)
                     NBT.write_string(stream, self.tag_name)
 
-                stream.write(len(self.tag_value).to_bytes(2, byteorder='big', signed=False))
-                for c in self.tag_value:
-                    stream.write(ord(c).to_bytes(1, byteorder='big', signed=False))
+                stream.write_string(self.tag_value)
 
             def clone(self):
                 return type(self)(self.tag_value, tag_name=self.tag_name)
@@ -144,57 +183,84 @@ class NBT:
     @staticmethod
     def create_array_nbt_class(tag_id, tag_name, sub_type):
         class ArrayNBTTag(BaseNBTTag):
+            __slots__ = ('tag_name', 'values', '_shared')
 
             clazz_sub_type = sub_type
+            # The element struct format doubles as the array typecode ('>q' -> 'q')
+            clazz_typecode = sub_type.clazz_parser[1:]
             clazz_name = tag_name
             clazz_id = tag_id
 
             @classmethod
-            def parse(cls, stream, name):
-                payload_length = int.from_bytes(stream.read(4), byteorder='big', signed=True)
-                tag = cls(tag_name=name)
-                for i in range(payload_length):
-                    tag.add_child(cls.clazz_sub_type.parse(stream, 'None'))
-                return tag
+            def parse(cls, stream, name, lazy=False):
+                payload_length = stream.read_i32()
+                return cls(tag_name=name, values=stream.read_array(cls.clazz_typecode, payload_length))
 
-            def __init__(self, tag_name='None', children=[]):
+            @classmethod
+            def skip(cls, stream):
+                stream.skip(stream.read_i32() * cls.clazz_sub_type.clazz_width)
+
+            def __init__(self, tag_name='None', children=[], values=None):
+                '''Values are held in one native `array.array`, `children` tags are only converted on creation.'''
                 self.tag_name = tag_name
-                self.children = children[:]
+                typecode = type(self).clazz_typecode
+                if values is None:
+                    values = array.array(typecode, [c.get() for c in children])
+                elif not isinstance(values, array.array) or values.typecode != typecode:
+                    values = array.array(typecode, values)
+                self.values = values
+                self._shared = None
+
+            @property
+            def children(self):
+                '''Legacy view of the values as individual element tags, changes to it are not written back.'''
+                return [type(self).clazz_sub_type(v) for v in self.values]
 
             def add_child(self, tag):
-                self.children.append(tag)
+                if self._shared is not None:
+                    self._unshare()
+                self.values.append(tag.get())
+
+            def _unshare(self):
+                if self._release():
+                    self.values = array.array(self.values.typecode, self.values)
+
+            def __del__(self):
+                self._release()
 
             def name(self):
                 return self.tag_name
 
             def print(self, indent=''):
-                str_dat = ', '.join([str(c.get()) for c in self.children])
-                print(f'{indent}{type(self).clazz_name}: {self.tag_name} size {str(len(self.children))} = [{str_dat}]')
+                print(indent + self.__repr__())
 
             def get(self):
-                return [int(c.get()) for c in self.children]
+                # The array may be changed by the caller, stop sharing it with clones first
+                if self._shared is not None:
+                    self._unshare()
+                return self.values
 
             def serialize(self, stream, include_name=True):
                 if include_name:
-                    stream.write(type(self).clazz_id.to_bytes(1, byteorder='big', signed=False))
+                    stream.write_u8(type(self).clazz_id)
                     NBT.write_string(stream, self.tag_name)
 
-                stream.write(len(self.children).to_bytes(4, byteorder='big', signed=True))
-
-                for tag in self.children:
-                    tag.serialize(stream, include_name=False)
+                stream.write_i32(len(self.values))
+                stream.write_array(self.values)
 
             def clone(self):
-                return type(self)(tag_name=self.tag_name, children=[c.clone() for c in self.children])
+                '''Copy-on-write clone, the values are only copied if a tag changes or hands them out while the other
+                one is still alive.'''
+                copy = type(self)(tag_name=self.tag_name, values=self.values)
+                self._share_with(copy)
+                return copy
 
             def __repr__(self):
-                str_dat = ', '.join([str(c.get()) for c in self.children])
-                return f'{type(self).clazz_name}: {self.tag_name} size {str(len(self.children))} = [{str_dat}]'
+                str_dat = ', '.join([str(v) for v in self.values])
+                return f'{type(self).clazz_name}: {self.tag_name} size {str(len(self.values))} = [{str_dat}]'
 
             def __eq__(self, other):
-                return self.tag_name == other.tag_name and \
-                    len(self.children) == len(other.children) and \
-                    not any([not self.children[i] == other.children[i] for i in range(len(self.children))])
+                return self.tag_name == other.tag_name and self.values == other.values
 
         NBT.register_parser(tag_id, ArrayNBTTag)
 
@@ -203,25 +269,53 @@ class NBT:
     @staticmethod
     def create_list_nbt_class(tag_id):
         class ListNBTTag(BaseNBTTag):
+            __slots__ = ('tag_name', 'sub_type_id', '_children', '_shared')
 
             clazz_id = tag_id
 
             @classmethod
-            def parse(cls, stream, name):
-                sub_type = int.from_bytes(stream.read(1), byteorder='big', signed=False)
-                payload_length = int.from_bytes(stream.read(4), byteorder='big', signed=True)
-                tag = cls(sub_type, tag_name=name)
-                for i in range(payload_length):
-                    tag.add_child(NBT._parsers[sub_type].parse(stream, 'None'))
-                return tag
+            def parse(cls, stream, name, lazy=False):
+                return NBT.parse_payload(stream, cls.clazz_id, name, lazy=lazy)
+
+            @classmethod
+            def skip(cls, stream):
+                NBT.skip_payload(stream, cls.clazz_id)
+
+            @staticmethod
+            def skip_elements(stream, sub_type, count):
+                if count <= 0:
+                    return
+                sub_parser = NBT._parsers[sub_type]
+                if hasattr(sub_parser, 'clazz_width'):
+                    stream.skip(count * sub_parser.clazz_width)
+                else:
+                    for i in range(count):
+                        NBT.skip_payload(stream, sub_type)
 
             def __init__(self, sub_type_id, tag_name='None', children=[]):
                 self.tag_name = tag_name
                 self.sub_type_id = sub_type_id
-                self.children = children[:]
+                self._children = children[:]
+                self._shared = None
+
+            @property
+            def children(self):
+                '''The element tags. They can be changed through the list, so it stops sharing them with clones first.'''
+                if self._shared is not None:
+                    self._unshare()
+                return self._children
 
             def add_child(self, tag):
-                self.children.append(tag)
+                if self._shared is not None:
+                    self._unshare()
+                self._children.append(tag)
+
+            def _unshare(self):
+                if self._release():
+                    self._children = [c.clone() for c in self._children]
+
+            def __del__(self):
+                self._release()
 
             def get(self):
                 return [c.get() for c in self.children]
@@ -230,32 +324,27 @@ class NBT:
                 return self.tag_name
 
             def print(self, indent=''):
-                print(indent + 'List: ' + self.tag_name + ' size ' + str(len(self.children)))
-                for c in self.children:
+                print(indent + 'List: ' + self.tag_name + ' size ' + str(len(self._children)))
+                for c in self._children:
                     c.print(indent + '  ')
 
             def serialize(self, stream, include_name=True):
-                if include_name:
-                    stream.write(type(self).clazz_id.to_bytes(1, byteorder='big', signed=False))
-                    NBT.write_string(stream, self.tag_name)
-
-                stream.write(self.sub_type_id.to_bytes(1, byteorder='big', signed=False))
-                stream.write(len(self.children).to_bytes(4, byteorder='big', signed=True))
-
-                for tag in self.children:
-                    tag.serialize(stream, include_name=False)
+                NBT.serialize_tree(self, stream, include_name=include_name)
 
             def clone(self):
-                return type(self)(self.sub_type_id, tag_name=self.tag_name, children=[c.clone() for c in self.children])
+                '''Copy-on-write clone, the elements stay shared until a list is changed or hands them out while the other
+                one is still alive.'''
+                copy = type(self)(self.sub_type_id, tag_name=self.tag_name)
+                copy._children = self._children
+                self._share_with(copy)
+                return copy
 
             def __repr__(self):
-                str_dat = ', '.join([c.__repr__() for c in self.children])
-                return f'ListTag: {self.tag_name} size {str(len(self.children))} = [{str_dat}]'
+                str_dat = ', '.join([c.__repr__() for c in self._children])
+                return f'ListTag: {self.tag_name} size {str(len(self._children))} = [{str_dat}]'
 
             def __eq__(self, other):
-                return self.tag_name == other.tag_name and \
-                    len(self.children) == len(other.children) and \
-                    (len(self.children) == 0 or not any([not self.children[i] == other.children[i] for i in range(len(self.children))]))
+                return NBT.trees_equal(self, other)
 
         NBT.register_parser(tag_id, ListNBTTag)
 
@@ -264,26 +353,69 @@ class NBT:
     @staticmethod
     def create_compund_nbt_class(tag_id):
         class CompundNBTTag(BaseNBTTag):
+            __slots__ = ('tag_name', '_children', '_shared')
 
             clazz_id = tag_id
 
             @classmethod
-            def parse(cls, stream, name):
-                tag = cls(tag_name=name)
+            def parse(cls, stream, name, lazy=False):
+                return NBT.parse_payload(stream, cls.clazz_id, name, lazy=lazy)
+
+            @classmethod
+            def skip(cls, stream):
+                NBT.skip_payload(stream, cls.clazz_id)
+
+            def _index_children(self, stream):
+                '''Record where each child lives without parsing it, it is parsed on first access.'''
                 while stream.peek() != 0:  # end tag
-                    tag.add_child(NBT.parse_nbt(stream))
-                stream.read(1)  # get rid of the end tag
-                return tag
+                    start = stream.pos
+                    child_type = stream.read_u8()
+                    child_name = sys.intern(stream.read_string())
+                    NBT.skip_payload(stream, child_type)
+                    self._children[child_name] = _TagSpan(child_name, stream.buffer, start, stream.pos)
+                stream.skip(1)  # get rid of the end tag
 
             def __init__(self, tag_name='None', children=[]):
                 self.tag_name = tag_name
-                self.children = {c.tag_name: c for c in children[:]}
+                self._children = {c.tag_name: c for c in children[:]}
+                self._shared = None
+
+            @property
+            def children(self):
+                '''All children by name, parsing any that were left unparsed by a lazy parse.
+
+                They can be changed through the mapping, so it stops sharing them with clones first.'''
+                if self._shared is not None:
+                    self._unshare()
+                return self._materialized()
+
+            def _materialized(self):
+                # Read-only access to all children, which may still be shared with clones
+                for name, child in self._children.items():
+                    if type(child) is _TagSpan:
+                        self._children[name] = child.materialize()
+                return self._children
+
+            def _unshare(self):
+                # Only this level is copied, the children become copy-on-write clones themselves
+                if self._release():
+                    self._children = {name: c.clone() for name, c in self._children.items()}
+
+            def __del__(self):
+                self._release()
 
             def add_child(self, tag):
-                self.children[tag.tag_name] = tag
+                if self._shared is not None:
+                    self._unshare()
+                self._children[tag.tag_name] = tag
 
             def get(self, name):
-                return self.children[name]
+                if self._shared is not None:
+                    self._unshare()
+                child = self._children[name]
+                if type(child) is _TagSpan:
+                    child = self._children[name] = child.materialize()
+                return child
 
             # def get(self):
             #     return { n: v.get() for n, v in self.children }
@@ -292,55 +424,461 @@ class NBT:
                 return self.tag_name
 
             def has(self, name):
-                return name in self.children
+                return name in self._children
 
             def to_dict(self):
                 nd = {}
-                for p in self.children:
-                    nd[p] = self.children[p].get()
+                for p, child in self._materialized().items():
+                    nd[p] = child.get()
                 return nd
 
             def print(self, indent=''):
-                print(indent + 'Compound: ' + self.tag_name + ' size ' + str(len(self.children)))
-                for c in self.children:
-                    self.children[c].print(indent + '  ')
+                children = self._materialized()
+                print(indent + 'Compound: ' + self.tag_name + ' size ' + str(len(children)))
+                for c in children:
+                    children[c].print(indent + '  ')
 
             def serialize(self, stream, include_name=True):
-                if include_name:
-                    stream.write(type(self).clazz_id.to_bytes(1, byteorder='big', signed=False))
-                    NBT.write_string(stream, self.tag_name)
-
-                for tag_name in self.children:
-                    self.children[tag_name].serialize(stream, include_name=True)
-
-                stream.write((0).to_bytes(1, byteorder='big', signed=False))
+                NBT.serialize_tree(self, stream, include_name=include_name)
 
             def clone(self):
-                return type(self)(tag_name=self.tag_name, children=[v.clone() for k, v in self.children.items()])
+                '''Copy-on-write clone, the children stay shared until a compound is changed or hands them out while the
+                other one is still alive.'''
+                copy = type(self)(tag_name=self.tag_name)
+                copy._children = self._children
+                self._share_with(copy)
+                return copy
 
             def __repr__(self):
-                str_dat = ', '.join([c.__repr__() for name, c in self.children.items()])
-                return f'CompundTag: {self.tag_name} size {str(len(self.children))} = {{{str_dat}}}]'
+                children = self._materialized()
+                str_dat = ', '.join([c.__repr__() for name, c in children.items()])
+                return f'CompundTag: {self.tag_name} size {str(len(children))} = {{{str_dat}}}]'
 
             def __eq__(self, other):
-                passed = True
-                for name, v in self.children.items():
-                    if name not in other.children:
-                        passed = False
-                    elif other.children[name] != v:
-                        passed = False
-                return self.tag_name == other.tag_name and \
-                    len(self.children) == len(other.children) and \
-                    passed
+                return NBT.trees_equal(self, other)
 
         NBT.register_parser(tag_id, CompundNBTTag)
 
         return CompundNBTTag
 
     @staticmethod
-    def parse_nbt(stream: InputStream):
-        tag_type = int.from_bytes(stream.read(1), byteorder='big', signed=False)
-        tag_name_length = int.from_bytes(stream.read(2), byteorder='big', signed=False)
-        tag_name = stream.read(tag_name_length).decode('utf-8')
+    def parse_nbt(stream: InputStream, lazy=False):
+        '''Parse the named tag at the current stream position.
+
+        With `lazy` compound children are only indexed by their byte span and parsed when first
+        accessed, untouched children are written back verbatim when serialized.'''
+        tag_type = stream.read_u8()
+        tag_name = sys.intern(stream.read_string())
+
+        return NBT._parsers[tag_type].parse(stream, tag_name, lazy=lazy)
+
+    # The functions below walk nested compounds and lists with an explicit stack instead of
+    # recursion, so arbitrarily deep data cannot overflow the interpreter stack.
+
+    @staticmethod
+    def parse_payload(stream, tag_type, name, lazy=False):
+        '''Parse the payload of a tag whose type and name have already been read.'''
+        parsers = NBT._parsers
+        compound_class = parsers[_COMPOUND]
+        list_class = parsers[_LIST]
+        read_u8 = stream.read_u8
+        read_i32 = stream.read_i32
+        read_string = stream.read_string
+        intern = sys.intern
+
+        # Frames are [parent, None] for compounds and [parent, elements left, element name] for lists,
+        # the root is read as the only element of a placeholder list.
+        root = _RootHolder(tag_type)
+        stack = [[root, 1, name]]
+        while stack:
+            frame = stack[-1]
+            parent = frame[0]
+            if frame[1] is None:
+                tag_type = read_u8()
+                if tag_type == _END:
+                    stack.pop()
+                    continue
+                name = intern(read_string())
+            elif frame[1] > 0:
+                frame[1] -= 1
+                tag_type = parent.sub_type_id
+                name = frame[2]
+            else:
+                stack.pop()
+                continue
+
+            if tag_type == _COMPOUND:
+                tag = compound_class(tag_name=name)
+                if lazy:
+                    tag._index_children(stream)
+                else:
+                    stack.append([tag, None])
+            elif tag_type == _LIST:
+                tag = list_class(read_u8(), tag_name=name)
+                stack.append([tag, read_i32(), _UNNAMED])
+            else:
+                tag = parsers[tag_type].parse(stream, name)
+
+            if frame[1] is None:
+                parent._children[name] = tag
+            else:
+                parent._children.append(tag)
+        return root._children[0]
+
+    @staticmethod
+    def skip_payload(stream, tag_type):
+        '''Step over the payload of a tag whose type and name have already been read.'''
+        stack = []
+        NBT._skip_open(stream, tag_type, stack)
+        while stack:
+            frame = stack[-1]
+            if frame[1] is None:  # compound
+                child_type = stream.read_u8()
+                if child_type == _END:
+                    stack.pop()
+                    continue
+                stream.skip(stream.read_u16())
+                NBT._skip_open(stream, child_type, stack)
+            elif frame[1] > 0:  # list elements left
+                frame[1] -= 1
+                NBT._skip_open(stream, frame[0], stack)
+            else:
+                stack.pop()
 
-        return NBT._parsers[tag_type].parse(stream, tag_name)
+    @staticmethod
+    def _skip_open(stream, tag_type, stack):
+        if tag_type == _COMPOUND:
+            stack.append([None, None])
+        elif tag_type == _LIST:
+            sub_type = stream.read_u8()
+            count = stream.read_i32()
+            sub_parser = NBT._parsers.get(sub_type)
+            if hasattr(sub_parser, 'clazz_width'):
+                stream.skip(max(count, 0) * sub_parser.clazz_width)
+            elif count > 0:
+                stack.append([sub_type, count])
+        else:
+            NBT._parsers[tag_type].skip(stream)
+
+    @staticmethod
+    def serialize_tree(tag, stream, include_name=True):
+        stack = []
+        NBT._write_open(tag, stream, include_name, stack)
+        while stack:
+            children, in_compound = stack[-1]
+            child = next(children, None)
+            if child is None:
+                stack.pop()
+                if in_compound:
+                    stream.write_u8(_END)
+            else:
+                NBT._write_open(child, stream, in_compound, stack)
+
+    @staticmethod
+    def _write_open(tag, stream, include_name, stack):
+        tag_id = getattr(tag, 'clazz_id', None)
+        if tag_id != _COMPOUND and tag_id != _LIST:
+            tag.serialize(stream, include_name=include_name)
+            return
+        if include_name:
+            stream.write_u8(tag_id)
+            NBT.write_string(stream, tag.tag_name)
+        if tag_id == _COMPOUND:
+            stack.append((iter(tag._children.values()), True))
+        else:
+            stream.write_u8(tag.sub_type_id)
+            stream.write_i32(len(tag._children))
+            stack.append((iter(tag._children), False))
+
+    @staticmethod
+    def clone_tree(tag):
+        '''Deep copy of a tag tree, `clone()` shares unchanged children instead.'''
+        stack = []
+        root = NBT._clone_open(tag, stack)
+        while stack:
+            children, copy = stack[-1]
+            child = next(children, None)
+            if child is None:
+                stack.pop()
+            elif copy.clazz_id == _COMPOUND:
+                copy._children[child.tag_name] = NBT._clone_open(child, stack)
+            else:
+                copy._children.append(NBT._clone_open(child, stack))
+        return root
+
+    @staticmethod
+    def _clone_open(tag, stack):
+        tag_id = getattr(tag, 'clazz_id', None)
+        if tag_id == _COMPOUND:
+            copy = type(tag)(tag_name=tag.tag_name)
+            stack.append((iter(tag._children.values()), copy))
+        elif tag_id == _LIST:
+            copy = type(tag)(tag.sub_type_id, tag_name=tag.tag_name)
+            stack.append((iter(tag._children), copy))
+        else:
+            copy = tag.clone()
+        return copy
+
+    @staticmethod
+    def trees_equal(tag, other):
+        pairs = [(tag, other)]
+        while pairs:
+            tag, other = pairs.pop()
+            if type(tag) is not type(other) or tag.tag_name != other.tag_name:
+                return False
+            if tag.clazz_id == _COMPOUND:
+                children, other_children = tag._materialized(), other._materialized()
+                if children.keys() != other_children.keys():
+                    return False
+                pairs.extend((c, other_children[n]) for n, c in children.items())
+            elif tag.clazz_id == _LIST:
+                if len(tag._children) != len(other._children):
+                    return False
+                pairs.extend(zip(tag._children, other._children))
+            elif not tag == other:
+                return False
+        return True
+
+    @staticmethod
+    def compile_path(path):
+        '''Compile a query such as `Level.Sections[*].Palette[*].Name` into an `NBTPath`.'''
+        return NBTPath(path)
+
+    @staticmethod
+    def iter_events(source):
+        '''Walk an NBT payload as a stream of `NBTEvent`s without building the tag tree.
+
+        `source` is a binary file-like object (for example a `gzip.open` file or a
+        `stream.DecompressingReader`) or an existing input stream, and is read incrementally.'''
+        return NBTEventReader(source)
+
+
+class _RootHolder:
+    '''Stands in for the list a root tag is parsed into by `NBT.parse_payload`.'''
+
+    __slots__ = ('sub_type_id', '_children')
+
+    def __init__(self, tag_type):
+        self.sub_type_id = tag_type
+        self._children = []
+
+
+class _TagSpan:
+    '''A named tag that has not been parsed yet, kept as its span in the source buffer.'''
+
+    __slots__ = ('tag_name', 'source', 'start', 'end')
+
+    def __init__(self, tag_name, source, start, end):
+        self.tag_name = tag_name
+        self.source = source
+        self.start = start
+        self.end = end
+
+    def materialize(self):
+        return NBT.parse_nbt(InputStream(self.source[self.start:self.end]), lazy=True)
+
+    def serialize(self, stream, include_name=True):
+        stream.write(self.source[self.start:self.end])
+
+    def clone(self):
+        # The source buffer is never modified, so the span can be shared
+        return self
+
+
+NBTEvent = namedtuple('NBTEvent', ['path', 'tag_type', 'name', 'value'])
+NBTEvent.__doc__ = '''A tag seen by `NBTEventReader`.
+
+Compounds and lists produce an event with a `None` value when they open and an event with the
+`TagType.END` type and the same path when they close. List elements have no name, the last entry
+of their path is their index.'''
+
+
+class NBTEventReader:
+    '''Iterator over the `NBTEvent`s of a single named root tag.'''
+
+    class _Frame:
+        def __init__(self, path, tag_type, name, sub_type=None, length=0):
+            self.path = path
+            self.tag_type = tag_type
+            self.name = name
+            self.sub_type = sub_type
+            self.length = length
+            self.index = 0
+
+    def __init__(self, source):
+        if not hasattr(source, 'read_u8'):
+            source = FileInputStream(source)
+        self.stream = source
+        self.__stack = []
+        self.__started = False
+        self.__just_opened = None
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        self.__just_opened = None
+        stream = self.stream
+        if not self.__stack:
+            if self.__started:
+                raise StopIteration
+            self.__started = True
+            tag_type = stream.read_u8()
+            return self.__open(tag_type, stream.read_string(), ())
+
+        frame = self.__stack[-1]
+        if frame.tag_type == TagType.COMPOUND:
+            tag_type = stream.read_u8()
+            if tag_type != TagType.END:
+                name = stream.read_string()
+                return self.__open(tag_type, name, frame.path + (name,))
+        elif frame.index < frame.length:
+            frame.index += 1
+            return self.__open(frame.sub_type, None, frame.path + (frame.index - 1,))
+
+        self.__stack.pop()
+        return NBTEvent(frame.path, TagType.END, frame.name, None)
+
+    def __open(self, tag_type, name, path):
+        stream = self.stream
+        if tag_type == TagType.COMPOUND:
+            frame = NBTEventReader._Frame(path, tag_type, name)
+        elif tag_type == TagType.LIST:
+            sub_type = stream.read_u8()
+            frame = NBTEventReader._Frame(path, tag_type, name, sub_type=sub_type, length=stream.read_i32())
+        else:
+            parser = NBT._parsers[tag_type]
+            if hasattr(parser, 'clazz_parser'):
+                # The tag classes read with InputStream methods, use the reader of this stream
+                value = stream.READERS[parser.clazz_parser](stream)
+            else:
+                value = parser.parse(stream, name).get()
+            return NBTEvent(path, tag_type, name, value)
+        self.__stack.append(frame)
+        self.__just_opened = frame
+        return NBTEvent(path, tag_type, name, None)
+
+    def skip(self):
+        '''Skip the contents of the compound or list that was just opened, its end event is not produced.'''
+        frame = self.__just_opened
+        if frame is None:
+            raise ValueError('skip() must directly follow the opening event of a compound or list')
+        self.__stack.pop()
+        self.__just_opened = None
+        if frame.tag_type == TagType.COMPOUND:
+            NBT._parsers[TagType.COMPOUND].skip(self.stream)
+        else:
+            NBT._parsers[TagType.LIST].skip_elements(self.stream, frame.sub_type, frame.length)
+
+
+class NBTPath:
+    '''A compiled query over an NBT tree.
+
+    A path is a dot separated list of compound child names, `*` matching every child. Each name may be
+    followed by `[n]` or `[*]` to select elements of a list or array. The root tag itself is not named.'''
+
+    _STEP = re.compile(r'\[(\*|-?\d+)\]')
+
+    def __init__(self, path):
+        self.path = path
+        # Steps are (name bytes or None) for compound children and (index or None,) for elements
+        self.steps = []
+        for part in path.split('.'):
+            name, _, rest = part.partition('[')
+            if not name:
+                raise ValueError(f'Empty name in NBT path "{path}"')
+            self.steps.append(None if name == '*' else mutf8.encode(name))
+            rest = '[' + rest if rest else ''
+            indexes = NBTPath._STEP.findall(rest)
+            if ''.join(f'[{i}]' for i in indexes) != rest:
+                raise ValueError(f'Malformed index in NBT path "{path}"')
+            self.steps.extend((None if i == '*' else int(i),) for i in indexes)
+
+    def __repr__(self):
+        return f'NBTPath({self.path!r})'
+
+    def search(self, source):
+        '''Return the values matched in `source`.
+
+        `source` is a parsed tag or a raw, uncompressed named root tag (bytes-like or an `InputStream`).
+        Raw data is scanned in place, subtrees that cannot match are skipped by their length. Matched
+        compounds and lists are returned as tags, everything else as its value.'''
+        results = []
+        if hasattr(source, 'clazz_id') or isinstance(source, _TagSpan):
+            self.__walk(source, 0, results)
+        else:
+            stream = source if isinstance(source, InputStream) else InputStream(source)
+            tag_type = stream.read_u8()
+            self.__scan(stream, tag_type, stream.read(stream.read_u16()), 0, results)
+        return results
+
+    def __scan(self, stream, tag_type, name, step, results):
+        if step == len(self.steps):
+            if tag_type == _COMPOUND or tag_type == _LIST:
+                results.append(NBT.parse_payload(stream, tag_type, mutf8.decode(name)))
+            else:
+                results.append(NBT._parsers[tag_type].parse(stream, 'None').get())
+            return
+
+        key = self.steps[step]
+        if type(key) is tuple:
+            index, = key
+            if tag_type == _LIST:
+                sub_type = stream.read_u8()
+                count = stream.read_i32()
+                for i in range(count):
+                    if index is None or index == i or index == i - count:
+                        self.__scan(stream, sub_type, b'None', step + 1, results)
+                    else:
+                        NBT.skip_payload(stream, sub_type)
+            elif hasattr(NBT._parsers[tag_type], 'clazz_sub_type'):
+                values = NBT._parsers[tag_type].parse(stream, 'None').get()
+                self.__select(values, index, step + 1, results)
+            else:
+                NBT.skip_payload(stream, tag_type)
+        elif tag_type == _COMPOUND:
+            while True:
+                child_type = stream.read_u8()
+                if child_type == _END:
+                    break
+                name = stream.read(stream.read_u16())
+                if key is None or name == key:
+                    self.__scan(stream, child_type, name, step + 1, results)
+                else:
+                    NBT.skip_payload(stream, child_type)
+        else:
+            NBT.skip_payload(stream, tag_type)
+
+    def __walk(self, tag, step, results):
+        if isinstance(tag, _TagSpan):
+            tag = tag.materialize()
+        if step == len(self.steps):
+            results.append(tag if tag.clazz_id == _COMPOUND or tag.clazz_id == _LIST else tag.get())
+            return
+
+        key = self.steps[step]
+        if type(key) is tuple:
+            index, = key
+            if tag.clazz_id == _LIST:
+                children = tag.children if index is None else tag.children[index:index + 1 or None]
+                for child in children:
+                    self.__walk(child, step + 1, results)
+            elif hasattr(tag, 'clazz_sub_type'):
+                self.__select(tag.get(), index, step + 1, results)
+        elif tag.clazz_id == _COMPOUND:
+            if key is None:
+                for child in list(tag.children.values()):
+                    self.__walk(child, step + 1, results)
+            else:
+                name = mutf8.decode(key)
+                if tag.has(name):
+                    self.__walk(tag.get(name), step + 1, results)
+
+    def __select(self, values, index, step, results):
+        # Array elements are plain numbers, nothing can be selected below them
+        if step != len(self.steps):
+            return
+        if index is None:
+            results.extend(values)
+        elif -len(values) <= index < len(values):
+            results.append(values[index])
@@ -0,0 +1,47 @@
+import array
+from typing import Iterable
+
+from .components import BlockState
+
+
+class Volume:
+    '''A dense box of blocks, stored as palette indices in a flat `array` like chunk sections are:
+    x changes fastest, then z, then y.
+
+    The indices are unsigned 16 bit and widen to 32 bit when the palette outgrows them.
+    `block_light` and `sky_light` are filled in by `World.read_box(..., light=True)`.'''
+
+    def __init__(self, size: tuple[int, int, int], palette: Iterable[BlockState] = None, indices: array.array = None):
+        self.size = tuple(size)
+        self.palette: list[BlockState] = list(palette) if palette is not None else [BlockState('minecraft:air', {})]
+        self.__palette_index = {state: i for i, state in enumerate(self.palette)}
+        width, height, depth = self.size
+        if indices is None:
+            indices = array.array('H', bytes(2 * width * height * depth))
+        elif len(indices) != width * height * depth:
+            raise ValueError(f'Expected {width * height * depth} indices for a volume of size {self.size}, got {len(indices)}')
+        self.indices: array.array = indices
+        self.block_light: array.array = None
+        self.sky_light: array.array = None
+
+    def index(self, x: int, y: int, z: int) -> int:
+        '''Position of a block in the flat arrays, relative to the volume's minimum corner.'''
+        width, height, depth = self.size
+        if not (0 <= x < width and 0 <= y < height and 0 <= z < depth):
+            raise IndexError(f'({x}, {y}, {z}) is outside of a volume of size {self.size}')
+        return x + z * width + y * width * depth
+
+    def get_state(self, x: int, y: int, z: int) -> BlockState:
+        return self.palette[self.indices[self.index(x, y, z)]]
+
+    def set_state(self, x: int, y: int, z: int, state: BlockState):
+        self.indices[self.index(x, y, z)] = self.palette_index(state)
+
+    def palette_index(self, state: BlockState) -> int:
+        '''Index of `state` in the palette, it is added if it is not there yet.'''
+        if state not in self.__palette_index:
+            self.__palette_index[state] = len(self.palette)
+            self.palette.append(state)
+            if len(self.palette) > 0xFFFF and self.indices.typecode == 'H':
+                self.indices = array.array('I', self.indices)
+        return self.__palette_index[state]
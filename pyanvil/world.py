@@ -1,17 +1,91 @@
-from typing import Union
+import array
+import functools
+import threading
+import traceback
+from collections import OrderedDict
+from concurrent.futures import Executor, ProcessPoolExecutor, as_completed
+from io import UnsupportedOperation
+from typing import Any, Callable, Iterable, Iterator, NamedTuple, Union
 from pathlib import Path
 
-from .components.region import Region
+from .components.region import Region, RegionHeader
+from .utility.file_pool import RegionFilePool, default_pool
 from .coordinate import AbsoluteCoordinate, ChunkCoordinate, RegionCoordinate
 from .canvas import Canvas
-from .components import Chunk, Block
+from .components import Chunk, ChunkSection, Block, Sizes
+from .volume import Volume
+
+
+class ChunkError(NamedTuple):
+    '''A chunk that failed to load or made the mapped function raise.'''
+    region: str
+    x: int
+    z: int
+    error: str
+    traceback: str
+
+
+class MapResult(NamedTuple):
+    value: Any
+    errors: list[ChunkError]
+
+
+def _map_region(path: Path, fn: Callable, reduce: Callable, per: str) -> tuple[list, list[ChunkError]]:
+    '''Run `fn` over every chunk or section stored in one region file, the worker side of `World.map_regions`.
+
+    Returns the results, reduced to a single partial result if `reduce` is given, and the chunks that failed.'''
+    results = []
+    errors = []
+    # A pool of its own, closing the region must not close files the calling World still uses
+    region = Region(path, read_only=True, file_pool=RegionFilePool())
+    try:
+        base = region.region_coordinate.to_chunk_coordinate()
+        for index in region.header.chunk_indexes:
+            coord = ChunkCoordinate(base.x + index % Sizes.REGION_WIDTH, base.z + index // Sizes.REGION_WIDTH)
+            try:
+                chunk = region.get_chunk(coord)
+                if per == World.PER_SECTION:
+                    results += [fn(chunk, section) for section in chunk.sections.values()]
+                else:
+                    results.append(fn(chunk))
+            except Exception as e:
+                errors.append(ChunkError(str(path), coord.x, coord.z, repr(e), traceback.format_exc()))
+            finally:
+                region.chunks.pop(index, None)
+    finally:
+        region.close()
+    if reduce is not None:
+        results = [functools.reduce(reduce, results)] if results else []
+    return results, errors
 
 
 class World:
-    def __init__(self, world_folder, save_location=None, debug=False, read=True, write=True):
+    PER_CHUNK = 'chunk'
+    PER_SECTION = 'section'
+
+    def __init__(self, world_folder, save_location=None, debug=False, read=True, write=True, file_pool: RegionFilePool = None,
+                 max_regions: int = None, max_chunks: int = None):
+        '''At most `max_regions` regions and `max_chunks` chunks are kept loaded, the least recently used ones are
+        dropped first and saved if they are dirty. Both are unbounded by default.
+
+        With `write=False` the world is read-only: region files are only opened for reading, nothing is tracked
+        as dirty and changing a block raises. A read-only world can be shared by threads.'''
         self.debug = debug
+        self.write = write
         self.world_folder = self.__resolve_world_folder(world_folder=world_folder, save_location=save_location)
-        self.regions: dict[RegionCoordinate, Region] = dict()
+        # Both caches are kept in least recently used order
+        self.regions: OrderedDict[RegionCoordinate, Region] = OrderedDict()
+        self.__chunks: OrderedDict[ChunkCoordinate, Chunk] = OrderedDict()
+        self.max_regions = max_regions
+        self.max_chunks = max_chunks
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.write_backs = 0
+        # Region files are opened through the pool, by default the one shared by all regions
+        self.file_pool = file_pool if file_pool is not None else default_pool
+        # Only held while the caches are looked at or changed, never while chunks are read or parsed
+        self.__lock = threading.RLock()
 
     def __resolve_world_folder(self, world_folder: Union[str, Path], save_location: Union[str, Path]):
         folder = Path()
@@ -32,12 +106,150 @@ class World:
 
     def flush(self):
         self.close()
-        self.regions: dict[RegionCoordinate, Region] = dict()
+        self.regions.clear()
+        self.__chunks.clear()
 
-    def close(self):
+    def close(self, executor: Executor = None, compression_scheme: Union[int, str] = None, compression_level: int = None):
+        '''Save every dirty region, compressing the chunks on `executor` if one is given.'''
         for region in self.regions.values():
+            if region.is_dirty and self.write:
+                region.save(executor=executor, compression_scheme=compression_scheme, compression_level=compression_level)
+            region.close()
+
+    def map_regions(self, fn: Callable, reduce: Callable = None, workers: int = None, per: str = PER_CHUNK,
+                    progress: Callable[[int, int], None] = None) -> MapResult:
+        '''Run `fn` over every chunk (`fn(chunk)`) or every section (`fn(chunk, section)`) stored in the world.
+
+        Region files are handed out to a pool of `workers` processes, `workers=1` runs in this process. `fn` and
+        `reduce` have to be picklable, module level functions for example. Each region is opened read-only in the
+        worker, `fn` cannot change the chunks.
+
+        Without `reduce` the value is the list of all results, region by region in file order. With `reduce` the
+        results are combined with `reduce(a, b)`, per region in the workers and then across regions, so it has to
+        be associative. A chunk that fails to load or makes `fn` raise is skipped and reported in the errors.
+        `progress(done, total)` is called in this process after each region file.
+
+        The workers read the region files on disk, so the dirty regions of this world are saved first.'''
+        if per not in (World.PER_CHUNK, World.PER_SECTION):
+            raise ValueError(f'Unknown unit "{per}", expected "{World.PER_CHUNK}" or "{World.PER_SECTION}"')
+        for region in list(self.regions.values()):
             if region.is_dirty:
                 region.save()
+        paths = self.__region_paths()
+        partials = {}
+        if workers == 1:
+            for done, path in enumerate(paths, start=1):
+                partials[path] = _map_region(path, fn, reduce, per)
+                if progress is not None:
+                    progress(done, len(paths))
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                futures = {executor.submit(_map_region, path, fn, reduce, per): path for path in paths}
+                for done, future in enumerate(as_completed(futures), start=1):
+                    partials[futures[future]] = future.result()
+                    if progress is not None:
+                        progress(done, len(paths))
+
+        results = []
+        errors = []
+        for path in paths:
+            region_results, region_errors = partials[path]
+            results += region_results
+            errors += region_errors
+        if reduce is not None:
+            return MapResult(functools.reduce(reduce, results) if results else None, errors)
+        return MapResult(results, errors)
+
+    def iter_regions(self) -> Iterator[Region]:
+        '''Yield every region of the world, in file name order.
+
+        Regions that were not loaded before are released once the next one is asked for, unless they are dirty.'''
+        return self.__iter_regions(Region.coordinate_from_file_name(path) for path in self.__region_paths())
+
+    def __iter_regions(self, coords: Iterable[RegionCoordinate]) -> Iterator[Region]:
+        for coord in coords:
+            loaded = coord in self.regions
+            region = self.get_region(coord)
+            try:
+                yield region
+            finally:
+                if not loaded:
+                    self.__release_region(coord)
+
+    def iter_chunks(self, box: tuple[AbsoluteCoordinate, AbsoluteCoordinate] = None) -> Iterator[Chunk]:
+        '''Yield every stored chunk of the world, or those touching the box between two corners, in file order.
+
+        Chunks that were not loaded before are dropped again once the next one is asked for. Dirty ones are kept in
+        the chunk cache, which writes them back when they are evicted.'''
+        coords = [Region.coordinate_from_file_name(path) for path in self.__region_paths()]
+        if box is not None:
+            lo, hi = World.__box_corners(*box)
+            low_chunk, high_chunk = lo.to_chunk_coordinate(), hi.to_chunk_coordinate()
+            low_region, high_region = low_chunk.to_region_coordinate(), high_chunk.to_region_coordinate()
+            # Regions outside of the box are not even opened
+            coords = [c for c in coords if low_region.x <= c.x <= high_region.x and low_region.z <= c.z <= high_region.z]
+        for region in self.__iter_regions(coords):
+            base = region.region_coordinate.to_chunk_coordinate()
+            header = region.header
+            indexes = sorted(header.chunk_indexes, key=lambda i: header.offsets[i])
+            for index in indexes:
+                coord = ChunkCoordinate(base.x + index % Sizes.REGION_WIDTH, base.z + index // Sizes.REGION_WIDTH)
+                if box is not None and not (low_chunk.x <= coord.x <= high_chunk.x and low_chunk.z <= coord.z <= high_chunk.z):
+                    continue
+                loaded = index in region.chunks
+                chunk = region.get_chunk(coord)
+                try:
+                    yield chunk
+                finally:
+                    if chunk.is_dirty:
+                        self.__cache_chunk(coord, chunk)
+                    elif not loaded:
+                        with self.__lock:
+                            # Another thread may have cached the chunk meanwhile, it stays loaded for it
+                            if coord not in self.__chunks:
+                                region.unload_chunk(coord)
+
+    def iter_sections(self, box: tuple[AbsoluteCoordinate, AbsoluteCoordinate] = None) -> Iterator[tuple[Chunk, ChunkSection]]:
+        '''Yield `(chunk, section)` for every stored section of the world, or those touching the box between two
+        corners, chunk by chunk in file order and bottom to top within a chunk. See `iter_chunks`.'''
+        if box is not None:
+            lo, hi = World.__box_corners(*box)
+        for chunk in self.iter_chunks(box):
+            for section_y in sorted(chunk.sections):
+                if box is None or lo.y // Sizes.SUBCHUNK_WIDTH <= section_y <= hi.y // Sizes.SUBCHUNK_WIDTH:
+                    yield chunk, chunk.sections[section_y]
+
+    def __region_paths(self) -> list[Path]:
+        return sorted((self.world_folder / 'region').glob('r.*.*.mca'))
+
+    def __release_region(self, coord: RegionCoordinate):
+        with self.__lock:
+            region = self.regions.get(coord)
+            # A region with cached chunks is still in use, it is left to the cache
+            if region is None or region.is_dirty or any(c.to_region_coordinate() == coord for c in self.__chunks):
+                return
+            del self.regions[coord]
+        region.close()
+
+    def region_index(self) -> dict[RegionCoordinate, RegionHeader]:
+        '''Read the header of every region file in the world, without loading any chunks.'''
+        index = {}
+        for path in self.__region_paths():
+            index[Region.coordinate_from_file_name(path)] = RegionHeader.from_file(path)
+        return index
+
+    def optimize(self, order: str = Region.ORDER_Z_MAJOR) -> int:
+        '''Repack every region file of the world, see `Region.optimize`. Returns the number of bytes reclaimed.'''
+        self.__check_writable()
+        reclaimed = 0
+        for path in self.__region_paths():
+            coord = Region.coordinate_from_file_name(path)
+            if coord in self.regions:
+                reclaimed += self.regions[coord].optimize(order=order)
+            else:
+                with Region(path, file_pool=self.file_pool) as region:
+                    reclaimed += region.optimize(order=order)
+        return reclaimed
 
     def get_block(self, coordinate: AbsoluteCoordinate) -> Block:
         self._get_region_file_name(coordinate.to_region_coordinate())
@@ -45,20 +257,188 @@ class World:
         return chunk.get_block(coordinate)
 
     def get_region(self, coord: RegionCoordinate):
-        return self.regions.get(coord, self._load_region(coord))
+        with self.__lock:
+            region = self.regions.get(coord)
+            if region is not None:
+                self.regions.move_to_end(coord)
+                return region
+        return self._load_region(coord)
 
     def get_chunk(self, coord: ChunkCoordinate) -> Chunk:
+        with self.__lock:
+            chunk = self.__chunks.get(coord)
+            if chunk is not None:
+                self.hits += 1
+                self.__chunks.move_to_end(coord)
+                return chunk
+            self.misses += 1
         region = self.get_region(coord.to_region_coordinate())
-        return region.get_chunk(coord)
+        return self.__cache_chunk(coord, region.get_chunk(coord))
+
+    @property
+    def cache_stats(self) -> dict[str, int]:
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'write_backs': self.write_backs,
+            'regions': len(self.regions),
+            'chunks': len(self.__chunks),
+        }
+
+    def __cache_chunk(self, coord: ChunkCoordinate, chunk: Chunk) -> Chunk:
+        '''Add a loaded chunk to the cache. If another thread cached the chunk first, that one is returned.'''
+        with self.__lock:
+            chunk = self.__chunks.setdefault(coord, chunk)
+            while self.max_chunks is not None and len(self.__chunks) > self.max_chunks:
+                self.__evict_chunk(next(iter(self.__chunks)))
+            return chunk
+
+    def __check_writable(self):
+        if not self.write:
+            raise UnsupportedOperation(f'World "{self.world_folder}" is opened read-only')
+
+    def __evict_chunk(self, coord: ChunkCoordinate):
+        chunk = self.__chunks.pop(coord)
+        self.evictions += 1
+        if chunk.is_dirty:
+            self.write_backs += 1
+        region = self.regions.get(coord.to_region_coordinate())
+        if region is not None:
+            region.unload_chunk(coord)
+
+    def __evict_region(self, coord: RegionCoordinate):
+        region = self.regions.pop(coord)
+        for chunk_coord in [c for c in self.__chunks if c.to_region_coordinate() == coord]:
+            del self.__chunks[chunk_coord]
+        self.evictions += 1
+        if region.is_dirty:
+            self.write_backs += 1
+            region.save()
+        region.close()
+
+    def prefetch(self, corner1: AbsoluteCoordinate, corner2: AbsoluteCoordinate, executor: Executor = None) -> list[Chunk]:
+        '''Load every existing chunk in the box between the two corners, see `Region.prefetch`.
+
+        A box of more than `max_chunks` chunks pushes its first chunks out of the cache again. They are still
+        the instances `get_chunk` returns as long as they are referenced, edits to them are not lost.'''
+        chunk1, chunk2 = corner1.to_chunk_coordinate(), corner2.to_chunk_coordinate()
+        by_region: dict[RegionCoordinate, list[ChunkCoordinate]] = {}
+        for x in range(min(chunk1.x, chunk2.x), max(chunk1.x, chunk2.x) + 1):
+            for z in range(min(chunk1.z, chunk2.z), max(chunk1.z, chunk2.z) + 1):
+                coord = ChunkCoordinate(x, z)
+                by_region.setdefault(coord.to_region_coordinate(), []).append(coord)
+        chunks = []
+        for region_coord, coords in by_region.items():
+            if (self.world_folder / 'region' / self._get_region_file_name(region_coord)).exists():
+                chunks += self.get_region(region_coord).prefetch(coords, executor=executor)
+        return [self.__cache_chunk(chunk.coordinate, chunk) for chunk in chunks]
+
+    def read_box(self, corner1: AbsoluteCoordinate, corner2: AbsoluteCoordinate, light: bool = False,
+                 executor: Executor = None) -> Volume:
+        '''Read every block in the box between the two corners (inclusive) into a `Volume`, section by section.
+
+        Blocks in chunks or sections that do not exist are air. With `light` the volume also gets the light values.'''
+        lo, hi = World.__box_corners(corner1, corner2)
+        volume = Volume((hi.x - lo.x + 1, hi.y - lo.y + 1, hi.z - lo.z + 1))
+        if light:
+            volume.block_light = array.array('B', bytes(len(volume.indices)))
+            volume.sky_light = array.array('B', bytes(len(volume.indices)))
+        for chunk in self.prefetch(lo, hi, executor=executor):
+            for section_y, rows in World.__section_rows(chunk, lo, hi):
+                section = chunk.sections.get(section_y)
+                if section is None:
+                    continue
+                indices, palette = section.palette_indices()
+                remap = [volume.palette_index(state) for state in palette]
+                typecode = volume.indices.typecode
+                for src, dst, length in rows:
+                    volume.indices[dst:dst + length] = array.array(typecode, [remap[i] for i in indices[src:src + length]])
+                if light:
+                    block_light, sky_light = section.light_values()
+                    for src, dst, length in rows:
+                        volume.block_light[dst:dst + length] = block_light[src:src + length]
+                        volume.sky_light[dst:dst + length] = sky_light[src:src + length]
+        return volume
+
+    def write_box(self, corner: AbsoluteCoordinate, volume: Volume, executor: Executor = None):
+        '''Write `volume` into the world with its minimum corner at `corner`, section by section.
+
+        The volume carries the flat palette indices, their palette and the size of the box, an index array and
+        palette from elsewhere are wrapped with `Volume(size, palette, indices)`. Every chunk the volume touches has
+        to exist already, missing sections are created.'''
+        self.__check_writable()
+        width, height, depth = volume.size
+        lo = corner
+        hi = AbsoluteCoordinate(corner.x + width - 1, corner.y + height - 1, corner.z + depth - 1)
+        chunks = self.prefetch(lo, hi, executor=executor)
+        low_chunk, high_chunk = lo.to_chunk_coordinate(), hi.to_chunk_coordinate()
+        expected = (high_chunk.x - low_chunk.x + 1) * (high_chunk.z - low_chunk.z + 1)
+        if len(chunks) != expected:
+            loaded = {(c.coordinate.x, c.coordinate.z) for c in chunks}
+            missing = [
+                (x, z) for x in range(low_chunk.x, high_chunk.x + 1) for z in range(low_chunk.z, high_chunk.z + 1)
+                if (x, z) not in loaded
+            ]
+            raise ValueError(f'Cannot write to chunks that do not exist: {missing}')
+        for chunk in chunks:
+            for section_y, rows in World.__section_rows(chunk, lo, hi):
+                section = chunk.get_section(section_y * Sizes.SUBCHUNK_WIDTH)
+                indices, palette = section.palette_indices()
+                section_index = {state: i for i, state in enumerate(palette)}
+                remap = []
+                for state in volume.palette:
+                    if state not in section_index:
+                        section_index[state] = len(palette)
+                        palette.append(state)
+                    remap.append(section_index[state])
+                for src, dst, length in rows:
+                    indices[src:src + length] = array.array('H', [remap[i] for i in volume.indices[dst:dst + length]])
+                section.set_palette_indices(indices, palette)
+
+    @staticmethod
+    def __box_corners(corner1: AbsoluteCoordinate, corner2: AbsoluteCoordinate) -> tuple[AbsoluteCoordinate, AbsoluteCoordinate]:
+        return (
+            AbsoluteCoordinate(min(corner1.x, corner2.x), min(corner1.y, corner2.y), min(corner1.z, corner2.z)),
+            AbsoluteCoordinate(max(corner1.x, corner2.x), max(corner1.y, corner2.y), max(corner1.z, corner2.z)),
+        )
+
+    @staticmethod
+    def __section_rows(chunk: Chunk, lo: AbsoluteCoordinate, hi: AbsoluteCoordinate):
+        '''For every section of the chunk inside the box: its y index and the (section offset, volume offset, length)
+        of each row of blocks along x.'''
+        size = Sizes.SUBCHUNK_WIDTH
+        width, depth = hi.x - lo.x + 1, hi.z - lo.z + 1
+        chunk_x, chunk_z = chunk.coordinate.x * size, chunk.coordinate.z * size
+        x0, x1 = max(lo.x, chunk_x), min(hi.x, chunk_x + size - 1)
+        z0, z1 = max(lo.z, chunk_z), min(hi.z, chunk_z + size - 1)
+        for section_y in range(lo.y // size, hi.y // size + 1):
+            section_base = section_y * size
+            rows = [
+                (
+                    (x0 - chunk_x) + (z - chunk_z) * size + (y - section_base) * size * size,
+                    (x0 - lo.x) + (z - lo.z) * width + (y - lo.y) * width * depth,
+                    x1 - x0 + 1,
+                )
+                for y in range(max(lo.y, section_base), min(hi.y, section_base + size - 1) + 1)
+                for z in range(z0, z1 + 1)
+            ]
+            yield section_y, rows
 
     def get_canvas(self):
         return Canvas(self)
 
     def _load_region(self, coord: RegionCoordinate):
         name = self._get_region_file_name(coord)
-        region = Region(self.world_folder / 'region' / name)
-        self.regions[coord] = region
-        return region
+        region = Region(self.world_folder / 'region' / name, file_pool=self.file_pool, read_only=not self.write)
+        with self.__lock:
+            cached = self.regions.setdefault(coord, region)
+            while self.max_regions is not None and len(self.regions) > self.max_regions:
+                self.__evict_region(next(iter(self.regions)))
+        if cached is not region:
+            # Another thread loaded the region first
+            region.close()
+        return cached
 
     def _get_region_file_name(self, region: RegionCoordinate):
         return f'r.{region.x}.{region.z}.mca'
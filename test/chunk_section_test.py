@@ -0,0 +1,61 @@
+import array
+
+from pyanvil.components import BlockState, ByteArrayTag, ChunkSection
+from conftest import PALETTE, build_section_nbt
+
+
+class TestChunkSection:
+    def test_blocks_are_built_on_demand(args):
+        section = ChunkSection.from_nbt(build_section_nbt(0))
+        assert section._ChunkSection__blocks is None
+        indices, palette = section.palette_indices()
+        assert section._ChunkSection__blocks is None
+        assert [palette[i].name for i in indices[:4]] == PALETTE + PALETTE[:1]
+        assert section.get_block((1, 0, 0)).get_state().name == PALETTE[1]
+        assert len(section._ChunkSection__blocks) == 4096
+
+    def test_light_nibbles(args):
+        assert ChunkSection._divide_nibbles([0x21, -1]) == [1, 2, 15, 15]
+        block_light, sky_light = ChunkSection.from_nbt(build_section_nbt(0)).light_values()
+        assert set(block_light) == {0} and set(sky_light) == {15} and len(sky_light) == 4096
+
+    def test_light_values_per_block(args):
+        # Block 0 is in the low nibble of the first byte, block 1 in its high nibble
+        section_nbt = build_section_nbt(0)
+        section_nbt.add_child(ByteArrayTag(tag_name='BlockLight', values=array.array('b', [0x3A, 0x0F]) + array.array('b', bytes(2046))))
+        section_nbt.add_child(ByteArrayTag(tag_name='SkyLight', values=array.array('b', [0x70, -1]) + array.array('b', bytes(2046))))
+        block_light, sky_light = ChunkSection.from_nbt(section_nbt).light_values()
+        assert list(block_light[:4]) == [10, 3, 15, 0]
+        assert list(sky_light[:4]) == [0, 7, 15, 15]
+        section = ChunkSection.from_nbt(section_nbt)
+        blocks = [section.get_block((x, 0, 0)) for x in range(4)]
+        assert [b.block_light for b in blocks] == [10, 3, 15, 0]
+        assert [b.sky_light for b in blocks] == [0, 7, 15, 15]
+
+    def test_packing_round_trip(args):
+        section = ChunkSection.from_nbt(build_section_nbt(0))
+        indices, palette = section.palette_indices()
+        palette += [BlockState(f'minecraft:block_{i}', {}) for i in range(30)]
+        indices = array.array('H', (i % len(palette) for i in range(4096)))
+        section.set_palette_indices(indices, palette)
+        assert section.is_dirty
+
+        tag = section.serialize()
+        # 33 states need 6 bits, 10 per long
+        assert len(tag.get('BlockStates').get()) == 410
+        reread, reread_palette = ChunkSection.from_nbt(tag).palette_indices()
+        assert [reread_palette[i] for i in reread] == [palette[i] for i in indices]
+
+    def test_set_palette_indices_keeps_built_blocks(args):
+        section = ChunkSection.from_nbt(build_section_nbt(0))
+        block = section.get_block((0, 0, 0))
+        block.block_light = 7
+        gold = BlockState('minecraft:gold_block', {})
+        section.set_palette_indices(array.array('H', bytes(2 * 4096)), [gold])
+        assert block.get_state().name == 'minecraft:gold_block' and section.get_block((0, 0, 0)) is block
+        # A change through a block handed out earlier is still written
+        block.set_state(BlockState('minecraft:dirt', {}))
+        tag = section.serialize()
+        reread, reread_palette = ChunkSection.from_nbt(tag).palette_indices()
+        assert reread_palette[reread[0]].name == 'minecraft:dirt' and reread_palette[reread[1]].name == 'minecraft:gold_block'
+        assert section.light_values()[0][0] == 7
@@ -0,0 +1,57 @@
+import os
+
+import pytest
+
+from pyanvil.utility import compression
+
+
+DATA = b'minecraft:stone' * 5000 + os.urandom(100)
+
+
+class TestCompression:
+    @pytest.mark.parametrize('scheme', [compression.GZIP, compression.ZLIB, compression.NONE])
+    def test_round_trip(args, scheme):
+        packed = compression.compress(scheme, DATA)
+        assert compression.decompress(scheme, packed) == DATA
+
+    def test_lookup_by_name_and_external_flag(args):
+        assert compression.get_codec('gzip').scheme == compression.GZIP
+        assert compression.get_codec(compression.ZLIB | compression.EXTERNAL).name == 'zlib'
+        with pytest.raises(ValueError):
+            compression.get_codec(7)
+        with pytest.raises(ValueError):
+            compression.get_codec('brotli')
+
+    def test_level(args):
+        assert len(compression.compress('zlib', DATA, 9)) < len(compression.compress('zlib', DATA, 0))
+
+    def test_gzip_is_a_gzip_stream(args):
+        assert compression.compress('gzip', DATA)[:2] == b'\x1f\x8b'
+
+    @pytest.mark.parametrize('xxh32', [compression.xxh32, compression._xxh32])
+    def test_xxh32(args, xxh32):
+        assert xxh32(b'') == 0x02CC5D05
+        assert xxh32(b'abc') == 0x32D153FF
+        assert xxh32(b'Nobody inspects the spammish repetition') == 0xE2293B2F
+        data = memoryview(DATA)[3:70003]
+        assert xxh32(data, compression._LZ4_SEED) == compression._xxh32(data, compression._LZ4_SEED)
+
+    def test_lz4_raw_blocks(args):
+        # Blocks that do not shrink are stored raw, those can be read without the lz4 package
+        blocks = [os.urandom(100), os.urandom(30)]
+        data = b''.join(
+            compression._lz4_block_header(compression._LZ4_RAW, len(b), len(b), compression.xxh32(b, compression._LZ4_SEED) & 0xFFFFFFF) + b
+            for b in blocks
+        ) + compression._lz4_block_header(compression._LZ4_RAW, 0, 0, 0)
+        assert compression.decompress(compression.LZ4, data) == b''.join(blocks)
+
+    def test_lz4_round_trip(args):
+        pytest.importorskip('lz4')
+        packed = compression.compress(compression.LZ4, DATA * 2)
+        assert packed.startswith(b'LZ4Block')
+        # The repetitive data is stored in compressed blocks, each with the checksum of its uncompressed bytes
+        method = packed[len(compression._LZ4_MAGIC)] & 0xF0
+        checksum = int.from_bytes(packed[len(compression._LZ4_MAGIC) + 9:len(compression._LZ4_MAGIC) + 13], 'little')
+        assert method == compression._LZ4_COMPRESSED
+        assert checksum == compression._xxh32((DATA * 2)[:compression._LZ4_BLOCK_SIZE], compression._LZ4_SEED) & 0xFFFFFFF
+        assert compression.decompress(compression.LZ4, packed) == DATA * 2
@@ -0,0 +1,71 @@
+from pyanvil.components import Region
+from pyanvil.coordinate import ChunkCoordinate
+from pyanvil.utility.file_pool import RegionFilePool
+from conftest import build_chunk_nbt, write_region_file
+
+
+def region_files(folder, count):
+    return [write_region_file(folder / f'r.{i}.0.mca', {(0, 0): build_chunk_nbt(i * 32, 0)}) for i in range(count)]
+
+
+class TestRegionFilePool:
+    def test_descriptors_are_bounded(args, tmp_path):
+        pool = RegionFilePool(max_descriptors=3)
+        regions = [Region(path, file_pool=pool) for path in region_files(tmp_path, 6)]
+        for i, region in enumerate(regions):
+            assert region.get_chunk(ChunkCoordinate(i * 32, 0)).coordinate.x == i * 32
+            assert pool.open_descriptors <= 3
+        # Read-only files only hold the descriptor of their map
+        assert pool.stats['open_files'] == 3
+        # Every file opened after the first three pushed out the least recently used one
+        assert pool.evictions == pool.misses - 3
+        # Evicted files are reopened on demand
+        assert regions[0].query('Level.xPos') == {0: [0]}
+        pool.close_all()
+        assert pool.open_descriptors == 0
+
+    def test_hits_and_misses(args, tmp_path):
+        pool = RegionFilePool()
+        path, = region_files(tmp_path, 1)
+        region = Region(path, file_pool=pool)
+        assert (pool.hits, pool.misses) == (0, 1)
+        region.get_chunk(ChunkCoordinate(0, 0))
+        region.query('Level.xPos')
+        assert (pool.hits, pool.misses) == (2, 1)
+
+    def test_files_are_read_only_until_saved(args, tmp_path):
+        pool = RegionFilePool()
+        path, = region_files(tmp_path, 1)
+        with Region(path, file_pool=pool) as region:
+            region.get_chunk(ChunkCoordinate(0, 0)).mark_as_dirty()
+            assert pool.open_descriptors == 1
+            region.save()
+            assert pool.open_descriptors == 2
+            assert pool.misses == 2
+        assert path not in pool
+        with Region(path, file_pool=pool) as region:
+            assert region.get_chunk(ChunkCoordinate(0, 0)).coordinate.x == 0
+
+    def test_file_stays_open_for_other_users(args, tmp_path):
+        pool = RegionFilePool()
+        path, = region_files(tmp_path, 1)
+        first = Region(path, file_pool=pool)
+        with Region(path, file_pool=pool) as second:
+            second.get_chunk(ChunkCoordinate(0, 0))
+        assert path in pool
+        assert first.get_chunk(ChunkCoordinate(0, 0)).coordinate.x == 0
+        first.close()
+        # Closing twice does not give up another user's share
+        first.close()
+        assert path not in pool
+
+    def test_release_keeps_viewed_file(args, tmp_path):
+        pool = RegionFilePool()
+        path, = region_files(tmp_path, 1)
+        region = Region(path, file_pool=pool)
+        view = memoryview(pool.get(path).map)
+        region.close()
+        assert path in pool and pool.open_descriptors == 1
+        view.release()
+        pool.release(path)
+        assert path not in pool
@@ -0,0 +1,95 @@
+import tracemalloc
+
+from pyanvil.stream import InputStream, OutputStream
+from pyanvil.utility.nbt import NBT
+from conftest import build_chunk_nbt
+
+
+def serialized_chunk():
+    stream = OutputStream()
+    build_chunk_nbt(0, 0, section_ys=range(16)).serialize(stream)
+    return stream.get_data()
+
+
+def traced_bytes(build):
+    tracemalloc.start()
+    try:
+        start = tracemalloc.get_traced_memory()[0]
+        result = build()
+        return tracemalloc.get_traced_memory()[0] - start, result
+    finally:
+        tracemalloc.stop()
+
+
+def walk(tag):
+    stack = [tag]
+    while stack:
+        tag = stack.pop()
+        yield tag
+        children = getattr(tag, '_children', ())
+        stack.extend(children.values() if isinstance(children, dict) else children)
+
+
+# Stand-ins for the tag classes as they were before __slots__, with a per-instance __dict__
+_legacy_classes = {}
+
+
+def legacy_class(clazz):
+    if clazz not in _legacy_classes:
+        _legacy_classes[clazz] = type(f'Legacy{clazz.__name__}', (), {})
+    return _legacy_classes[clazz]
+
+
+def rebuild(tag, make):
+    '''A copy of the tree made of `make(tag)` nodes, sharing the leaf values with the original.'''
+    node = make(tag)
+    children = getattr(tag, '_children', None)
+    if isinstance(children, dict):
+        node._children = {name: rebuild(child, make) for name, child in children.items()}
+    elif children is not None:
+        node._children = [rebuild(child, make) for child in children]
+    return node
+
+
+def slotted_node(tag):
+    node = object.__new__(type(tag))
+    for name in type(tag).__slots__:
+        setattr(node, name, getattr(tag, name))
+    return node
+
+
+def legacy_node(tag):
+    node = legacy_class(type(tag))()
+    for name in type(tag).__slots__:
+        setattr(node, name, getattr(tag, name))
+    # Every tag used to hold its own copy of its name
+    node.tag_name = (tag.tag_name + '.')[:-1]
+    return node
+
+
+class TestMemoryReport:
+    def test_bytes_per_parsed_chunk(args, record_property):
+        data = serialized_chunk()
+        eager_bytes = traced_bytes(lambda: NBT.parse_nbt(InputStream(data)))[0]
+        lazy_bytes = traced_bytes(lambda: NBT.parse_nbt(InputStream(data), lazy=True))[0]
+        tag = NBT.parse_nbt(InputStream(data))
+        # The same tree built from slotted tags with interned names (after) and from tags with a __dict__ and
+        # their own names (before)
+        slotted_bytes = traced_bytes(lambda: rebuild(tag, slotted_node))[0]
+        legacy_bytes = traced_bytes(lambda: rebuild(tag, legacy_node))[0]
+        # The figures are written to the junit xml report (--junitxml)
+        for name, value in [('chunk_bytes', len(data)), ('eager_parse_bytes', eager_bytes), ('lazy_parse_bytes', lazy_bytes),
+                            ('tag_objects_bytes_before', legacy_bytes), ('tag_objects_bytes_after', slotted_bytes)]:
+            record_property(name, value)
+        assert lazy_bytes < eager_bytes
+        assert slotted_bytes < legacy_bytes * 0.6
+
+    def test_tags_have_no_instance_dict(args):
+        tag = NBT.parse_nbt(InputStream(serialized_chunk()))
+        assert not any(hasattr(t, '__dict__') for t in walk(tag))
+
+    def test_names_are_shared(args):
+        tag = NBT.parse_nbt(InputStream(serialized_chunk()))
+        sections = tag.get('Level').get('Sections').children
+        assert sections[0].get('Y').tag_name is sections[1].get('Y').tag_name
+        assert sections[0].tag_name is sections[1].tag_name
@@ -0,0 +1,28 @@
+from pyanvil.utility import mutf8
+from pyanvil.stream import InputStream, OutputStream
+
+
+class TestModifiedUTF8:
+
+    def test_ascii(args):
+        assert mutf8.encode('minecraft:stone') == b'minecraft:stone'
+        assert mutf8.decode(b'minecraft:stone') == 'minecraft:stone'
+
+    def test_nul_uses_two_bytes(args):
+        assert mutf8.encode('a\x00b') == b'a\xc0\x80b'
+        assert mutf8.decode(b'a\xc0\x80b') == 'a\x00b'
+
+    def test_two_and_three_byte_characters(args):
+        assert mutf8.encode('é€') == b'\xc3\xa9\xe2\x82\xac'
+        assert mutf8.decode(b'\xc3\xa9\xe2\x82\xac') == 'é€'
+
+    def test_supplementary_characters_use_surrogate_pairs(args):
+        assert mutf8.encode('\U0001F600') == b'\xed\xa0\xbd\xed\xb8\x80'
+        assert mutf8.decode(b'\xed\xa0\xbd\xed\xb8\x80') == '\U0001F600'
+        assert mutf8.decode(memoryview(b'x\xed\xa0\xbd\xed\xb8\x80')) == 'x\U0001F600'
+
+    def test_stream_length_prefix_counts_bytes(args):
+        stream = OutputStream()
+        stream.write_string('é\U0001F600')
+        assert stream.get_data() == b'\x00\x08\xc3\xa9\xed\xa0\xbd\xed\xb8\x80'
+        assert InputStream(stream.get_data()).read_string() == 'é\U0001F600'
@@ -1,7 +1,14 @@
+import array
+import gzip
+import io
+
+import pytest
+
 from pyanvil.components import ByteTag, ShortTag, IntTag, LongTag, FloatTag, DoubleTag
 from pyanvil.components import ByteArrayTag, StringTag, ListTag, CompoundTag, IntArrayTag, LongArrayTag
-from pyanvil.utility.nbt import NBT
-from pyanvil.stream import OutputStream, InputStream
+from pyanvil.utility.nbt import NBT, TagType, _TagSpan
+from pyanvil.stream import DecompressingReader, OutputStream, InputStream
+from conftest import build_chunk_nbt
 
 
 def build_simple_nbt_tag_test(clz, test_val, test_bin):
@@ -61,6 +68,20 @@ def build_array_nbt_tag_test(clz, test_vals, test_bins):
             ])
             assert parsed_tag == expected_tag, f'Tag {clz.clazz_name}'
 
+        def test_values_are_contiguous(args):
+            raw_tag = InputStream(bytearray([clz.clazz_id, 0, 4] +
+                                            list(b'Test') +
+                                            [0, 0, 0, len(test_vals)] +
+                                            [b for sublist in test_bins for b in sublist]))
+            parsed_tag = NBT.parse_nbt(raw_tag)
+            assert isinstance(parsed_tag.get(), array.array)
+            assert list(parsed_tag.get()) == test_vals
+            assert parsed_tag == clz('Test', values=test_vals)
+
+        def test_legacy_children_view(args):
+            tag = clz('Test', values=test_vals)
+            assert tag.children == [clz.clazz_sub_type(v) for v in test_vals]
+
     return TestArrayNBTTag
 
 
@@ -246,3 +267,222 @@ class TestCompoundNBTTag:
             ])
         ])
         assert parsed_tag == tag, 'Tag ListTag with ListTag elements'
+
+
+class TestLazyParsing:
+    def serialized_chunk(args):
+        stream = OutputStream()
+        build_chunk_nbt(3, 4).serialize(stream)
+        return stream.get_data()
+
+    def test_lazy_matches_eager(args):
+        data = args.serialized_chunk()
+        lazy_tag = NBT.parse_nbt(InputStream(data), lazy=True)
+        eager_tag = NBT.parse_nbt(InputStream(data))
+        assert lazy_tag == eager_tag
+
+    def test_children_parsed_on_access(args):
+        lazy_tag = NBT.parse_nbt(InputStream(args.serialized_chunk()), lazy=True)
+        level = lazy_tag.get('Level')
+        assert level.has('Heightmaps')
+        assert level.get('xPos').get() == 3
+        assert type(level._children['xPos']) is not _TagSpan
+        assert type(level._children['Heightmaps']) is _TagSpan
+
+    def test_untouched_children_written_verbatim(args):
+        data = args.serialized_chunk()
+        lazy_tag = NBT.parse_nbt(InputStream(data), lazy=True)
+        lazy_tag.get('Level').get('zPos')
+        stream = OutputStream()
+        lazy_tag.clone().serialize(stream)
+        assert stream.get_data() == data
+
+    def test_modified_children_are_reserialized(args):
+        lazy_tag = NBT.parse_nbt(InputStream(args.serialized_chunk()), lazy=True)
+        lazy_tag.get('Level').add_child(IntTag(9, tag_name='xPos'))
+        stream = OutputStream()
+        lazy_tag.serialize(stream)
+        reparsed = NBT.parse_nbt(InputStream(stream.get_data()))
+        assert reparsed.get('Level').get('xPos').get() == 9
+        assert reparsed.get('Level').get('zPos').get() == 4
+
+
+class TestEventReader:
+    def serialized(args, tag):
+        stream = OutputStream()
+        tag.serialize(stream)
+        return stream.get_data()
+
+    def test_events(args):
+        tag = CompoundTag(tag_name='Test', children=[
+            ByteTag(25, tag_name='dp1'),
+            ListTag(StringTag.clazz_id, tag_name='dp2', children=[StringTag('a'), StringTag('b')]),
+            IntArrayTag(tag_name='dp3', values=[1, 2]),
+        ])
+        events = list(NBT.iter_events(io.BytesIO(args.serialized(tag))))
+        assert [(e.path, e.tag_type, e.name) for e in events] == [
+            ((), TagType.COMPOUND, 'Test'),
+            (('dp1',), TagType.BYTE, 'dp1'),
+            (('dp2',), TagType.LIST, 'dp2'),
+            (('dp2', 0), TagType.STRING, None),
+            (('dp2', 1), TagType.STRING, None),
+            (('dp2',), TagType.END, 'dp2'),
+            (('dp3',), TagType.INT_ARRAY, 'dp3'),
+            ((), TagType.END, 'Test'),
+        ]
+        assert [e.value for e in events if e.tag_type in (TagType.BYTE, TagType.STRING)] == [25, 'a', 'b']
+        assert list(events[6].value) == [1, 2]
+
+    def test_skipping_subtrees(args):
+        data = args.serialized(build_chunk_nbt(3, 4))
+        reader = NBT.iter_events(io.BytesIO(data))
+        names = []
+        for event in reader:
+            if event.tag_type in (TagType.LIST, TagType.COMPOUND) and event.path[-1:] != ('Level',) and event.path:
+                reader.skip()
+            names.append(event.path)
+        assert ('Level', 'xPos') in names
+        assert ('Level', 'Sections') in names
+        assert not any(len(path) > 2 for path in names)
+
+    def test_reading_from_decompressor(args):
+        data = args.serialized(build_chunk_nbt(3, 4))
+        reader = DecompressingReader(io.BytesIO(gzip.compress(data)), wbits=DecompressingReader.GZIP, chunk_size=64)
+        values = {e.path: e.value for e in NBT.iter_events(reader) if e.tag_type == TagType.INT}
+        assert values[('Level', 'xPos')] == 3
+        assert values[('Level', 'zPos')] == 4
+
+    def test_skip_requires_open_container(args):
+        reader = NBT.iter_events(io.BytesIO(args.serialized(CompoundTag(tag_name='Test', children=[ByteTag(1, tag_name='b')]))))
+        next(reader)
+        next(reader)
+        with pytest.raises(ValueError):
+            reader.skip()
+
+
+class TestDeepNesting:
+    DEPTH = 20000
+
+    def nested_data(args):
+        # A compound holding DEPTH lists, each holding the next one
+        return bytes([10, 0, 4]) + b'Test' + \
+            bytes([9, 0, 4]) + b'deep' + bytes([9, 0, 0, 0, 1]) * (args.DEPTH - 1) + bytes([1, 0, 0, 0, 1, 7]) + \
+            bytes([0])
+
+    def test_parse_serialize_roundtrip(args):
+        data = args.nested_data()
+        tag = NBT.parse_nbt(InputStream(data))
+        stream = OutputStream()
+        tag.serialize(stream)
+        assert stream.get_data() == data
+
+    def test_clone_and_compare(args):
+        tag = NBT.parse_nbt(InputStream(args.nested_data()))
+        copy = tag.clone()
+        assert copy == tag
+        innermost = copy.get('deep')
+        for i in range(args.DEPTH - 1):
+            innermost = innermost.children[0]
+        innermost.children[0] = ByteTag(8)
+        assert copy != tag
+
+    def test_skipping(args):
+        stream = InputStream(args.nested_data())
+        NBT.parse_nbt(stream, lazy=True)
+        assert stream.pos == len(stream.buffer)
+
+
+class TestNBTPath:
+    def chunk(args):
+        stream = OutputStream()
+        build_chunk_nbt(3, 4, section_ys=(0, 1)).serialize(stream)
+        return stream.get_data()
+
+    def test_raw_and_parsed_agree(args):
+        data = args.chunk()
+        for query in ['Level.Sections[*].Palette[*].Name', 'Level.TileEntities[*].id', 'Level.xPos', 'Level.Sections[-1].Y',
+                      'Level.Biomes[2]', 'Level.*', 'Level.Missing[*].id', 'Level.xPos.Name']:
+            path = NBT.compile_path(query)
+            raw = path.search(data)
+            assert raw == path.search(NBT.parse_nbt(InputStream(data))), query
+            assert raw == path.search(NBT.parse_nbt(InputStream(data), lazy=True)), query
+
+    def test_values(args):
+        data = args.chunk()
+        assert NBT.compile_path('Level.Sections[*].Palette[*].Name').search(data) == \
+            ['minecraft:air', 'minecraft:stone', 'minecraft:dirt'] * 2
+        assert NBT.compile_path('Level.Sections[1].Y').search(data) == [1]
+        assert NBT.compile_path('Level.zPos').search(data) == [4]
+        assert NBT.compile_path('Level.Biomes[*]').search(data) == [1] * 1024
+        heightmaps, = NBT.compile_path('Level.Heightmaps').search(data)
+        assert heightmaps.has('MOTION_BLOCKING')
+
+    def test_modified_utf8_names(args):
+        name = 'a\x00\U0001F600'
+        stream = OutputStream()
+        CompoundTag(tag_name='', children=[CompoundTag(tag_name=name, children=[ByteTag(1, tag_name='b')])]).serialize(stream)
+        found, = NBT.compile_path(name).search(stream.get_data())
+        assert found.tag_name == name and found.get('b').get() == 1
+
+    def test_malformed_paths(args):
+        for query in ['Level..xPos', 'Level.Sections[a]', 'Level.Sections[*']:
+            with pytest.raises(ValueError):
+                NBT.compile_path(query)
+
+
+class TestCopyOnWriteClone:
+    def tree(args):
+        return CompoundTag(tag_name='Test', children=[
+            CompoundTag(tag_name='inner', children=[ByteTag(1, tag_name='b')]),
+            ListTag(IntTag.clazz_id, tag_name='list', children=[IntTag(1)]),
+            IntArrayTag(tag_name='array', values=[1, 2]),
+        ])
+
+    def test_clone_shares_children(args):
+        tag = args.tree()
+        copy = tag.clone()
+        assert copy._children is tag._children
+        assert copy == tag
+
+    def test_changes_to_clone_stay_private(args):
+        tag = args.tree()
+        copy = tag.clone()
+        copy.get('inner').add_child(ByteTag(2, tag_name='c'))
+        copy.get('list').add_child(IntTag(2))
+        copy.get('array').get()[0] = 5
+        copy.add_child(ByteTag(3, tag_name='d'))
+        assert tag == args.tree()
+        assert not tag.get('inner').has('c')
+        assert copy.get('inner').has('c')
+        assert list(copy.get('array').get()) == [5, 2]
+        assert copy.get('list').get() == [1, 2]
+
+    def test_changes_to_original_stay_private(args):
+        tag = args.tree()
+        copy = tag.clone()
+        tag.get('inner').get('b').tag_value = 9
+        tag.get('list').children.append(IntTag(2))
+        assert copy == args.tree()
+
+    def test_untouched_subtrees_stay_shared(args):
+        tag = args.tree()
+        inner = tag.get('inner')
+        copy = tag.clone()
+        copy.add_child(ByteTag(3, tag_name='d'))
+        assert copy.get('inner')._children is inner._children
+
+    def test_last_owner_stops_copying(args):
+        tag = args.tree()
+        children = tag._children
+        copy = tag.clone()
+        copy.add_child(ByteTag(3, tag_name='d'))
+        # The clone made its own copy, the original is the only owner left
+        tag.get('inner')
+        assert tag._children is children and tag._shared is None
+
+    def test_dropped_clone_releases_values(args):
+        tag = args.tree().get('array')
+        values = tag.values
+        copy = tag.clone()
+        del copy
+        assert tag.get() is values
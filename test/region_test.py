@@ -0,0 +1,332 @@
+import array
+import os
+from io import UnsupportedOperation
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import pytest
+
+from pyanvil.components import BlockState, ByteArrayTag, Chunk, Region
+from pyanvil.coordinate import AbsoluteCoordinate, ChunkCoordinate
+from pyanvil.utility import compression
+from pyanvil.utility.nbt import TagType
+from conftest import build_chunk_nbt
+
+
+class TestRegion:
+    def test_loading_chunk(args, region_file):
+        with Region(region_file) as region:
+            chunk = region.get_chunk(ChunkCoordinate(5, 7))
+            assert chunk.coordinate.x == 5
+            assert chunk.coordinate.z == 7
+
+    def test_chunk_events(args, region_file):
+        with Region(region_file) as region:
+            reader = region.iter_chunk_events(ChunkCoordinate(1, 0))
+            ids = [e.value for e in reader if e.path[-1:] == ('id',)]
+            assert ids == ['minecraft:chest']
+
+    def test_query(args, region_file):
+        with Region(region_file) as region:
+            results = region.query('Level.xPos')
+            assert results == {0: [0], 1: [1], 32: [0], 5 + 7 * 32: [5]}
+            assert region.chunks == {}
+
+    def test_only_requested_chunks_are_read(args, region_file):
+        # Corrupt every chunk except (0, 0), opening the region must not touch them
+        with Region(region_file) as region:
+            locations = [loc for i, loc in enumerate(region.chunk_locations) if i != 0 and loc[0] != 0]
+        with open(region_file, 'r+b') as f:
+            for offset, size in locations:
+                f.seek(offset + 5)
+                f.write(b'garbage')
+        with Region(region_file) as region:
+            assert region.get_chunk(ChunkCoordinate(0, 0)).coordinate.x == 0
+
+    def test_saving_grows_mapped_file(args, region_file):
+        with Region(region_file) as region:
+            chunk = region.get_chunk(ChunkCoordinate(0, 0))
+            for y in range(1, 8):
+                chunk.get_section(y * 16).mark_as_dirty()
+            region.save()
+            assert region.get_chunk(ChunkCoordinate(5, 7)).coordinate.z == 7
+        with Region(region_file) as region:
+            assert sorted(region.get_chunk(ChunkCoordinate(0, 0)).sections) == list(range(8))
+
+    def test_saving_in_place_leaves_other_chunks_alone(args, region_file):
+        before = region_file.read_bytes()
+        with Region(region_file) as region:
+            region.get_chunk(ChunkCoordinate(1, 0)).mark_as_dirty()
+            region.save()
+            offset, size = region.chunk_locations[1]
+        after = region_file.read_bytes()
+        assert len(after) == len(before)
+        # Only the chunk's own sectors and its timestamp changed
+        changed = {i // 4096 for i in range(len(after)) if after[i] != before[i]}
+        assert changed <= {1} | set(range(offset // 4096, (offset + size) // 4096))
+
+    def test_grown_chunk_moves_and_gap_is_reused(args, region_file):
+        with Region(region_file) as region:
+            chunk = region.get_chunk(ChunkCoordinate(0, 0))
+            chunk.raw_nbt.get('Level').add_child(ByteArrayTag(tag_name='Junk', values=array.array('b', os.urandom(3 * 4096))))
+            chunk.mark_as_dirty()
+            old_offset = region.chunk_locations[0][0]
+            size_before = region_file.stat().st_size
+            region.save()
+            offset, size = region.chunk_locations[0]
+            assert offset == size_before and size == 4 * 4096
+            assert region_file.stat().st_size == size_before + size
+
+            # Chunk 1 follows the freed sectors of chunk 0, grown to two sectors it fits across both
+            region.chunks.clear()
+            other = region.get_chunk(ChunkCoordinate(1, 0))
+            other.raw_nbt.get('Level').add_child(ByteArrayTag(tag_name='Junk', values=array.array('b', os.urandom(5000))))
+            other.mark_as_dirty()
+            region.save()
+            assert region.chunk_locations[1][0] == old_offset
+        with Region(region_file) as region:
+            assert region.get_chunk(ChunkCoordinate(0, 0)).raw_nbt.get('Level').has('Junk')
+            assert region.get_chunk(ChunkCoordinate(1, 0)).raw_nbt.get('Level').has('Junk')
+            assert region.get_chunk(ChunkCoordinate(5, 7)).coordinate.z == 7
+
+    def test_new_chunk_is_appended(args, region_file):
+        with Region(region_file) as region:
+            region.chunks[40] = Chunk(ChunkCoordinate(8, 1), {}, build_chunk_nbt(8, 1), orig_size=0, parent_region=region)
+            region.chunks[40].mark_as_dirty()
+            region.save()
+        with Region(region_file) as region:
+            assert region.get_chunk(ChunkCoordinate(8, 1)).coordinate.x == 8
+
+    @pytest.mark.parametrize('pool', [ThreadPoolExecutor, ProcessPoolExecutor])
+    def test_saving_with_executor(args, region_file, pool):
+        with Region(region_file) as region:
+            for coord in [ChunkCoordinate(0, 0), ChunkCoordinate(1, 0), ChunkCoordinate(5, 7)]:
+                region.get_chunk(coord).get_section(16).mark_as_dirty()
+            expected = {index: chunk.package_and_compress() for index, chunk in region.chunks.items()}
+            with pool(max_workers=2) as executor:
+                region.save(executor=executor)
+            for index, payload in expected.items():
+                offset, size = region.chunk_locations[index]
+                with open(region_file, 'rb') as f:
+                    f.seek(offset + 5)
+                    assert f.read(len(payload)) == payload
+        with Region(region_file) as region:
+            assert sorted(region.get_chunk(ChunkCoordinate(5, 7)).sections) == [0, 1]
+
+    def test_only_dirty_chunks_are_saved(args, region_file):
+        before = region_file.read_bytes()
+        with Region(region_file) as region:
+            for coord in [ChunkCoordinate(0, 0), ChunkCoordinate(1, 0), ChunkCoordinate(5, 7)]:
+                region.get_chunk(coord)
+            assert not region.is_dirty
+            region.save()
+        assert region_file.read_bytes() == before
+
+        with Region(region_file) as region:
+            region.get_chunk(ChunkCoordinate(0, 0))
+            block = region.get_chunk(ChunkCoordinate(1, 0)).get_block(AbsoluteCoordinate(16, 0, 0))
+            block.set_state(BlockState('minecraft:diamond_block', {}))
+            timestamps = list(region.timestamps)
+        after = region_file.read_bytes()
+        assert after[:4] == before[:4] and after[4096:4100] == before[4096:4100]
+        assert after[4100:4104] != before[4100:4104]
+
+        with Region(region_file) as region:
+            assert region.timestamps[0] == timestamps[0] == 1000
+            chunk = region.get_chunk(ChunkCoordinate(1, 0))
+            assert chunk.get_block(AbsoluteCoordinate(16, 0, 0)).get_state().name == 'minecraft:diamond_block'
+            assert not chunk.is_dirty and not region.is_dirty
+
+    def test_saving_clears_dirty_state(args, region_file):
+        with Region(region_file) as region:
+            chunk = region.get_chunk(ChunkCoordinate(0, 0))
+            chunk.get_block(AbsoluteCoordinate(0, 0, 0)).set_state(BlockState('minecraft:stone', {}))
+            section = chunk.sections[0]
+            assert region.is_dirty and chunk.is_dirty and section.is_dirty
+            region.save()
+            assert not region.is_dirty and not chunk.is_dirty and not section.is_dirty
+            assert not region._dirty_children and not chunk._dirty_children
+
+    @pytest.mark.parametrize('scheme', ['gzip', 'none'])
+    def test_saving_with_compression_scheme(args, region_file, scheme):
+        with Region(region_file, compression_scheme=scheme) as region:
+            region.get_chunk(ChunkCoordinate(5, 7)).get_section(16).mark_as_dirty()
+            region.save()
+            offset = region.chunk_locations[5 + 7 * 32][0]
+        with open(region_file, 'rb') as f:
+            f.seek(offset + 4)
+            assert f.read(1)[0] == compression.get_codec(scheme).scheme
+        with Region(region_file) as region:
+            assert sorted(region.get_chunk(ChunkCoordinate(5, 7)).sections) == [0, 1]
+            assert region.query('Level.zPos')[5 + 7 * 32] == [7]
+            ids = [e.value for e in region.iter_chunk_events(ChunkCoordinate(5, 7)) if e.path[-1:] == ('id',)]
+            assert ids == ['minecraft:chest']
+
+    def test_oversized_chunks_go_to_external_file(args, region_file, monkeypatch):
+        external = region_file.parent / 'c.5.7.mcc'
+        with Region(region_file) as region:
+            monkeypatch.setattr(Region, 'MAX_CHUNK_SECTORS', 0)
+            region.get_chunk(ChunkCoordinate(5, 7)).get_section(16).mark_as_dirty()
+            region.save()
+            assert region.chunk_locations[5 + 7 * 32][1] == 4096
+        assert external.exists()
+        with Region(region_file) as region:
+            chunk = region.get_chunk(ChunkCoordinate(5, 7))
+            assert sorted(chunk.sections) == [0, 1]
+            assert region.query('Level.xPos')[5 + 7 * 32] == [5]
+
+            # Once it fits again the external file is removed
+            monkeypatch.undo()
+            chunk.mark_as_dirty()
+            region.save()
+        assert not external.exists()
+        with Region(region_file) as region:
+            assert sorted(region.get_chunk(ChunkCoordinate(5, 7)).sections) == [0, 1]
+
+    def test_region_coordinate(args, tmp_path):
+        path = tmp_path / 'r.-3.12.mca'
+        path.write_bytes(b'')
+        with Region(path) as region:
+            coord = region.region_coordinate
+            assert (coord.x, coord.z) == (-3, 12)
+
+    def test_header(args, region_file):
+        with Region(region_file) as region:
+            header = region.header
+            assert header.chunk_indexes == [0, 1, 32, 5 + 7 * 32]
+            assert header.chunk_count == 4
+            assert header.has_chunk(5, 7) and not header.has_chunk(7, 5)
+            assert header.presence_rows[7][5] == 1 and sum(map(sum, header.presence_rows)) == 4
+            assert [header.offsets[i] for i in header.chunk_indexes] == [2, 3, 4, 5]
+            assert [header.sector_counts[i] for i in header.chunk_indexes] == [1, 1, 1, 1]
+            assert [header.timestamps[i] for i in header.chunk_indexes] == [1000, 1001, 1032, 1229]
+            assert region.chunk_locations[1] == [3 * 4096, 4096]
+
+    def test_header_follows_saves(args, region_file):
+        with Region(region_file) as region:
+            chunk = region.get_chunk(ChunkCoordinate(0, 0))
+            chunk.raw_nbt.get('Level').add_child(ByteArrayTag(tag_name='Junk', values=array.array('b', os.urandom(5000))))
+            chunk.mark_as_dirty()
+            region.save()
+            header = region.header
+            assert (header.offsets[0], header.sector_counts[0]) == (6, 2)
+            assert header.timestamps[0] == region.timestamps[0]
+
+    def test_append_only_saves(args, region_file):
+        before = region_file.read_bytes()
+        with Region(region_file, append_only=True) as region:
+            chunk = region.get_chunk(ChunkCoordinate(1, 0))
+            chunk.get_block(AbsoluteCoordinate(16, 0, 0)).set_state(BlockState('minecraft:diamond_block', {}))
+            region.save()
+            assert region.chunk_locations[1][0] == len(before)
+            chunk.get_block(AbsoluteCoordinate(17, 0, 0)).set_state(BlockState('minecraft:gold_block', {}))
+            region.save()
+            assert region.chunk_locations[1][0] == len(before) + 4096
+            # Two dead sectors out of eight: the original and the first new version of chunk 1
+            assert region.dead_space_ratio == 2 / 8
+        after = region_file.read_bytes()
+        assert after[8192:len(before)] == before[8192:]
+        with Region(region_file) as region:
+            chunk = region.get_chunk(ChunkCoordinate(1, 0))
+            assert chunk.get_block(AbsoluteCoordinate(16, 0, 0)).get_state().name == 'minecraft:diamond_block'
+            assert chunk.get_block(AbsoluteCoordinate(17, 0, 0)).get_state().name == 'minecraft:gold_block'
+
+    def test_compact(args, region_file):
+        with Region(region_file, append_only=True) as region:
+            for coord in [ChunkCoordinate(0, 0), ChunkCoordinate(5, 7)]:
+                region.get_chunk(coord).mark_as_dirty()
+            region.save()
+            timestamps = list(region.timestamps)
+            assert region_file.stat().st_size == 8 * 4096
+            region.compact()
+            assert region_file.stat().st_size == 6 * 4096
+            assert region.dead_space_ratio == 0
+            assert [region.chunk_locations[i][0] // 4096 for i in (0, 1, 32, 5 + 7 * 32)] == [2, 3, 4, 5]
+            assert region.timestamps == timestamps
+            assert region.get_chunk(ChunkCoordinate(0, 1)).coordinate.z == 1
+        assert not region_file.with_name('r.0.0.mca.tmp').exists()
+        with Region(region_file) as region:
+            assert region.header.timestamps.tolist() == timestamps
+            assert region.query('Level.xPos') == {0: [0], 1: [1], 32: [0], 5 + 7 * 32: [5]}
+
+    def test_compact_threshold(args, region_file):
+        with Region(region_file, append_only=True, compact_threshold=0.3) as region:
+            region.get_chunk(ChunkCoordinate(0, 0)).mark_as_dirty()
+            region.save()
+            assert region_file.stat().st_size == 7 * 4096
+            region.get_chunk(ChunkCoordinate(0, 0)).mark_as_dirty()
+            region.get_chunk(ChunkCoordinate(1, 0)).mark_as_dirty()
+            region.save()
+            assert region_file.stat().st_size == 6 * 4096
+
+    def test_optimize(args, region_file):
+        with Region(region_file) as region:
+            chunk = region.get_chunk(ChunkCoordinate(1, 0))
+            chunk.raw_nbt.get('Level').add_child(ByteArrayTag(tag_name='Junk', values=array.array('b', os.urandom(5000))))
+            chunk.mark_as_dirty()
+            region.save()
+            assert region_file.stat().st_size == 8 * 4096
+            assert region.optimize(order=Region.ORDER_MORTON) == 4096
+            # Morton order puts (0, 1) before (5, 7)
+            assert [region.chunk_locations[i][0] // 4096 for i in (0, 1, 32, 5 + 7 * 32)] == [2, 3, 5, 6]
+            assert region.optimize() == 0
+            assert [region.chunk_locations[i][0] // 4096 for i in (0, 1, 32, 5 + 7 * 32)] == [2, 3, 5, 6]
+            with pytest.raises(ValueError):
+                region.optimize(order='hilbert')
+        with Region(region_file) as region:
+            assert region.get_chunk(ChunkCoordinate(1, 0)).raw_nbt.get('Level').has('Junk')
+
+    def test_morton_key(args):
+        assert [Region.morton_key(i) for i in (0, 1, 32, 33, 2, 1023)] == [0, 1, 2, 3, 4, 1023]
+
+    def test_prefetch(args, region_file, monkeypatch):
+        reads = []
+        with Region(region_file) as region:
+            loaded = region.get_chunk(ChunkCoordinate(1, 0))
+            original = Region._Region__read_payloads
+            monkeypatch.setattr(Region, '_Region__read_payloads', lambda self, indexes: reads.append(indexes) or original(self, indexes))
+            coords = [ChunkCoordinate(5, 7), ChunkCoordinate(0, 1), ChunkCoordinate(1, 0), ChunkCoordinate(9, 9), ChunkCoordinate(0, 0)]
+            chunks = region.prefetch(coords)
+            # Missing chunks are skipped, loaded chunks are not read again, the rest is read in file order
+            assert [(c.coordinate.x, c.coordinate.z) for c in chunks] == [(5, 7), (0, 1), (1, 0), (0, 0)]
+            assert chunks[2] is loaded
+            assert reads == [[0, 32, 5 + 7 * 32]]
+            assert region.get_chunk(ChunkCoordinate(0, 1)) is chunks[1]
+            assert sorted(chunks[0].sections) == [0]
+
+    def test_prefetch_shares_default_pool(args, region_file):
+        from pyanvil.components import region as region_module
+        pools = []
+        for coords in [[ChunkCoordinate(0, 0), ChunkCoordinate(1, 0)], [ChunkCoordinate(0, 1), ChunkCoordinate(5, 7)]]:
+            with Region(region_file) as region:
+                assert len(region.prefetch(coords)) == 2
+            pools.append(region_module._decompress_pool)
+        assert pools[0] is not None and pools[0] is pools[1]
+
+    def test_prefetch_on_process_pool(args, region_file):
+        with Region(region_file) as region, ProcessPoolExecutor(2) as executor:
+            chunks = region.prefetch([ChunkCoordinate(0, 0), ChunkCoordinate(5, 7)], executor=executor)
+            assert [(c.coordinate.x, c.coordinate.z) for c in chunks] == [(0, 0), (5, 7)]
+
+    def test_prefetch_merges_neighbouring_chunks(args, region_file):
+        with Region(region_file) as region:
+            payloads = region._Region__read_payloads([0, 1, 32, 5 + 7 * 32])
+            assert sorted(payloads) == [0, 1, 32, 5 + 7 * 32]
+            # All four chunks are in one run, their payloads are views of the same read
+            assert len({id(payload.obj) for scheme, payload in payloads.values()}) == 1
+
+    def test_read_only(args, region_file):
+        size = os.path.getsize(region_file)
+        with Region(region_file, read_only=True) as region:
+            chunk = region.get_chunk(ChunkCoordinate(0, 0))
+            block = chunk.get_block(AbsoluteCoordinate(1, 0, 0))
+            assert block.get_state().name == 'minecraft:stone'
+            # Clean components never allocate a dirty set
+            assert region._dirty_children is None and chunk._dirty_children is None
+            with pytest.raises(UnsupportedOperation):
+                block.set_state(BlockState('minecraft:dirt', {}))
+            assert block.get_state().name == 'minecraft:stone' and not region.is_dirty
+            with pytest.raises(UnsupportedOperation):
+                region.save()
+            with pytest.raises(UnsupportedOperation):
+                region.optimize()
+        assert os.path.getsize(region_file) == size
@@ -1,4 +1,11 @@
-from pyanvil.stream import InputStream, OutputStream
+import array
+import gzip
+import io
+import zlib
+
+import pytest
+
+from pyanvil.stream import DecompressingReader, FileInputStream, InputStream, OutputStream
 
 
 class TestInputStream:
@@ -18,6 +25,33 @@ class TestInputStream:
         assert read_hello == b'Hello'
         assert peek_space == 32
 
+    def test_typed_readers(args):
+        stream = InputStream(bytes([0xff, 0xff, 0x80, 0x00, 0, 0, 0, 5, 0, 0, 0, 0, 0, 0, 1, 0, 63, 192, 0, 0]))
+        assert stream.read_i8() == -1
+        assert stream.read_u8() == 255
+        assert stream.read_i16() == -2**15
+        assert stream.read_i32() == 5
+        assert stream.read_i64() == 256
+        assert stream.read_f32() == 1.5
+        assert stream.pos == 20
+
+    def test_reading_string(args):
+        stream = InputStream(b'\x00\x05Hello World')
+        assert stream.read_string() == 'Hello'
+        assert stream.peek() == 32
+
+    def test_reading_array(args):
+        stream = InputStream(bytes([0, 0, 0, 1, 0xff, 0xff, 0xff, 0xfe, 7]))
+        assert list(stream.read_array('i', 2)) == [1, -2]
+        assert list(stream.read_array('b', 1)) == [7]
+
+    def test_reading_does_not_copy(args):
+        data = bytearray(b'Hello World')
+        stream = InputStream(data)
+        view = stream.read(5)
+        data[0] = ord('J')
+        assert view == b'Jello'
+
 
 class TestOutputStream:
 
@@ -26,3 +60,67 @@ class TestOutputStream:
         stream.write(b'Hello World')
         stream_data = stream.get_data()
         assert stream_data == b'Hello World'
+
+    def test_typed_writers(args):
+        stream = OutputStream()
+        stream.write_i8(-1).write_u8(255).write_i16(-2**15).write_i32(5).write_i64(256).write_f32(1.5)
+        assert stream.get_data() == bytes([0xff, 0xff, 0x80, 0x00, 0, 0, 0, 5, 0, 0, 0, 0, 0, 0, 1, 0, 63, 192, 0, 0])
+
+    def test_writing_string(args):
+        stream = OutputStream()
+        stream.write_string('Hello')
+        assert stream.get_data() == b'\x00\x05Hello'
+
+    def test_writing_array(args):
+        stream = OutputStream()
+        stream.write_array(array.array('i', [1, -2]))
+        assert stream.get_data() == bytes([0, 0, 0, 1, 0xff, 0xff, 0xff, 0xfe])
+
+    def test_getbuffer_does_not_copy(args):
+        stream = OutputStream()
+        stream.write(b'Hello World')
+        with stream.getbuffer() as view:
+            assert view == b'Hello World'
+            assert view.obj is stream.buffer
+
+
+class TestFileInputStream:
+
+    def test_reading_across_windows(args):
+        stream = FileInputStream(io.BytesIO(b'\x00\x05Hello\x00\x00\x00\x07 World'), buffer_size=3)
+        assert stream.read_string() == 'Hello'
+        assert stream.read_i32() == 7
+        assert stream.peek() == 32
+        stream.skip(1)
+        assert stream.read(5) == b'World'
+        assert stream.pos == 17
+
+    def test_skipping_past_window(args):
+        stream = FileInputStream(io.BytesIO(bytes(100) + b'\x01'), buffer_size=8)
+        stream.read_u8()
+        stream.skip(99)
+        assert stream.read_u8() == 1
+
+    def test_unexpected_end(args):
+        stream = FileInputStream(io.BytesIO(b'\x00'))
+        with pytest.raises(EOFError):
+            stream.read_i32()
+
+
+class TestDecompressingReader:
+
+    def test_reading_in_pieces(args):
+        data = bytes(range(256)) * 64
+        reader = DecompressingReader(zlib.compress(data), chunk_size=16)
+        parts = []
+        while True:
+            part = reader.read(1000)
+            if not part:
+                break
+            assert len(part) <= 1000
+            parts.append(part)
+        assert b''.join(parts) == data
+
+    def test_gzip(args):
+        reader = DecompressingReader(io.BytesIO(gzip.compress(b'Hello World')), wbits=DecompressingReader.GZIP)
+        assert reader.read() == b'Hello World'
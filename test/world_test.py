@@ -1,5 +1,13 @@
-from pyanvil import BlockState, World
-from pyanvil.coordinate import AbsoluteCoordinate
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from io import UnsupportedOperation
+
+import pytest
+
+from pyanvil import BlockState, Volume, World
+from pyanvil.components import Chunk
+from pyanvil.coordinate import AbsoluteCoordinate, ChunkCoordinate, RegionCoordinate
+from pyanvil.utility.file_pool import RegionFilePool
 
 
 def test_block_place():
@@ -19,3 +27,318 @@ def test_block_place():
         # Get the block object at the given location
         myBlock = myWorld.get_block(myBlockPos)
         assert myBlock.get_state().name == 'minecraft:diamond_block'
+
+
+def test_reading_missing_section_leaves_file_alone(world_folder):
+    region_file = world_folder / 'region' / 'r.0.0.mca'
+    data = region_file.read_bytes()
+    with World(world_folder) as world:
+        assert world.get_block(AbsoluteCoordinate(0, 100, 0)).get_state().name == 'minecraft:air'
+        assert not world.get_region(RegionCoordinate(0, 0)).is_dirty
+    assert region_file.read_bytes() == data
+
+    with World(world_folder) as world:
+        world.get_chunk(ChunkCoordinate(0, 0)).get_section(100)
+        world.get_block(AbsoluteCoordinate(0, 0, 0)).set_state(BlockState('minecraft:gold_block', {}))
+    with World(world_folder) as world:
+        # The untouched placeholder section was not stored along with the changed chunk
+        assert sorted(world.get_chunk(ChunkCoordinate(0, 0)).sections) == [0, 1]
+        world.get_block(AbsoluteCoordinate(0, 100, 0)).set_state(BlockState('minecraft:diamond_block', {}))
+    with World(world_folder) as world:
+        assert sorted(world.get_chunk(ChunkCoordinate(0, 0)).sections) == [0, 1, 6]
+        assert world.get_block(AbsoluteCoordinate(0, 100, 0)).get_state().name == 'minecraft:diamond_block'
+
+
+def test_region_index(world_folder):
+    with World(world_folder) as world:
+        index = world.region_index()
+        assert set(index) == {RegionCoordinate(0, 0), RegionCoordinate(-1, 0)}
+        assert index[RegionCoordinate(0, 0)].chunk_indexes == [0, 1, 32, 33]
+        assert index[RegionCoordinate(-1, 0)].has_chunk(-1, 0)
+        assert world.regions == {}
+
+
+def test_optimize(world_folder):
+    region_file = world_folder / 'region' / 'r.0.0.mca'
+    with open(region_file, 'ab') as f:
+        f.write(bytes(3 * 4096))
+    with World(world_folder) as world:
+        assert world.optimize(order='morton') == 3 * 4096
+        assert world.get_chunk(ChunkCoordinate(1, 1)).coordinate.x == 1
+
+
+def test_prefetch(world_folder):
+    with World(world_folder) as world:
+        chunks = world.prefetch(AbsoluteCoordinate(-16, 0, 0), AbsoluteCoordinate(31, 255, 40))
+        assert sorted((c.coordinate.x, c.coordinate.z) for c in chunks) == [(-1, 0), (0, 0), (0, 1), (1, 0), (1, 1)]
+        assert world.get_chunk(ChunkCoordinate(1, 1)) in chunks
+
+
+def test_chunk_cache(world_folder):
+    with World(world_folder, max_chunks=2) as world:
+        first = world.get_chunk(ChunkCoordinate(0, 0))
+        assert world.get_chunk(ChunkCoordinate(0, 0)) is first
+        assert (world.hits, world.misses) == (1, 1)
+        world.get_block(AbsoluteCoordinate(16, 0, 0)).set_state(BlockState('minecraft:diamond_block', {}))
+        world.get_chunk(ChunkCoordinate(0, 1))
+        world.get_chunk(ChunkCoordinate(1, 1))
+        # (0, 0) and then the dirty (1, 0) were least recently used
+        assert world.cache_stats == {'hits': 1, 'misses': 4, 'evictions': 2, 'write_backs': 1, 'regions': 1, 'chunks': 2}
+        region = world.get_region(RegionCoordinate(0, 0))
+        assert sorted(region.chunks) == [32, 33] and not region.is_dirty
+        # The evicted chunk is still referenced here, so it is handed out again instead of a copy from disk
+        assert world.get_chunk(ChunkCoordinate(0, 0)) is first
+        assert world.get_block(AbsoluteCoordinate(16, 0, 0)).get_state().name == 'minecraft:diamond_block'
+
+
+def test_evicted_chunk_is_written_back_alone(world_folder):
+    with World(world_folder, max_chunks=2) as world:
+        world.get_block(AbsoluteCoordinate(0, 0, 0)).set_state(BlockState('minecraft:diamond_block', {}))
+        world.get_block(AbsoluteCoordinate(16, 0, 0)).set_state(BlockState('minecraft:gold_block', {}))
+        world.get_chunk(ChunkCoordinate(0, 1))
+        # Only (0, 0) was written back, (1, 0) is still dirty in the cache
+        region = world.get_region(RegionCoordinate(0, 0))
+        assert world.write_backs == 1
+        assert sorted(region.chunks) == [1, 32] and region.is_dirty
+        assert region.chunks[1].is_dirty
+    with World(world_folder) as world:
+        assert world.get_block(AbsoluteCoordinate(0, 0, 0)).get_state().name == 'minecraft:diamond_block'
+        assert world.get_block(AbsoluteCoordinate(16, 0, 0)).get_state().name == 'minecraft:gold_block'
+
+
+def test_evicted_chunks_stay_the_same_instance(world_folder):
+    with World(world_folder, max_chunks=1) as world:
+        chunks = world.prefetch(AbsoluteCoordinate(0, 0, 0), AbsoluteCoordinate(31, 0, 0))
+        assert [(c.coordinate.x, c.coordinate.z) for c in chunks] == [(0, 0), (1, 0)]
+        for chunk in chunks:
+            chunk.get_block(AbsoluteCoordinate(chunk.coordinate.x * 16, 0, 0)).set_state(BlockState('minecraft:gold_block', {}))
+        first = world.get_chunk(ChunkCoordinate(0, 0))
+        assert first is chunks[0]
+        assert first.get_block(AbsoluteCoordinate(0, 0, 0)).get_state().name == 'minecraft:gold_block'
+        assert world.get_chunk(ChunkCoordinate(1, 0)) is chunks[1]
+    with World(world_folder) as world:
+        assert world.get_block(AbsoluteCoordinate(0, 0, 0)).get_state().name == 'minecraft:gold_block'
+        assert world.get_block(AbsoluteCoordinate(16, 0, 0)).get_state().name == 'minecraft:gold_block'
+
+
+def test_region_cache(world_folder):
+    with World(world_folder, max_regions=1) as world:
+        world.get_block(AbsoluteCoordinate(-16, 0, 0)).set_state(BlockState('minecraft:gold_block', {}))
+        world.get_chunk(ChunkCoordinate(0, 0))
+        assert list(world.regions) == [RegionCoordinate(0, 0)]
+        assert (world.evictions, world.write_backs) == (1, 1)
+        assert world.get_block(AbsoluteCoordinate(-16, 0, 0)).get_state().name == 'minecraft:gold_block'
+        assert list(world.regions) == [RegionCoordinate(-1, 0)]
+
+
+def test_read_box(world_folder):
+    with World(world_folder) as world:
+        volume = world.read_box(AbsoluteCoordinate(20, 40, 3), AbsoluteCoordinate(-3, 10, 18), light=True)
+        assert volume.size == (24, 31, 16)
+        for x, y, z in [(-3, 10, 3), (0, 15, 5), (15, 16, 15), (16, 31, 16), (20, 40, 18), (-1, 20, 10)]:
+            state = volume.get_state(x + 3, y - 10, z - 3)
+            assert state == world.get_block(AbsoluteCoordinate(x, y, z)).get_state()
+        # Sections 0 and 1 exist, above them is air
+        assert volume.get_state(5, 22, 5).name == 'minecraft:air'
+        assert volume.get_state(5, 21, 5).name != 'minecraft:air'
+        assert volume.sky_light[volume.index(5, 5, 5)] == 15 and volume.block_light[volume.index(5, 5, 5)] == 0
+        assert volume.sky_light[volume.index(5, 25, 5)] == 0
+
+
+def test_write_box(world_folder):
+    volume = Volume((20, 3, 2))
+    for x in range(20):
+        volume.set_state(x, 1, 1, BlockState('minecraft:gold_block', {}))
+    volume.set_state(0, 0, 0, BlockState('minecraft:oak_log', {'axis': 'x'}))
+    with World(world_folder) as world:
+        world.write_box(AbsoluteCoordinate(5, 26, 7), volume)
+    with World(world_folder) as world:
+        assert world.get_block(AbsoluteCoordinate(5, 26, 7)).get_state() == BlockState('minecraft:oak_log', {'axis': 'x'})
+        assert world.get_block(AbsoluteCoordinate(24, 27, 8)).get_state().name == 'minecraft:gold_block'
+        assert world.get_block(AbsoluteCoordinate(6, 26, 7)).get_state().name == 'minecraft:air'
+        assert world.get_block(AbsoluteCoordinate(4, 27, 8)).get_state().name == 'minecraft:dirt'
+        back = world.read_box(AbsoluteCoordinate(5, 26, 7), AbsoluteCoordinate(24, 28, 8))
+        assert [back.palette[i] for i in back.indices] == [volume.palette[i] for i in volume.indices]
+
+
+def test_write_box_needs_existing_chunks(world_folder):
+    with World(world_folder) as world:
+        with pytest.raises(ValueError):
+            world.write_box(AbsoluteCoordinate(30, 0, 0), Volume((4, 1, 1)))
+        assert not world.get_region(RegionCoordinate(0, 0)).is_dirty
+
+
+def count_stone(chunk, section):
+    indices, palette = section.palette_indices()
+    stone = [i for i, state in enumerate(palette) if state.name == 'minecraft:stone']
+    return sum(indices.count(i) for i in stone)
+
+
+def chunk_position(chunk):
+    if chunk.coordinate.x == 1 and chunk.coordinate.z == 1:
+        raise RuntimeError('broken chunk')
+    return (chunk.coordinate.x, chunk.coordinate.z)
+
+
+def add(a, b):
+    return a + b
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_map_regions(world_folder, workers):
+    seen = []
+    with World(world_folder) as world:
+        result = world.map_regions(count_stone, reduce=add, per='section', workers=workers,
+                                   progress=lambda done, total: seen.append((done, total)))
+        # 9 sections of 4096 blocks, every third block is stone
+        assert result.value == 9 * 1365 and result.errors == []
+        assert seen == [(1, 2), (2, 2)]
+
+        result = world.map_regions(chunk_position, workers=workers)
+        assert result.value == [(-1, 0), (0, 0), (1, 0), (0, 1)]
+        error, = result.errors
+        assert (error.x, error.z, error.region) == (1, 1, str(world_folder / 'region' / 'r.0.0.mca'))
+        assert 'broken chunk' in error.error and 'RuntimeError' in error.traceback
+        assert world.regions == {}
+
+
+def test_map_regions_sees_unsaved_changes(world_folder):
+    with World(world_folder) as world:
+        world.get_block(AbsoluteCoordinate(1, 0, 0)).set_state(BlockState('minecraft:air', {}))
+        assert world.map_regions(count_stone, reduce=add, per='section', workers=1).value == 9 * 1365 - 1
+        # The in-process worker leaves the world's pooled file open
+        assert world_folder / 'region' / 'r.0.0.mca' in world.file_pool
+        assert not world.get_region(RegionCoordinate(0, 0)).is_dirty
+
+
+def test_iter_regions(world_folder):
+    with World(world_folder) as world:
+        kept = world.get_region(RegionCoordinate(0, 0))
+        coords = []
+        for region in world.iter_regions():
+            coords.append(region.region_coordinate)
+            assert region.region_coordinate in world.regions
+        assert coords == [RegionCoordinate(-1, 0), RegionCoordinate(0, 0)]
+        # Only the region that was loaded before stays
+        assert list(world.regions.values()) == [kept]
+
+
+def test_iter_chunks(world_folder):
+    with World(world_folder) as world:
+        positions = []
+        for chunk in world.iter_chunks():
+            positions.append((chunk.coordinate.x, chunk.coordinate.z))
+            assert sum(len(r.chunks) for r in world.regions.values()) == 1
+        # File order, the fixture writes the chunks of r.0.0 column by column
+        assert positions == [(-1, 0), (0, 0), (0, 1), (1, 0), (1, 1)]
+        assert world.regions == {}
+
+        box = (AbsoluteCoordinate(40, 0, 0), AbsoluteCoordinate(16, 0, 31))
+        assert [(c.coordinate.x, c.coordinate.z) for c in world.iter_chunks(box)] == [(1, 0), (1, 1)]
+
+
+def test_iter_chunks_keeps_dirty_chunks(world_folder):
+    with World(world_folder) as world:
+        for chunk in world.iter_chunks():
+            if chunk.coordinate.x == 1 and chunk.coordinate.z == 0:
+                chunk.get_block(AbsoluteCoordinate(16, 0, 0)).set_state(BlockState('minecraft:gold_block', {}))
+        region, = world.regions.values()
+        assert list(region.chunks) == [1]
+    with World(world_folder) as world:
+        assert world.get_block(AbsoluteCoordinate(16, 0, 0)).get_state().name == 'minecraft:gold_block'
+
+
+def test_iter_chunks_only_opens_regions_in_box(world_folder):
+    pool = RegionFilePool()
+    with World(world_folder, file_pool=pool) as world:
+        box = (AbsoluteCoordinate(0, 0, 0), AbsoluteCoordinate(15, 0, 15))
+        assert [(c.coordinate.x, c.coordinate.z) for c in world.iter_chunks(box)] == [(0, 0)]
+        assert pool.misses == 1 and world.misses == 0
+
+
+def test_iter_chunks_bounds_dirty_chunks(world_folder):
+    with World(world_folder, max_chunks=2) as world:
+        for chunk in world.iter_chunks():
+            chunk.get_block(AbsoluteCoordinate(chunk.coordinate.x * 16, 0, chunk.coordinate.z * 16)).set_state(
+                BlockState('minecraft:gold_block', {}))
+            # The cached chunks and the one being visited
+            assert sum(len(r.chunks) for r in world.regions.values()) <= 3
+        assert world.write_backs == 3
+    with World(world_folder) as world:
+        assert world.get_block(AbsoluteCoordinate(-16, 0, 0)).get_state().name == 'minecraft:gold_block'
+        assert world.get_block(AbsoluteCoordinate(16, 0, 16)).get_state().name == 'minecraft:gold_block'
+
+
+def test_iter_sections(world_folder):
+    with World(world_folder) as world:
+        sections = [(c.coordinate.x, c.coordinate.z, s.y_index) for c, s in world.iter_sections()]
+        assert len(sections) == 9 and sections[:3] == [(-1, 0, 0), (0, 0, 0), (0, 0, 1)]
+        box = (AbsoluteCoordinate(0, 16, 0), AbsoluteCoordinate(0, 20, 0))
+        assert [(c.coordinate.x, c.coordinate.z, s.y_index) for c, s in world.iter_sections(box)] == [(0, 0, 1)]
+
+
+def test_read_only_world(world_folder):
+    region_file = world_folder / 'region' / 'r.0.0.mca'
+    data = region_file.read_bytes()
+    with World(world_folder, write=False) as world:
+        block = world.get_block(AbsoluteCoordinate(1, 0, 0))
+        assert block.get_state().name == 'minecraft:stone'
+        with pytest.raises(UnsupportedOperation):
+            block.set_state(BlockState('minecraft:dirt', {}))
+        with pytest.raises(UnsupportedOperation):
+            world.write_box(AbsoluteCoordinate(0, 0, 0), Volume((1, 1, 1)))
+        with pytest.raises(UnsupportedOperation):
+            world.optimize()
+    assert region_file.read_bytes() == data
+
+
+def test_read_only_world_threads(world_folder):
+    corners = (AbsoluteCoordinate(0, 0, 0), AbsoluteCoordinate(31, 31, 31))
+    with World(world_folder, write=False, max_chunks=2) as world:
+        expected = world.read_box(*corners).indices
+        with ThreadPoolExecutor(8) as executor:
+            volumes = list(executor.map(lambda _: world.read_box(*corners), range(16)))
+        assert all(volume.indices == expected for volume in volumes)
+
+
+def test_read_only_world_loads_chunks_concurrently(world_folder, monkeypatch):
+    # Both threads have to be loading a chunk at the same time to get past the barrier
+    barrier = threading.Barrier(2, timeout=5)
+    from_payload = Chunk.from_payload
+
+    def waiting_from_payload(*args, **kwargs):
+        barrier.wait()
+        return from_payload(*args, **kwargs)
+
+    monkeypatch.setattr(Chunk, 'from_payload', staticmethod(waiting_from_payload))
+    with World(world_folder, write=False) as world, ThreadPoolExecutor(2) as executor:
+        chunks = list(executor.map(world.get_chunk, [ChunkCoordinate(0, 0), ChunkCoordinate(1, 1)]))
+        assert [(c.coordinate.x, c.coordinate.z) for c in chunks] == [(0, 0), (1, 1)]
+
+
+def test_iter_chunks_next_to_get_block(world_folder):
+    with World(world_folder, write=False) as world:
+        chunks = world.iter_chunks()
+        next(chunks)
+        visited = next(chunks)
+        # Another reader caches the chunk the iterator is visiting, moving on must not drop it
+        block = world.get_block(AbsoluteCoordinate(1, 0, 0))
+        next(chunks)
+        assert world.get_chunk(ChunkCoordinate(0, 0)) is visited
+        assert block.get_state().name == 'minecraft:stone'
+        list(chunks)
+        assert list(world.regions) == [RegionCoordinate(0, 0)]
+        assert world.cache_stats['hits'] == 1
+
+    with World(world_folder, write=False, max_chunks=1) as world:
+        def iterate(_):
+            return [(c.coordinate.x, c.coordinate.z) for c in world.iter_chunks()]
+
+        def read(i):
+            return world.get_block(AbsoluteCoordinate(16 * (i % 2) + 1, 0, 16 * (i // 2 % 2))).get_state().name
+
+        with ThreadPoolExecutor(8) as executor:
+            iterations = [executor.submit(iterate, i) for i in range(8)]
+            reads = list(executor.map(read, range(128)))
+        assert all(i.result() == [(-1, 0), (0, 0), (0, 1), (1, 0), (1, 1)] for i in iterations)
+        assert set(reads) == {'minecraft:stone'}